@@ -8,17 +8,31 @@ from __future__ import print_function
 import os
 import sys
 import re
+import json
+import time
+import shutil
+import hashlib
+import threading
+import quopri
 import base64
+import socket
+import ssl
 import logging
 import binascii
 import datetime
 import functools
-from collections import namedtuple
+import fnmatch
+import numbers
+import string
+import types
+from collections import namedtuple, OrderedDict
+from select import select as select_io
 
 import imaplib
 import smtplib
 import mimetypes
 import email
+import email.base64mime
 from email.header import decode_header
 from email.mime.base import MIMEBase
 from email.mime.text import MIMEText
@@ -26,11 +40,15 @@ from email.mime.image import MIMEImage
 from email.mime.audio import MIMEAudio
 from email.mime.multipart import MIMEMultipart
 from email.header import Header as EmailHeader
+from email.parser import HeaderParser
 from email.utils import (
     getaddresses as get_email_addr,
     formatdate as format_email_date,
     parseaddr as parse_email_addr,
     formataddr as format_email_addr,
+    decode_params as decode_email_params,
+    collapse_rfc2231_value,
+    unquote as unquote_email_value,
 )
 
 try:
@@ -38,6 +56,21 @@ try:
 except ImportError:
     from UserString import UserString
 
+try:
+    from sys import intern
+except ImportError:
+    pass  # Python 2 内置的 intern 函数
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+try:
+    from email.parser import BytesHeaderParser
+except ImportError:
+    BytesHeaderParser = None
+
 
 __version__ = "0.2.3"
 
@@ -48,6 +81,11 @@ else:
     string_types = basestring  # noqa
     binary_types = str
 
+try:
+    _network_errors = (ConnectionError, socket.timeout, ssl.SSLError)
+except NameError:  # Python 2
+    _network_errors = (socket.error, ssl.SSLError)
+
 if 'ID' not in imaplib.Commands:
     imaplib.Commands['ID'] = ('AUTH', 'NONAUTH')
 
@@ -114,15 +152,548 @@ def _shorten_sequence_string(sequence, max_len=3, placeholder="..."):
     )
 
 
+def _iter_chunks(iterable, size):
+    """将可迭代对象按指定大小分块"""
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _iter_prefetched(iterable, size=1):
+    """在后台线程中预先读取可迭代对象的元素，使读取与处理并行进行
+
+    最多预读 size 个元素，迭代结束或者中途退出时等待后台线程结束
+    """
+    items = queue.Queue(maxsize=max(size, 1))
+    stopped = threading.Event()
+    end = object()
+
+    def put(item):
+        while not stopped.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+        except Exception as ex:
+            put((end, ex))
+        else:
+            put((end, None))
+
+    thread = threading.Thread(target=produce)
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            item, error = items.get()
+            if item is end:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        stopped.set()
+        thread.join()
+
+
+def _merge_sequence_ranges(ranges):
+    """合并编号区间，返回有序且互不重叠的 (起始, 结束) 列表"""
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+
+def _iter_sequence_sets(ranges, max_length=None):
+    """将编号区间格式化为 IMAP 序列集合
+
+    指定 max_length 时拆分为多个长度不超过该值的集合
+    """
+    items, length = [], 0
+    for start, end in ranges:
+        item = str(start) if start == end else '{}:{}'.format(start, end)
+        if max_length and items and length + len(item) > max_length:
+            yield ','.join(items)
+            items, length = [], 0
+        items.append(item)
+        length += len(item) + 1
+    if items:
+        yield ','.join(items)
+
+
+def _compact_sequence_set(numbers):
+    """将编号序列压缩为 IMAP 序列集合，如 [1, 2, 3, 5] 转化为 '1:3,5'"""
+    ranges = _merge_sequence_ranges((int(num), int(num)) for num in numbers)
+    return ','.join(_iter_sequence_sets(ranges))
+
+
+def _expand_sequence_set(sequence_set):
+    """将 IMAP 序列集合展开为编号列表，如 '1:3,5' 转化为 [1, 2, 3, 5]"""
+    sequence_set = _decode_string(sequence_set, "utf-8") or ''
+    numbers = []
+    for item in sequence_set.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        if ':' in item:
+            start, end = sorted(int(num) for num in item.split(':', 1))
+            numbers.extend(range(start, end + 1))
+        else:
+            numbers.append(int(item))
+    return numbers
+
+
+def _parse_uid_ranges(uid_set):
+    """解析 uid 集合，返回合并后的 uid 区间列表"""
+    if isinstance(uid_set, binary_types):
+        uid_set = uid_set.decode("utf-8")
+    if isinstance(uid_set, string_types):
+        uid_set = uid_set.split(',')
+    elif isinstance(uid_set, numbers.Integral):
+        uid_set = [uid_set]
+    try:
+        uid_set_iter = iter(uid_set)
+    except TypeError:
+        raise ValueError('Wrong uid type: "{}"'.format(type(uid_set)))
+
+    ranges = []
+    for uid in uid_set_iter:
+        if isinstance(uid, numbers.Integral):
+            ranges.append((int(uid), int(uid)))
+            continue
+        if not isinstance(uid, string_types):
+            try:
+                uid = uid.uid
+            except AttributeError:
+                raise ValueError('Wrong uid: "{}"'.format(uid))
+        uid = uid.strip()
+        if not uid:
+            continue
+        bounds = uid.split(':', 1)
+        if not all(item.strip().isdigit() for item in bounds):
+            raise ValueError('Wrong uid: "{}"'.format(uid))
+        bounds = sorted(int(item) for item in bounds)
+        ranges.append((bounds[0], bounds[-1]))
+    return _merge_sequence_ranges(ranges)
+
+
+# 命令数据中的字面量标记，如 b'SUBJECT {6}\r\n'
+_literal_marker_pattern = re.compile(br'\{(\d+)\}\r\n')
+
+
+def _split_literals(data):
+    """将包含字面量的命令数据拆分为需要分别发送的片段
+
+    如 b'SUBJECT {6}\\r\\n<6 字节> FROM {3}\\r\\n<3 字节>' 拆分为
+    [b'SUBJECT {6}', b'<6 字节> FROM {3}', b'<3 字节>']，每个片段之后需要发送 CRLF，
+    从第二个片段开始需要等待服务器的继续响应后再发送
+    """
+    segments = []
+    start = pos = 0
+    while True:
+        match = _literal_marker_pattern.search(data, pos)
+        if not match:
+            break
+        segments.append(data[start:match.end() - 2])
+        start = match.end()
+        pos = start + int(match.group(1))
+    segments.append(data[start:])
+    return segments
+
+
+def _compile_criterions(criterions, charset=None):
+    """编译检索条件，将其中的 MailQuery 对象转换为字符串，返回 (检索条件, 字符集)"""
+    result = []
+    for criterion in criterions:
+        if isinstance(criterion, MailQuery):
+            query_charset, criterion = criterion.compile()
+            charset = charset or query_charset
+        result.append(criterion)
+    return tuple(result), charset
+
+
+def _normalize_flags(flags):
+    """将邮件标志转化为统一的格式，如 '\\Seen' 转化为 'SEEN'"""
+    return tuple(
+        _decode_string(flag, "utf-8").strip().replace('\\', '').upper()
+        for flag in (flags or [])
+    )
+
+
+_short_month_names = ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun',
+                      'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec')
+
+# 匹配 IMAP 的 INTERNALDATE，如 '17-Jul-1996 02:44:25 -0700'
+_internal_date_pattern = re.compile(
+    r'(?P<day>\d{1,2})-(?P<month>[A-Za-z]{3})-(?P<year>\d{4})\s+'
+    r'(?P<hour>\d{1,2}):(?P<minute>\d{2}):(?P<second>\d{2})\s*'
+    r'(?P<zone_sign>[+-])(?P<zone>\d{4})'
+)
+
+
+def _parse_internal_date(value):
+    """解析 IMAP 的 INTERNALDATE，返回带时区的 datetime 对象，格式错误时返回 None"""
+    match = _internal_date_pattern.search(_decode_string(value, "utf-8") or '')
+    if not match or match.group('month').title() not in _short_month_names:
+        return None
+    zone_sign = int('{}1'.format(match.group('zone_sign')))
+    zone = match.group('zone')
+    return datetime.datetime(
+        year=int(match.group('year')),
+        month=_short_month_names.index(match.group('month').title()) + 1,
+        day=int(match.group('day')),
+        hour=int(match.group('hour')),
+        minute=int(match.group('minute')),
+        second=int(match.group('second')),
+        tzinfo=datetime.timezone(datetime.timedelta(
+            hours=int(zone[:2]) * zone_sign,
+            minutes=int(zone[2:]) * zone_sign
+        )),
+    )
+
+
+# 匹配 Date、Received 邮件头中的日期，如 '2 Mar 2020 10:00:00 +0800'
+_email_date_pattern = re.compile(
+    r'(?P<date>\d{1,2}\s+(' + '|'.join(_short_month_names) +
+    r')\s+\d{4})\s+' +
+    r'(?P<time>\d{1,2}:\d{1,2}(:\d{1,2})?)\s*' +
+    r'(?P<zone_sign>[+-])?(?P<zone>\d{4})?'
+)
+
+
+def _parse_email_date(value):
+    """解析邮件头中的日期，返回 datetime 对象，格式错误时返回 None"""
+    match = _email_date_pattern.search(_decode_string(value, "utf-8") or '')
+    if not match:
+        return None
+    group = match.groupdict()
+    day, month, year = group['date'].split()
+    time_values = group['time'].split(':')
+    zone_sign = int('{}1'.format(group.get('zone_sign') or '+'))
+    zone = group['zone']
+    return datetime.datetime(
+        year=int(year),
+        month=_short_month_names.index(month) + 1,
+        day=int(day),
+        hour=int(time_values[0]),
+        minute=int(time_values[1]),
+        second=int(time_values[2]) if len(time_values) > 2 else 0,
+        tzinfo=datetime.timezone(datetime.timedelta(
+            hours=int(zone[:2]) * zone_sign,
+            minutes=int(zone[2:]) * zone_sign
+        )) if zone else None,
+    )
+
+
+def _parse_email_headers(data):
+    """仅解析邮件头部分，返回只包含邮件头的 email.message.Message 对象"""
+    match = re.search(br'\r?\n\r?\n' if isinstance(data, binary_types)
+                      else r'\r?\n\r?\n', data)
+    if match:
+        data = data[:match.end()]
+    if isinstance(data, string_types):
+        return HeaderParser().parsestr(data)
+    return BytesHeaderParser().parsebytes(data)
+
+
+# 邮件原始数据中的 MIME 叶子部分：编号、邮件头对象、内容在原始数据中的起止偏移
+_MimePartSlice = namedtuple("MimePartSlice", "section headers start end")
+
+# 匹配邮件头与内容之间的空行
+_header_end_pattern = re.compile(br'\r?\n\r?\n')
+
+
+def _bytes_slice(data, start, end):
+    """获取 bytes 或 memoryview 的片段，返回 bytes"""
+    chunk = data[start:end]
+    return chunk.tobytes() if isinstance(chunk, memoryview) else chunk
+
+
+def _index_mime_parts(data, start=0, end=None, section='', parts=None,
+                      encapsulated=False):
+    """单次扫描邮件的原始数据，建立 MIME 叶子部分的偏移索引
+
+    data 为 bytes 或 memoryview，仅解析各部分的邮件头，不复制也不解码内容，返回
+    _MimePartSlice 列表，顺序与 email.message.Message.walk() 的叶子部分一致
+    """
+    parts = [] if parts is None else parts
+    end = len(data) if end is None else end
+    if data[start:start + 1] == b'\n' or data[start:start + 2] == b'\r\n':
+        header_end = start   # 没有邮件头
+        body_start = start + (1 if data[start:start + 1] == b'\n' else 2)
+    else:
+        match = _header_end_pattern.search(data, start, end)
+        header_end = body_start = match.end() if match else end
+    headers = _parse_email_headers(_bytes_slice(data, start, header_end))
+
+    maintype = headers.get_content_maintype()
+    boundary = headers.get_boundary() if maintype == 'multipart' else None
+    encoding = str(headers.get('Content-Transfer-Encoding', '')).lower()
+    if boundary:
+        delimiter = re.compile(
+            br'^--' + re.escape(boundary.encode("utf-8")) +
+            br'(?P<close>--)?[ \t]*\r?(?:\n|\Z)', re.M
+        )
+        part_start = None
+        index = 0
+        for match in delimiter.finditer(data, body_start, end):
+            if part_start is not None:
+                # 分隔符之前的换行符属于分隔符
+                part_end = match.start()
+                if data[part_end - 1:part_end] == b'\n':
+                    part_end -= 1
+                    if data[part_end - 1:part_end] == b'\r':
+                        part_end -= 1
+                index += 1
+                _index_mime_parts(
+                    data, part_start, max(part_end, part_start),
+                    "{}.{}".format(section, index) if section else str(index),
+                    parts
+                )
+            if match.group('close'):
+                break
+            part_start = match.end()
+        return parts
+    if headers.get_content_type() == 'message/rfc822' and \
+            encoding in ('', '7bit', '8bit', 'binary'):
+        # 与 walk() 一致，展开内嵌的邮件
+        return _index_mime_parts(data, body_start, end, section, parts,
+                                 encapsulated=True)
+    # 邮件本身或内嵌邮件不是 multipart 时，其内容的编号为 1 或者 x.1
+    if encapsulated or not section:
+        section = "{}.1".format(section) if section else '1'
+    parts.append(_MimePartSlice(section, headers, body_start, end))
+    return parts
+
+
+def _walk_email_parts(msg, section='', encapsulated=False):
+    """遍历 email.message.Message 对象，依次返回叶子部分的 (编号, 部分)
+
+    编号规则与 _index_mime_parts 相同，顺序与 walk() 一致
+    """
+    if msg.is_multipart():
+        payload = msg.get_payload()
+        if msg.get_content_maintype() == 'message':
+            for inner in payload:
+                for result in _walk_email_parts(inner, section, True):
+                    yield result
+            return
+        for index, part in enumerate(payload, 1):
+            sub_section = ("{}.{}".format(section, index) if section
+                           else str(index))
+            for result in _walk_email_parts(part, sub_section):
+                yield result
+        return
+    if encapsulated or not section:
+        section = "{}.1".format(section) if section else '1'
+    yield section, msg
+
+
+def _iter_mime_payload(data, encoding, chunk_size=None):
+    """按内容传输编码分块解码 MIME 部分的内容，data 为 bytes 或 memoryview"""
+    chunk_size = chunk_size or len(data) or 1
+    chunks = (_bytes_slice(data, pos, pos + chunk_size)
+              for pos in range(0, len(data), chunk_size))
+    encoding = _decode_string(str(encoding or ''), "utf-8").strip()
+    return _iter_decoded_chunks(chunks, encoding)
+
+
 def _decode_email_header(header):
     data, encoding = decode_header(header)[0]
     return _decode_string(data, encoding)
 
 
+# IMAP 响应数据中的词法单元：括号、带引号字符串、字面量标记、原子（包括 NIL、数字、
+# 标志以及形如 BODY[HEADER.FIELDS (FROM)]<0> 的数据项名称）
+_imap_token_pattern = re.compile(
+    br'\s*(?:(?P<open>\()|(?P<close>\))'
+    br'|"(?P<quoted>(?:[^"\\]|\\.)*)"'
+    br'|\{(?P<literal>\d+)\}$'
+    br'|(?P<atom>[^\s()"\[]+(?:\[[^\]]*\](?:<\d+>)?)?))'
+)
+
+
+def _parse_imap_response(data):
+    """解析 imaplib 返回的原始响应数据
+
+    data 为 imaplib 命令返回的数据列表，其中字面量以 (头部, 字面量) 元组的形式出现。
+    括号列表转化为 list，带引号字符串及原子转化为 str，字面量保持为 bytes，NIL 为 None
+    """
+    stack = [[]]
+    for item in data:
+        if isinstance(item, (tuple, list)):
+            text, literal = item[0], item[1]
+        else:
+            text, literal = item, None
+        if not isinstance(text, binary_types):
+            text = text.encode("utf-8")
+        text = text.rstrip()
+        pos = 0
+        while pos < len(text):
+            match = _imap_token_pattern.match(text, pos)
+            if not match or match.end() == pos:
+                raise ValueError("Invalid IMAP response: {!r}".format(text))
+            pos = match.end()
+            if match.group('open'):
+                stack.append([])
+            elif match.group('close'):
+                if len(stack) < 2:
+                    raise ValueError("Unbalanced IMAP response: {!r}".format(
+                        text
+                    ))
+                value = stack.pop()
+                stack[-1].append(value)
+            elif match.group('quoted') is not None:
+                value = re.sub(br'\\(.)', br'\1', match.group('quoted'))
+                stack[-1].append(_decode_string(value, "utf-8"))
+            elif match.group('literal') is not None:
+                if literal is None:
+                    raise ValueError("Missing literal: {!r}".format(text))
+                stack[-1].append(literal)
+                literal = None
+            else:
+                value = _decode_string(match.group('atom'), "utf-8")
+                stack[-1].append(None if value.upper() == 'NIL' else value)
+    if len(stack) != 1:
+        raise ValueError("Unbalanced IMAP response: {!r}".format(data))
+    return stack[0]
+
+
+def _parse_fetch_response(data):
+    """解析单封邮件的 FETCH 响应数据，返回数据项名称（大写）到值的字典"""
+    values = _parse_imap_response(data)
+    if len(values) < 2 or not isinstance(values[1], list):
+        raise ValueError("Invalid FETCH response: {!r}".format(values))
+    items = values[1]
+    return {
+        str(items[i]).upper(): items[i + 1]
+        for i in range(0, len(items) - 1, 2)
+    }
+
+
+def _decode_structure_params(params):
+    """将 BODYSTRUCTURE 中的参数列表转化为字典，并处理 RFC 2231 编码的参数值"""
+    if not isinstance(params, list):
+        return {}
+    pairs = [
+        (str(params[i]).lower(), _decode_string(params[i + 1], "utf-8") or '')
+        for i in range(0, len(params) - 1, 2)
+    ]
+    # decode_params 会原样保留第一个参数，因此需要添加一个占位参数
+    result = {}
+    for name, value in decode_email_params([('', '')] + pairs)[1:]:
+        if isinstance(value, tuple):  # RFC 2231 编码的值
+            value = (value[0], value[1], unquote_email_value(value[2]))
+        result[name] = collapse_rfc2231_value(value)
+    return result
+
+
+def _walk_bodystructure(structure, section=""):
+    """遍历 BODYSTRUCTURE，依次返回非 multipart 部分的 (section, 结构信息)"""
+    if structure and isinstance(structure[0], list):  # multipart
+        index = 0
+        for item in structure:
+            if not isinstance(item, list):
+                break
+            index += 1
+            sub_section = ("{}.{}".format(section, index) if section
+                           else str(index))
+            for result in _walk_bodystructure(item, sub_section):
+                yield result
+        return
+    yield section or "1", structure
+
+
+def _parse_bodystructure_part(structure):
+    """解析单个非 multipart 部分的 BODYSTRUCTURE 信息"""
+    maintype = (structure[0] or 'application').lower()
+    subtype = (structure[1] or 'octet-stream').lower()
+    # 基本字段之后，text 类型有行数字段，message/rfc822 类型有信封、结构、行数字段
+    if maintype == 'text':
+        ext_index = 8
+    elif (maintype, subtype) == ('message', 'rfc822'):
+        ext_index = 10
+    else:
+        ext_index = 7
+    disposition = None
+    disposition_params = {}
+    if len(structure) > ext_index + 1 and isinstance(
+            structure[ext_index + 1], list):
+        disposition = (structure[ext_index + 1][0] or '').lower()
+        disposition_params = _decode_structure_params(
+            structure[ext_index + 1][1]
+        )
+    params = _decode_structure_params(structure[2])
+    filename = disposition_params.get('filename') or params.get('name')
+    if filename:
+        filename = _decode_email_header(filename).strip()
+    try:
+        size = int(structure[6])
+    except (TypeError, ValueError, IndexError):
+        size = None
+    content_id = _decode_string(structure[3], "utf-8") \
+        if len(structure) > 3 and structure[3] else None
+    return {
+        "content_type": "{}/{}".format(maintype, subtype),
+        "charset": params.get('charset'),
+        "encoding": (structure[5] or '7bit').lower(),
+        "size": size,
+        "disposition": disposition,
+        "filename": filename,
+        "content_id": content_id.strip().strip('<>') if content_id else None,
+    }
+
+
+def _iter_decoded_chunks(chunks, encoding):
+    """按内容传输编码逐块解码数据，用于流式处理大附件"""
+    encoding = (encoding or '').lower()
+    rest = b''
+    if encoding == 'base64':
+        for chunk in chunks:
+            data = rest + re.sub(br'\s+', b'', chunk)
+            cut = len(data) - len(data) % 4
+            rest = data[cut:]
+            if cut:
+                yield base64.b64decode(data[:cut])
+        if rest.strip(b'='):
+            yield base64.b64decode(rest + b'=' * (-len(rest) % 4))
+    elif encoding == 'quoted-printable':
+        for chunk in chunks:
+            data = rest + chunk
+            cut = data.rfind(b'\n') + 1
+            rest = data[cut:]
+            if cut:
+                yield quopri.decodestring(data[:cut])
+        if rest:
+            yield quopri.decodestring(rest)
+    else:
+        for chunk in chunks:
+            yield chunk
+
+
 class UnexpectedCommandStatusError(Exception):
     """命令执行返回的状态错误"""
 
 
+class CapabilityNotSupportedError(Exception):
+    """服务器不支持所需的扩展"""
+
+
 class imap_utf7(object):
     """IMAP 协议中的 UTF7 字符串编解码，按照 RFC 3501 实现
 
@@ -195,6 +766,299 @@ class MailFolder(namedtuple("MailFolder", "name flags delim")):
     """
 
 
+class MailFolderStatus(namedtuple(
+        "MailFolderStatus",
+        "name exists uidvalidity uidnext highestmodseq vanished")):
+    """选择邮箱目录时服务器返回的目录状态
+
+    name: str - folder name
+    exists: int - number of messages
+    uidvalidity: int - UIDVALIDITY value, UIDs are stable while it is unchanged
+    uidnext: int - predicted next UID
+    highestmodseq: int - HIGHESTMODSEQ value, None without CONDSTORE
+    vanished: list - uids expunged since the modseq passed to
+        select(qresync=(uidvalidity, modseq)), None otherwise
+    """
+
+
+# vanished 仅在 QRESYNC 同步时可用，默认为 None
+MailFolderStatus.__new__.__defaults__ = (None,)
+
+
+class MailChange(namedtuple("MailChange", "uid flags modseq")):
+    """邮件标志的变化
+
+    uid: str - message uid
+    flags: tuple - current flags of the message
+    modseq: int - MODSEQ value of the message
+    """
+
+
+class MailChanges(namedtuple("MailChanges", "changed vanished highestmodseq")):
+    """邮箱目录自某个 MODSEQ 之后的变化
+
+    changed: list - MailChange list of messages whose flags changed
+    vanished: list - uids of expunged messages, only available with QRESYNC
+    highestmodseq: int - the highest MODSEQ seen, used for next call
+    """
+
+
+class MailSearchResult(namedtuple("MailSearchResult", "count min max all")):
+    """服务器端统计的搜索结果（RFC 4731 ESEARCH）
+
+    count: int - number of matched messages
+    min: int - the lowest matched uid or message number
+    max: int - the highest matched uid or message number
+    all: str - matched uids or message numbers as a compact sequence set
+    """
+
+
+class MailSendResult(namedtuple(
+        "MailSendResult", "message success error refused attempts")):
+    """批量发送邮件时每封邮件的发送结果
+
+    message: Message - the message sent
+    success: bool - whether the message was accepted by the server
+    error: Exception - the last error when sending failed
+    refused: dict - recipients refused by the server, {addr: (code, msg)}
+    attempts: int - number of send attempts
+    """
+
+
+class MessageRecord(namedtuple(
+        "MessageRecord", "uid flags size internal_date date subject "
+                         "sender sender_name recipients cc message_id "
+                         "in_reply_to")):
+    """邮件列表记录
+
+    由 FETCH 响应中的 ENVELOPE 等数据构建的只读轻量记录，不包含邮件内容，适合在
+    内存中保存大量邮件的列表。邮件地址及标志会被驻留以共享相同的字符串，可以通过
+    to_message 方法下载完整的邮件
+
+    uid: str - unique identifier of the message
+    flags: tuple - normalized flags, such as ('SEEN', 'FLAGGED')
+    size: int - size of the message in bytes (RFC822.SIZE)
+    internal_date: datetime - the date the message was received by the server
+    date: datetime - the date from the Date header
+    subject: str - decoded subject
+    sender: str - email address of the sender
+    sender_name: str - display name of the sender
+    recipients: tuple - email addresses of the To recipients
+    cc: tuple - email addresses of the CC recipients
+    message_id: str - the Message-ID header
+    in_reply_to: str - the In-Reply-To header
+    """
+
+    __slots__ = ()
+
+    # 相同的标志组合共享同一个元组对象
+    _interned_flags = {}
+
+    @classmethod
+    def _intern_flags(cls, flags):
+        flags = tuple(intern(str(flag)) for flag in _normalize_flags(flags))
+        return cls._interned_flags.setdefault(flags, flags)
+
+    @staticmethod
+    def _envelope_addresses(addresses):
+        """将 ENVELOPE 中的地址列表转化为 (名称, 地址) 元组列表，忽略地址组标记"""
+        result = []
+        for item in addresses or []:
+            if not isinstance(item, list) or len(item) < 4:
+                continue
+            name, _, mailbox, host = item[:4]
+            if mailbox is None or host is None:
+                continue
+            address = "{}@{}".format(_decode_string(mailbox, "utf-8"),
+                                     _decode_string(host, "utf-8"))
+            name = _decode_email_header(_decode_string(name, "utf-8")) \
+                if name else ''
+            result.append((name.strip(), intern(str(address.lower()))))
+        return result
+
+    @classmethod
+    def from_fetch_items(cls, items):
+        """由 _parse_fetch_response 解析得到的数据项字典构建邮件记录"""
+        envelope = items.get('ENVELOPE') or [None] * 10
+
+        def envelope_text(index):
+            value = envelope[index] if index < len(envelope) else None
+            return _decode_string(value, "utf-8") if value else None
+
+        subject = envelope_text(1)
+        senders = cls._envelope_addresses(envelope[2])
+        size = items.get('RFC822.SIZE')
+        return cls(
+            uid=_decode_string(items.get('UID'), "utf-8"),
+            flags=cls._intern_flags(items.get('FLAGS')),
+            size=int(size) if size is not None else None,
+            internal_date=_parse_internal_date(items.get('INTERNALDATE')),
+            date=_parse_email_date(envelope_text(0)),
+            subject=_decode_email_header(subject) if subject else '',
+            sender=senders[0][1] if senders else None,
+            sender_name=senders[0][0] if senders else '',
+            recipients=tuple(
+                addr for _, addr in cls._envelope_addresses(envelope[5])
+            ),
+            cc=tuple(addr for _, addr in cls._envelope_addresses(envelope[6])),
+            in_reply_to=envelope_text(8),
+            message_id=envelope_text(9),
+        )
+
+    def to_message(self, mailbox, mark_seen=False, headers_only=False):
+        """通过 UID 下载完整的邮件，mailbox 需要选择记录所在的目录"""
+        messages = mailbox.fetch_messages([self.uid], mark_seen=mark_seen,
+                                          uid=True, headers_only=headers_only)
+        return messages[0] if messages else None
+
+
+class MailSyncState(object):
+    """邮件增量同步状态
+
+    以 JSON 格式将每个邮箱目录的 UIDVALIDITY 及已同步的最大 UID 保存在本地文件中
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._states = None
+
+    @property
+    def states(self):
+        if self._states is None:
+            if os.path.exists(self.path):
+                with open(self.path) as fp:
+                    self._states = json.load(fp)
+            else:
+                self._states = {}
+        return self._states
+
+    def get(self, key):
+        """获取同步状态，返回 (uidvalidity, last_uid)"""
+        state = self.states.get(key) or {}
+        return state.get("uidvalidity"), state.get("last_uid", 0)
+
+    def update(self, key, uidvalidity, last_uid):
+        self.states[key] = {"uidvalidity": uidvalidity, "last_uid": last_uid}
+
+    def save(self):
+        tmp_path = "{}.tmp".format(self.path)
+        with open(tmp_path, "w") as fp:
+            json.dump(self.states, fp, indent=2, sort_keys=True)
+        getattr(os, "replace", os.rename)(tmp_path, self.path)
+
+
+class MessageCache(object):
+    """邮件本地磁盘缓存
+
+    按 (目录, UIDVALIDITY, UID) 缓存邮件的原始数据，邮件内容不可变，因此只要目录的
+    UIDVALIDITY 不变即可直接使用缓存，UIDVALIDITY 变化时自动清除该目录的缓存。
+    缓存总大小超过 max_size 时按最近最少使用的顺序淘汰
+    """
+
+    def __init__(self, directory, max_size=512 * 1024 * 1024):
+        self.directory = directory
+        self.max_size = max_size
+
+        self._lock = threading.RLock()
+        self._index = None      # 缓存文件路径到文件大小的有序字典，按访问时间排序
+        self._total_size = 0
+        self._uidvalidities = {}  # 已校验过的目录 UIDVALIDITY
+
+    def _load_index(self):
+        if self._index is not None:
+            return
+        entries = []
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if not name.endswith(".eml"):
+                    continue
+                path = os.path.join(root, name)
+                stat = os.stat(path)
+                entries.append((stat.st_mtime, path, stat.st_size))
+        entries.sort()
+        self._index = OrderedDict((path, size) for _, path, size in entries)
+        self._total_size = sum(self._index.values())
+
+    def _folder_dir(self, folder_key):
+        digest = hashlib.md5(folder_key.encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, digest)
+
+    def _path(self, folder_key, uidvalidity, uid):
+        return os.path.join(self._folder_dir(folder_key), str(uidvalidity),
+                            "{}.eml".format(uid))
+
+    def _remove(self, path):
+        size = self._index.pop(path, 0)
+        self._total_size -= size
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def invalidate(self, folder_key, uidvalidity):
+        """清除目录中与当前 UIDVALIDITY 不一致的缓存"""
+        with self._lock:
+            if self._uidvalidities.get(folder_key) == uidvalidity:
+                return
+            self._load_index()
+            folder_dir = self._folder_dir(folder_key)
+            if os.path.isdir(folder_dir):
+                for name in os.listdir(folder_dir):
+                    if name == str(uidvalidity):
+                        continue
+                    stale_dir = os.path.join(folder_dir, name)
+                    for path in list(self._index):
+                        if path.startswith(stale_dir + os.sep):
+                            self._total_size -= self._index.pop(path)
+                    shutil.rmtree(stale_dir, ignore_errors=True)
+            self._uidvalidities[folder_key] = uidvalidity
+
+    def get(self, folder_key, uidvalidity, uid):
+        """获取缓存的邮件原始数据，不存在时返回 None"""
+        with self._lock:
+            self.invalidate(folder_key, uidvalidity)
+            path = self._path(folder_key, uidvalidity, uid)
+            if path not in self._index:
+                return None
+            try:
+                with open(path, "rb") as fp:
+                    data = fp.read()
+                os.utime(path, None)
+            except (IOError, OSError):
+                self._remove(path)
+                return None
+            self._index[path] = self._index.pop(path)  # 移动到最近使用的位置
+            return data
+
+    def set(self, folder_key, uidvalidity, uid, data):
+        """缓存邮件原始数据"""
+        if len(data) > self.max_size:
+            return
+        with self._lock:
+            self.invalidate(folder_key, uidvalidity)
+            path = self._path(folder_key, uidvalidity, uid)
+            if path in self._index:
+                return
+            dirname = os.path.dirname(path)
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            tmp_path = "{}.tmp".format(path)
+            with open(tmp_path, "wb") as fp:
+                fp.write(data)
+            getattr(os, "replace", os.rename)(tmp_path, path)
+            self._index[path] = len(data)
+            self._total_size += len(data)
+            while self._total_size > self.max_size and self._index:
+                self._remove(next(iter(self._index)))
+
+    def clear(self):
+        with self._lock:
+            shutil.rmtree(self.directory, ignore_errors=True)
+            self._index = OrderedDict()
+            self._total_size = 0
+            self._uidvalidities = {}
+
+
 class MailFlag(object):
     """基本邮件标志"""
 
@@ -206,6 +1070,184 @@ class MailFlag(object):
     RECENT = 'RECENT'      # 邮件最近到达该邮箱（本次会话是首次收到当前邮件通知）
 
 
+class MailQuery(object):
+    """邮件搜索条件
+
+    关键字参数之间为“与”的关系，值为列表时列表中的元素之间为“或”的关系，多个
+    条件可以通过 &、|、~ 组合，最终编译为一条 IMAP SEARCH 命令在服务器端执行，如：
+
+        MailQuery(sender=["a@mail.com", "b@mail.com"], since=date(2020, 1, 1))
+        MailQuery(subject="报告") & ~MailQuery(seen=True)
+
+    支持的关键字参数：
+        sender, to, cc, bcc, subject, body, text: 对应字段包含指定的字符串
+        since, before, on: 邮件到达服务器的日期（INTERNALDATE），可以为 date、
+            datetime 对象或者字符串
+        sent_since, sent_before, sent_on: 邮件头中的发送日期（Date）
+        larger, smaller: 邮件大小大于或者小于指定的字节数
+        flags, no_flags: 带有或者不带有指定的标志，如 MailFlag.SEEN
+        seen, flagged, answered: 是否带有对应的标志
+        header: 字典，邮件头包含指定的字符串，如 {"X-Mailer": "kmailbox"}
+        uid: 邮件的 UID 集合
+    """
+
+    _string_keys = (
+        ("sender", "FROM"), ("to", "TO"), ("cc", "CC"), ("bcc", "BCC"),
+        ("subject", "SUBJECT"), ("body", "BODY"), ("text", "TEXT"),
+    )
+    _date_keys = (
+        ("since", "SINCE"), ("before", "BEFORE"), ("on", "ON"),
+        ("sent_since", "SENTSINCE"), ("sent_before", "SENTBEFORE"),
+        ("sent_on", "SENTON"),
+    )
+    _flag_keys = (("seen", MailFlag.SEEN), ("flagged", MailFlag.FLAGGED),
+                  ("answered", MailFlag.ANSWERED))
+
+    def __init__(self, **kwargs):
+        self._keys = []
+        for name, key in self._string_keys:
+            if kwargs.get(name) is not None:
+                values = self._as_list(kwargs.pop(name))
+                if not values:
+                    raise ValueError(
+                        "Query field '{}' got an empty list".format(name)
+                    )
+                self._keys.append(self._or_keys([
+                    [key, self.quote(value)] for value in values
+                ]))
+        for name, key in self._date_keys:
+            if kwargs.get(name) is not None:
+                self._keys.append([key, self.format_date(kwargs.pop(name))])
+        for name, key in (("larger", "LARGER"), ("smaller", "SMALLER")):
+            if kwargs.get(name) is not None:
+                self._keys.append([key, str(int(kwargs.pop(name)))])
+        flags = self._as_list(kwargs.pop("flags", None) or [])
+        no_flags = self._as_list(kwargs.pop("no_flags", None) or [])
+        for name, flag in self._flag_keys:
+            value = kwargs.pop(name, None)
+            if value is not None:
+                (flags if value else no_flags).append(flag)
+        self._keys.extend([self._flag_key(flag, True)] for flag in flags)
+        self._keys.extend([self._flag_key(flag, False)] for flag in no_flags)
+        for name, value in (kwargs.pop("header", None) or {}).items():
+            self._keys.append(["HEADER", self.quote(name), self.quote(value)])
+        if kwargs.get("uid") is not None:
+            self._keys.append(["UID", MailBox._clean_uid_set(kwargs.pop("uid"))])
+        if kwargs:
+            raise ValueError("Unknown query fields: {}".format(
+                ", ".join(sorted(kwargs))
+            ))
+
+    @staticmethod
+    def _as_list(value):
+        if isinstance(value, (string_types, binary_types)) or \
+                not hasattr(value, '__iter__'):
+            return [value]
+        return list(value)
+
+    @staticmethod
+    def _flag_key(flag, value):
+        flag = flag.lstrip('\\')
+        if flag.upper() in ('SEEN', 'ANSWERED', 'FLAGGED', 'DELETED', 'DRAFT'):
+            return flag.upper() if value else 'UN' + flag.upper()
+        if flag.upper() == 'RECENT':
+            return 'RECENT' if value else 'OLD'
+        return '{} {}'.format('KEYWORD' if value else 'UNKEYWORD', flag)
+
+    @staticmethod
+    def _or_keys(keys):
+        """将多个检索条件组合为“或”的关系，IMAP 的 OR 只接受两个参数"""
+        result = keys[-1]
+        for key in reversed(keys[:-1]):
+            result = ["OR", key, result]
+        return result
+
+    @classmethod
+    def _combine(cls, *keys):
+        query = cls()
+        query._keys = list(keys)
+        return query
+
+    def _as_key(self):
+        if len(self._keys) == 1:
+            return self._keys[0]
+        return [self._keys or ["ALL"]]
+
+    def __and__(self, other):
+        return self._combine(*(self._keys + other._keys))
+
+    def __or__(self, other):
+        return self._combine(self._or_keys([self._as_key(), other._as_key()]))
+
+    def __invert__(self):
+        return self._combine(["NOT", self._as_key()])
+
+    @staticmethod
+    def quote(value):
+        """将字符串转换为 IMAP 的带引号字符串
+
+        RFC 3501 的带引号字符串不允许包含 8 位字符，包含非 ASCII 字符时转换为
+        字面量，如 '{6}\\r\\n报告'
+        """
+        value = _decode_string(value, "utf-8") \
+            if isinstance(value, binary_types) else value
+        try:
+            value.encode("ascii")
+        except UnicodeError:
+            return "{{{}}}\r\n{}".format(len(value.encode("utf-8")), value)
+        value = value.replace('\\', '\\\\').replace('"', '\\"')
+        return '"{}"'.format(value)
+
+    @classmethod
+    def format_date(cls, value):
+        """将日期转换为 IMAP 的日期格式，如 1-Jan-2020"""
+        if isinstance(value, (datetime.date, datetime.datetime)):
+            return "{}-{}-{}".format(
+                value.day, _short_month_names[value.month - 1], value.year
+            )
+        return value
+
+    @classmethod
+    def _format_key(cls, key):
+        if isinstance(key, list):
+            if len(key) == 1 and isinstance(key[0], list):
+                return "({})".format(" ".join(
+                    cls._format_key(item) for item in key[0]
+                ))
+            return " ".join(cls._format_key(item) for item in key)
+        return key
+
+    @property
+    def criteria(self):
+        """编译后的检索条件字符串"""
+        return " ".join(self._format_key(key) for key in self._keys) or "ALL"
+
+    @property
+    def charset(self):
+        """检索条件包含非 ASCII 字符时需要指定的字符集"""
+        try:
+            self.criteria.encode("ascii")
+        except UnicodeError:
+            return "UTF-8"
+        return None
+
+    def compile(self):
+        """编译为 (字符集, 检索条件) 元组
+
+        包含非 ASCII 字符时检索条件为包含字面量的字节串，由 MailBox 在收到服务器的
+        继续响应后逐个发送字面量
+        """
+        charset = self.charset
+        criteria = self.criteria
+        return charset, criteria.encode("utf-8") if charset else criteria
+
+    def __str__(self):
+        return self.criteria
+
+    def __repr__(self):
+        return "MailQuery({!r})".format(self.criteria)
+
+
 class MailAddress(UserString):
     """邮件地址"""
 
@@ -225,14 +1267,107 @@ class MailAddress(UserString):
                 self.data = address
 
 
+class MessagePart(namedtuple(
+        "MessagePart", "section content_type charset encoding disposition "
+                       "filename size content_id")):
+    """邮件中非 multipart 的 MIME 部分的信息
+
+    section: str - part number as used by IMAP FETCH, such as '1.2'
+    content_type: str - lower-cased content type, such as 'text/plain'
+    charset: str - charset parameter of the content type
+    encoding: str - lower-cased content transfer encoding, such as 'base64'
+    disposition: str - lower-cased content disposition, such as 'attachment'
+    filename: str - decoded filename
+    size: int - size of the encoded part body in bytes
+    content_id: str - Content-ID without angle brackets
+    """
+
+    __slots__ = ()
+
+    @property
+    def is_attachment(self):
+        return self.disposition is not None and bool(self.filename)
+
+    @classmethod
+    def from_email_part(cls, section, part, size=None):
+        """由 email.message.Message 对象（可以只包含邮件头）构建"""
+        disposition = part.get('Content-Disposition')
+        if disposition is not None:
+            disposition = str(disposition).split(';')[0].strip().lower()
+        filename = part.get_filename()
+        content_id = part.get('Content-ID')
+        encoding = part.get('Content-Transfer-Encoding') or '7bit'
+        return cls(
+            section=section,
+            content_type=part.get_content_type(),
+            charset=part.get_content_charset(),
+            encoding=str(encoding).strip().lower(),
+            disposition=disposition,
+            filename=_decode_email_header(filename).strip() if filename
+            else None,
+            size=size,
+            content_id=str(content_id).strip().strip('<>') if content_id
+            else None,
+        )
+
+    @classmethod
+    def from_bodystructure(cls, section, structure):
+        return cls(section=section, **_parse_bodystructure_part(structure))
+
+
 class MailAttachment(object):
-    """邮件附件"""
+    """邮件附件
+
+    通常由已下载的邮件部分 part 构建，也可以通过 from_bodystructure 由 BODYSTRUCTURE
+    信息构建，此时仅在访问 payload 或者下载附件时才从服务器获取该 MIME 部分的数据；
+    通过 from_raw_part 构建时引用邮件原始数据中的片段，在访问 payload 时才解码
+    """
 
     def __init__(self, part):
         self._part = part
 
         self._filename = None
         self._payload = None
+        self._content_type = None
+        self._size = None
+
+        # 由 BODYSTRUCTURE 构建时，记录附件所属的邮件及其 MIME 部分编号
+        self._mailbox = None
+        self._uid = None
+        self._section = None
+        self._encoding = None
+
+        # 由邮件原始数据构建时，记录附件内容在原始数据中的片段（memoryview）
+        self._raw_payload = None
+
+        # 由邮件的 MIME 部分索引构建时，记录对应的 MessagePart
+        self._part_info = None
+
+    @classmethod
+    def from_raw_part(cls, data, part):
+        """由邮件原始数据 data 及 _index_mime_parts 得到的 MIME 部分构建附件"""
+        attachment = cls(part.headers)
+        attachment._raw_payload = memoryview(data)[part.start:part.end]
+        attachment._encoding = part.headers.get('Content-Transfer-Encoding')
+        return attachment
+
+    @classmethod
+    def from_bodystructure(cls, mailbox, uid, section, filename,
+                           content_type, encoding=None, size=None):
+        attachment = cls(None)
+        attachment._mailbox = mailbox
+        attachment._uid = uid
+        attachment._section = section
+        attachment._filename = filename
+        attachment._content_type = content_type
+        attachment._encoding = encoding
+        attachment._size = size
+        return attachment
+
+    def __repr__(self):
+        return "{}(filename={!r}, content_type={!r})".format(
+            self.__class__.__name__, self.filename, self.content_type
+        )
 
     @property
     def filename(self):
@@ -243,9 +1378,29 @@ class MailAttachment(object):
 
     @property
     def content_type(self):
-        return self._part.get_content_type()
+        if self._content_type is None:
+            self._content_type = self._part.get_content_type()
+        return self._content_type
+
+    @property
+    def size(self):
+        """附件大小，由 BODYSTRUCTURE 构建时为编码后的大小"""
+        if self._size is None:
+            self._size = len(self.payload)
+        return self._size
+
+    def _iter_remote_payload(self, chunk_size=None):
+        chunks = self._mailbox._iter_message_section(
+            self._uid, self._section, chunk_size
+        )
+        return _iter_decoded_chunks(chunks, self._encoding)
 
     def _get_payload(self):
+        if self._raw_payload is not None:
+            return b''.join(_iter_mime_payload(self._raw_payload,
+                                               self._encoding))
+        if self._part is None:
+            return b''.join(self._iter_remote_payload())
         payload = self._part.get_payload(decode=True)
         if payload:
             return payload
@@ -271,12 +1426,25 @@ class MailAttachment(object):
             self._payload = self._get_payload()
         return self._payload
 
-    def download(self, directory=None, filename=None):
+    def download(self, directory=None, filename=None, chunk_size=None):
+        """下载为本地文件
+
+        附件由 BODYSTRUCTURE 构建且数据尚未获取时，按 chunk_size 分块从服务器获取并
+        解码后直接写入文件，不会在内存中保存完整的附件数据
+        """
         if not filename:
             filename = self.filename
         path = os.path.join(directory, filename) if directory else filename
         with open(path, "wb") as fp:
-            fp.write(self.payload)
+            if self._part is None and self._payload is None:
+                for chunk in self._iter_remote_payload(chunk_size):
+                    fp.write(chunk)
+            elif self._raw_payload is not None and self._payload is None:
+                for chunk in _iter_mime_payload(self._raw_payload,
+                                                self._encoding, chunk_size):
+                    fp.write(chunk)
+            else:
+                fp.write(self.payload)
 
 
 class MessageProperty(object):
@@ -320,81 +1488,34 @@ class MessageProperty(object):
                 result.append(MailAddress(address, name))
         return tuple(result)
 
-    @staticmethod
-    def _fetch_date(obj):
-        value = obj._msg.get('Date')
+    @classmethod
+    def _fetch_date(cls, obj):
+        value = obj._header_msg.get('Date')
         if not value:
-            value = obj._msg.get('Received', '')
-        short_month_names = ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun',
-                             'Jul', 'Aug', 'Sep', 'Oct', 'Nov', "Dec")
-        match = re.search((
-            r'(?P<date>\d{1,2}\s+(' + '|'.join(short_month_names) +
-            r')\s+\d{4})\s+' +
-            r'(?P<time>\d{1,2}:\d{1,2}(:\d{1,2})?)\s*' +
-            r'(?P<zone_sign>[+-])?(?P<zone>\d{4})?'
-        ), value)
-        if match:
-            group = match.groupdict()
-            day, month, year = group['date'].split()
-            time_values = group['time'].split(':')
-            zone_sign = int('{}1'.format(group.get('zone_sign') or '+'))
-            zone = group['zone']
-            return datetime.datetime(
-                year=int(year),
-                month=short_month_names.index(month) + 1,
-                day=int(day),
-                hour=int(time_values[0]),
-                minute=int(time_values[1]),
-                second=int(time_values[2]) if len(time_values) > 2 else 0,
-                tzinfo=datetime.timezone(datetime.timedelta(
-                    hours=int(zone[:2]) * zone_sign,
-                    minutes=int(zone[2:]) * zone_sign
-                )) if zone else None,
-            )
-        else:
-            return datetime.datetime.min
-
-    @staticmethod
-    def _fetch_content(obj):
-        for part in obj._msg.walk():
-            if part.is_multipart():
-                continue
-            content_type = part.get_content_type()
-            if content_type not in ('text/plain', 'text/html', 'text/'):
-                continue
-            text = part.get_payload(decode=True)
-            charset = part.get_content_charset()
-            return _decode_string(text, charset)
-        return ''
-
-    @staticmethod
-    def _fetch_attachments(obj):
-        results = []
-        for part in obj._msg.walk():
-            if part.is_multipart():
-                continue
-            if part.get('Content-Disposition') is None:
-                continue
-            filename = part.get_filename()
-            if not filename:
-                continue  # this is what happens when Content-Disposition = inline
-            results.append(MailAttachment(part))
-        return results
+            value = obj._header_msg.get('Received', '')
+        date = _parse_email_date(value)
+        if date:
+            return date
+        # 邮件头中的日期格式错误时使用邮件到达服务器的时间
+        return obj.internal_date or datetime.datetime.min
 
     def __get__(self, obj, type=None):
         if self.name in obj.__dict__:
             return obj.__dict__[self.name]
-        elif not obj._msg:
+        elif obj._header_msg is None:
             return self.default
         else:
+            header_msg = obj._header_msg
             if self.name == "sender":
                 name = 'From'
-                sender = self._parse_addr(obj._msg.get(name, self.default))[0]
+                sender = self._parse_addr(header_msg.get(name, self.default))[0]
                 obj.__dict__[self.name] = sender
                 return sender
             elif self.name == "subject":
                 name = self.name.title()
-                subject = _decode_email_header(obj._msg.get(name, self.default))
+                subject = _decode_email_header(
+                    header_msg.get(name, self.default)
+                )
                 obj.__dict__[self.name] = subject
                 return subject
             elif self.name == "date":
@@ -402,25 +1523,184 @@ class MessageProperty(object):
                 obj.__dict__[self.name] = date
                 return date
             elif self.name == "content":
-                content = self._fetch_content(obj)
+                content = obj.get_content()
                 obj.__dict__[self.name] = content
                 return content
             elif self.name == "attachments":
-                attachments = self._fetch_attachments(obj)
+                attachments = [
+                    obj._make_attachment(part, source)
+                    for part, source in obj._part_index if part.is_attachment
+                ]
                 obj.__dict__[self.name] = attachments
                 return attachments
             elif self.name in self._recipient_mapping:
                 name = self._recipient_mapping[self.name]
-                recipient = self._parse_addr(obj._msg.get(name, self.default))
+                recipient = self._parse_addr(header_msg.get(name, self.default))
                 obj.__dict__[self.name] = recipient
                 return recipient
             else:
-                return obj._msg.get(self.name.title(), self.default)
+                return header_msg.get(self.name.title(), self.default)
 
     def __set__(self, obj, value):
         obj.__dict__[self.name] = value
 
 
+def _format_email_address(addr, charset):
+    """格式化邮件地址，地址中的名称按指定字符集编码"""
+    realname, email_address = parse_email_addr(addr)
+    realname = EmailHeader(realname, charset).encode()
+    return format_email_addr((realname, email_address))
+
+
+def _parse_attachment_path(attachment):
+    """解析附件路径，返回 (文件路径, html 媒体的 cid, 主类型, 子类型)"""
+    html_media = re.search(R"^cid(\d+):(.+)$", attachment)
+    att_path = html_media.group(2) if html_media else attachment
+    ctype, encoding = mimetypes.guess_type(att_path)
+    if ctype is None or encoding is not None:
+        ctype = 'application/octet-stream'
+    maintype, subtype = ctype.split('/', 1)
+    cid = html_media.group(1) if html_media else None
+    return att_path, cid, maintype, subtype
+
+
+def _build_attachment_part(attachment, charset, placeholder=None):
+    """根据附件路径生成附件的 MIME 对象
+
+    路径形如 cid0:/path/to/image.png 时表示 html 中引用的媒体文件。placeholder 不
+    为空时不读取文件，以其作为 base64 编码后的内容，用于流式生成邮件
+    """
+    att_path, cid, maintype, subtype = _parse_attachment_path(attachment)
+    att_name = os.path.basename(att_path)
+
+    if cid is not None:  # 判断是否为 html 中包含的媒体
+        if maintype == "image":
+            mime_class = MIMEImage
+        elif maintype == "audio":
+            mime_class = MIMEAudio
+        else:
+            raise Exception(
+                "Undefined attachment type of html media: %s" % maintype
+            )
+
+        if placeholder is not None:
+            mime = MIMEBase(maintype, subtype)
+            mime['Content-Transfer-Encoding'] = 'base64'
+            mime.set_payload(placeholder)
+        else:
+            with open(att_path, 'rb') as fp:
+                mime = mime_class(fp.read(), _subtype=subtype)
+
+        mime.add_header('Content-Disposition', 'attachment', filename=att_name)
+        mime.add_header('Content-ID', '<{}>'.format(cid))
+        mime.add_header('X-Attachment-Id', cid)
+        return mime
+    else:  # 普通附件文件
+        if placeholder is not None:
+            if maintype == "text":
+                att = MIMEBase(maintype, subtype, charset=charset)
+            else:
+                att = MIMEBase(maintype, subtype)
+            att['Content-Transfer-Encoding'] = 'base64'
+            att.set_payload(placeholder)
+        else:
+            with open(att_path, 'rb') as fp:
+                content = fp.read()
+            if maintype == "text":
+                att = MIMEText(content, _subtype=subtype, _charset=charset)
+            elif maintype == "image":
+                att = MIMEImage(content, _subtype=subtype)
+            elif maintype == "audio":
+                att = MIMEAudio(content, _subtype=subtype)
+            else:
+                att = MIMEBase(maintype, subtype)
+                att.set_payload(content)
+                email.encoders.encode_base64(att)
+
+        att.add_header('Content-Type', 'application/octet-stream')
+        att.add_header('Content-Disposition', 'attachment', filename=att_name)
+        return att
+
+
+def _iter_base64_file(path, chunk_size=1024 * 1024):
+    """分块读取文件并进行 base64 编码
+
+    编码后每行 76 个字符，行之间以 CRLF 分隔，最后一行之后没有换行符
+    """
+    chunk_size = max(chunk_size // 57, 1) * 57
+    first_chunk = True
+    with open(path, 'rb') as fp:
+        while True:
+            data = fp.read(chunk_size)
+            if not data:
+                break
+            chunk = b'\r\n'.join(
+                binascii.b2a_base64(data[pos:pos + 57]).rstrip(b'\n')
+                for pos in range(0, len(data), 57)
+            )
+            yield chunk if first_chunk else b'\r\n' + chunk
+            first_chunk = False
+
+
+class AttachmentCache(object):
+    """附件 MIME 对象缓存
+
+    按 (路径, 修改时间, 文件大小, 字符集) 缓存已编码的附件 MIME 对象，同一个附件
+    发送给多个收件人时只需读取、编码一次，多封邮件共享同一个 MIME 对象。文件被修改
+    后自动重新编码，缓存的编码后数据总大小超过 max_size 时按最近最少使用的顺序淘汰
+    """
+
+    def __init__(self, max_size=64 * 1024 * 1024):
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._parts = OrderedDict()  # key -> (part, size)
+        self._total_size = 0
+
+    @staticmethod
+    def _key(attachment, charset):
+        stat = os.stat(_parse_attachment_path(attachment)[0])
+        return (attachment, stat.st_mtime, stat.st_size, charset)
+
+    def get(self, attachment, charset):
+        """获取附件的 MIME 对象，不在缓存中时生成并缓存"""
+        key = self._key(attachment, charset)
+        with self._lock:
+            if key in self._parts:
+                part, size = self._parts.pop(key)
+                self._parts[key] = (part, size)
+                return part
+
+        part = _build_attachment_part(attachment, charset)
+        size = len(part.get_payload())
+        if size > self.max_size:
+            return part
+        with self._lock:
+            if key not in self._parts:
+                self._parts[key] = (part, size)
+                self._total_size += size
+            while self._total_size > self.max_size:
+                _, (_, evicted_size) = self._parts.popitem(last=False)
+                self._total_size -= evicted_size
+        return part
+
+    def find(self, attachment, charset):
+        """获取可以缓存的附件的 MIME 对象
+
+        附件编码后的大小超过 max_size 且未被缓存时返回 None，由调用者流式编码
+        """
+        key = self._key(attachment, charset)
+        with self._lock:
+            cached = key in self._parts
+        if not cached and key[2] * 4 // 3 > self.max_size:
+            return None
+        return self.get(attachment, charset)
+
+    def clear(self):
+        with self._lock:
+            self._parts.clear()
+            self._total_size = 0
+
+
 class Message(object):
     """邮件消息
 
@@ -446,6 +1726,10 @@ class Message(object):
     # 附件
     attachments = MessageProperty("attachments")
 
+    # 附件 MIME 对象缓存，默认为 None 即不缓存。可以为 Message 类或者单个消息设置
+    # AttachmentCache 对象，多封邮件包含相同的附件时只需编码一次
+    attachment_cache = None
+
     def __init__(self, **kwargs):
         self.is_html = kwargs.pop("is_html", False)    # 是否为 html 内容邮件
         self.headers = kwargs.pop("headers", None)     # 邮件头
@@ -458,13 +1742,39 @@ class Message(object):
         # 为接受到的消息时会设置的属性
         self.uid = kwargs.pop("uid", None)      # 邮件唯一标识符
         self.flags = kwargs.pop("flags", None)  # 邮件标记
+        self.size = kwargs.pop("size", None)    # 邮件大小（字节数）
+        # 邮件到达服务器的时间（INTERNALDATE）
+        self.internal_date = kwargs.pop("internal_date", None)
 
         for name, value in kwargs.items():
             setattr(self, name, value)
 
         # 底层消息对象，为 email.message.Message 或其子类的对象
         # 用于在解析接收到的邮件消息时记录原始的二进制消息数据
-        self._msg = None
+        # 通过 from_bytes 接收到的邮件在首次访问 _msg 时才完整解析
+        self._parsed_msg = None
+        # 仅包含邮件头的消息对象，用于在不完整解析邮件的情况下读取邮件头
+        self._parsed_headers = None
+
+        # 仅下载了邮件头时，记录所属的 MailBox 对象，以便在访问邮件内容时再下载
+        self._mailbox = None
+        self._mark_seen = False
+        self._headers_only = False
+
+        # 邮件的 BODYSTRUCTURE 信息，用于在不下载邮件内容时获取附件信息
+        self._bodystructure = None
+
+        # 接收到的邮件的原始数据
+        self._raw = None
+        # 原始数据中 MIME 部分的偏移索引，在首次访问邮件内容或附件时建立
+        self._raw_part_index = None
+        # 各 MIME 叶子部分的信息及来源，只遍历一次邮件，内容及附件共用
+        self._part_index_cache = None
+
+        # 由 MessageTemplate 生成的邮件的完整文本，发送时直接使用
+        self._rendered = None
+        # 生成邮件的模板，发送时补充了默认发件人后需要重新生成
+        self._template = None
 
     def __repr__(self):
         return "{}(subject={!r}, sender={!r}, date='{}', content={!r})".format(
@@ -472,7 +1782,8 @@ class Message(object):
             _shorten_text(self.subject, 30),
             self.sender,
             self.date,
-            _shorten_text(self.content, 50),
+            # 仅下载了邮件头时不为展示内容而下载完整邮件
+            None if self._headers_only else _shorten_text(self.content, 50),
         )
 
     @property
@@ -490,16 +1801,11 @@ class Message(object):
                 addrs.extend(list(recp))
         return addrs
 
-    def __format_email_addr(self, addr):
-        realname, email_address = parse_email_addr(addr)
-        realname = EmailHeader(realname, self.charset).encode()
-        return format_email_addr((realname, email_address))
-
-    def __set_headers(self, msg=None):
-        msg = msg or MIMEMultipart()
-        msg['Date'] = format_email_date(localtime=True)
-        msg['Subject'] = EmailHeader(self.subject, self.charset).encode()
-        msg['From'] = self.__format_email_addr(self.sender)
+    def _iter_headers(self):
+        """生成要发送的邮件的邮件头，为 (名称, 编码后的值) 元组"""
+        yield 'Date', format_email_date(localtime=True)
+        yield 'Subject', EmailHeader(self.subject, self.charset).encode()
+        yield 'From', _format_email_address(self.sender, self.charset)
 
         recipient_mapping = {
             "To": self.recipient,
@@ -511,63 +1817,28 @@ class Message(object):
             if not recp:
                 continue
             if isinstance(recp, string_types):
-                msg[hname] = self.__format_email_addr(recp)
+                yield hname, _format_email_address(recp, self.charset)
             else:
-                msg[hname] = "; ".join([
-                    self.__format_email_addr(addr) for addr in recp
+                yield hname, "; ".join([
+                    _format_email_address(addr, self.charset) for addr in recp
                 ])
 
         if self.headers:
             for key, value in self.headers.items():
-                msg[key] = EmailHeader(value, self.charset).encode()
+                yield key, EmailHeader(value, self.charset).encode()
 
+    def __set_headers(self, msg=None):
+        msg = msg or MIMEMultipart()
+        for name, value in self._iter_headers():
+            msg[name] = value
         return msg
 
     def __attach_attachment(self, msg, attachment):
-        html_media = re.search(R"^cid(\d+):(.+)$", attachment)
-
-        att_path = html_media.group(2) if html_media else attachment
-        att_name = os.path.basename(att_path)
-        ctype, encoding = mimetypes.guess_type(att_path)
-        if ctype is None or encoding is not None:
-            ctype = 'application/octet-stream'
-        maintype, subtype = ctype.split('/', 1)
-
-        if html_media:  # 判断是否为 html 中包含的媒体
-            if maintype == "image":
-                mime_class = MIMEImage
-            elif maintype == "audio":
-                mime_class = MIMEAudio
-            else:
-                raise Exception(
-                    "Undefined attachment type of html media: %s" % maintype
-                )
-
-            with open(att_path, 'rb') as fp:
-                mime = mime_class(fp.read(), _subtype=subtype)
-
-            cid = html_media.group(1)
-            mime.add_header('Content-Disposition', 'attachment', filename=att_name)
-            mime.add_header('Content-ID', '<{}>'.format(cid))
-            mime.add_header('X-Attachment-Id', cid)
-            msg.attach(mime)
-        else:  # 普通附件文件
-            with open(attachment, 'rb') as fp:
-                content = fp.read()
-            if maintype == "text":
-                att = MIMEText(content, _subtype=subtype, _charset=self.charset)
-            elif maintype == "image":
-                att = MIMEImage(content, _subtype=subtype)
-            elif maintype == "audio":
-                att = MIMEAudio(content, _subtype=subtype)
-            else:
-                att = MIMEBase(maintype, subtype)
-                att.set_payload(content)
-                email.encoders.encode_base64(att)
-
-            att.add_header('Content-Type', 'application/octet-stream')
-            att.add_header('Content-Disposition', 'attachment', filename=att_name)
-            msg.attach(att)
+        if self.attachment_cache is not None:
+            part = self.attachment_cache.get(attachment, self.charset)
+        else:
+            part = _build_attachment_part(attachment, self.charset)
+        msg.attach(part)
 
     def __set_attachments(self, msg=None):
         msg = msg or MIMEMultipart()
@@ -575,7 +1846,39 @@ class Message(object):
             self.__attach_attachment(msg, attachment)
         return msg
 
+    def bind_mailbox(self, mailbox, mark_seen=False):
+        """将仅包含邮件头的消息与 MailBox 关联，在访问邮件内容时再下载完整邮件"""
+        self._mailbox = mailbox
+        self._mark_seen = mark_seen
+        self._headers_only = True
+        return self
+
+    def load_body(self):
+        """为仅下载了邮件头的消息下载完整的邮件数据"""
+        if not self._headers_only:
+            return self
+        data = self._mailbox._fetch_message_body(self.uid, self._mark_seen)
+        if isinstance(data, str):
+            self.from_string(data)
+        else:
+            self.from_bytes(data)
+        self._headers_only = False
+        return self
+
+    def as_bytes(self):
+        """获取邮件的字节串，接收到的邮件直接返回下载到的原始数据"""
+        self.load_body()
+        if self._raw is not None:
+            return self._raw
+        data = self.as_string()
+        if data is None or isinstance(data, binary_types):
+            return data
+        return data.encode("utf-8")
+
     def as_string(self):
+        self.load_body()
+        if self._rendered is not None:   # 为通过模板生成的邮件消息
+            return self._rendered
         if self._msg:                    # 为接收到的邮件消息
             return self._msg.as_string()
         elif not self.is_received:       # 为要发送的邮件消息
@@ -591,12 +1894,199 @@ class Message(object):
         else:
             return None
 
+    # 流式生成邮件时附件内容在邮件骨架中的占位符
+    _attachment_placeholder = "@@KMAILBOX-ATTACHMENT-{}@@"
+
+    def iter_bytes(self, chunk_size=1024 * 1024):
+        """流式生成邮件的字节串，行尾为 CRLF
+
+        要发送的邮件中超过附件缓存大小的附件在生成时才从磁盘分块读取并编码，内存
+        占用与其大小无关，其余附件使用 attachment_cache 中已编码的数据；
+        接收到的邮件、已生成过的邮件及通过模板生成的邮件直接返回完整的数据
+        """
+        if self.is_received or self._msg or self._rendered is not None:
+            data = self.as_bytes()
+            if data is not None:
+                yield re.sub(br'\r?\n', b'\r\n', data)
+            return
+
+        msg = self.__set_headers()
+        msg.attach(MIMEText(
+            self.content,
+            _subtype=("html" if self.is_html else "plain"),
+            _charset=self.charset
+        ))
+        # 可以缓存的附件使用缓存中已编码的 MIME 对象，其余的附件在生成时才编码
+        streamed = []
+        for index, attachment in enumerate(self.attachments or []):
+            part = None
+            if self.attachment_cache is not None:
+                part = self.attachment_cache.find(attachment, self.charset)
+            if part is None:
+                streamed.append((index, attachment))
+                part = _build_attachment_part(
+                    attachment, self.charset,
+                    placeholder=self._attachment_placeholder.format(index)
+                )
+            msg.attach(part)
+        text = msg.as_string()
+        for index, attachment in streamed:
+            head, text = text.split(
+                self._attachment_placeholder.format(index), 1
+            )
+            yield re.sub(r'\r?\n', '\r\n', head).encode("utf-8")
+            att_path = _parse_attachment_path(attachment)[0]
+            for chunk in _iter_base64_file(att_path, chunk_size):
+                yield chunk
+        yield re.sub(r'\r?\n', '\r\n', text).encode("utf-8")
+
+    @property
+    def _msg(self):
+        if self._parsed_msg is None and self._raw is not None:
+            self._parsed_msg = email.message_from_bytes(self._raw)
+        return self._parsed_msg
+
+    @_msg.setter
+    def _msg(self, value):
+        self._parsed_msg = value
+        self._parsed_headers = None
+        self._part_index_cache = None
+
+    @property
+    def _raw_parts(self):
+        """接收到的邮件未完整解析时，由原始数据建立的 MIME 叶子部分索引"""
+        if self._raw_part_index is None and self._raw is not None:
+            self._raw_part_index = _index_mime_parts(memoryview(self._raw))
+        return self._raw_part_index
+
+    @property
+    def _part_index(self):
+        """邮件各 MIME 叶子部分的 (MessagePart, 来源) 列表
+
+        来源为原始数据中的片段 _MimePartSlice、email.message.Message 对象，由
+        BODYSTRUCTURE 构建时为 None
+        """
+        if not (self._headers_only and self._bodystructure):
+            self.load_body()
+        if self._part_index_cache is not None:
+            return self._part_index_cache
+        if self._headers_only:
+            index = [
+                (MessagePart.from_bodystructure(section, structure), None)
+                for section, structure in _walk_bodystructure(
+                    self._bodystructure
+                )
+            ]
+        elif self._parsed_msg is None and self._raw is not None:
+            index = [
+                (MessagePart.from_email_part(part.section, part.headers,
+                                             part.end - part.start), part)
+                for part in self._raw_parts
+            ]
+        elif self._msg is not None:
+            index = [
+                (MessagePart.from_email_part(
+                    section, part, len(part.get_payload() or '')
+                ), part)
+                for section, part in _walk_email_parts(self._msg)
+            ]
+        else:
+            index = []
+        self._part_index_cache = index
+        return index
+
+    @property
+    def parts(self):
+        """接收到的邮件中各非 multipart 的 MIME 部分的信息（MessagePart 列表）"""
+        return [part for part, _ in self._part_index]
+
+    def _part_payload(self, part, source):
+        """获取 MIME 部分解码后的内容"""
+        if isinstance(source, _MimePartSlice):
+            return b''.join(_iter_mime_payload(
+                memoryview(self._raw)[source.start:source.end], part.encoding
+            ))
+        return source.get_payload(decode=True)
+
+    def _make_attachment(self, part, source):
+        if source is None:
+            attachment = MailAttachment.from_bodystructure(
+                self._mailbox, self.uid, part.section, part.filename,
+                part.content_type, part.encoding, part.size
+            )
+        elif isinstance(source, _MimePartSlice):
+            attachment = MailAttachment.from_raw_part(self._raw, source)
+        else:
+            attachment = MailAttachment(source)
+        attachment._filename = part.filename
+        attachment._content_type = part.content_type
+        attachment._part_info = part
+        return attachment
+
+    def get_content(self, prefer=None):
+        """获取接收到的邮件的文本内容
+
+        prefer 为 'plain' 或 'html' 时优先返回对应类型的内容，没有时返回另一种类型的
+        内容，为 None 时返回第一个文本部分的内容，与 content 属性相同
+        """
+        self.load_body()
+        texts = [(part, source) for part, source in self._part_index
+                 if part.content_type in ('text/plain', 'text/html')]
+        if prefer:
+            preferred = "text/{}".format(prefer.lower())
+            texts.sort(key=lambda item: item[0].content_type != preferred)
+        if not texts:
+            return ''
+        part, source = texts[0]
+        return _decode_string(self._part_payload(part, source), part.charset)
+
+    def get_attachments(self, content_type=None, min_size=None,
+                        max_size=None):
+        """按类型或大小过滤接收到的邮件的附件
+
+        content_type 为附件类型或者其列表，支持通配符，如 'image/*'；min_size、
+        max_size 按附件编码后的大小（同 BODYSTRUCTURE）过滤，无需解码附件内容
+        """
+        if isinstance(content_type, string_types):
+            content_type = [content_type]
+        results = []
+        for attachment in self.attachments or []:
+            info = attachment._part_info
+            ctype = info.content_type if info else attachment.content_type
+            if content_type and not any(
+                fnmatch.fnmatchcase(ctype, pattern.lower())
+                for pattern in content_type
+            ):
+                continue
+            size = info.size if info and info.size is not None \
+                else attachment.size
+            if min_size is not None and size < min_size:
+                continue
+            if max_size is not None and size > max_size:
+                continue
+            results.append(attachment)
+        return results
+
+    @property
+    def _header_msg(self):
+        """邮件头，接收到的邮件未完整解析时只解析邮件头部分"""
+        if self._parsed_msg is not None:
+            return self._parsed_msg
+        if self._parsed_headers is None and self._raw is not None:
+            self._parsed_headers = _parse_email_headers(self._raw)
+        return self._parsed_headers
+
     def from_string(self, data):
         self._msg = email.message_from_string(data)
+        self._raw = None
+        self._raw_part_index = None
         return self
 
     def from_bytes(self, data):
-        self._msg = email.message_from_bytes(data)
+        """从二进制数据中获取消息，邮件头、内容及附件均按需从原始数据中解析"""
+        self._msg = None
+        self._raw = data
+        self._raw_part_index = None
         return self
 
     def uid_from_string(self, data):
@@ -630,7 +2120,53 @@ class Message(object):
         self.flags = flags
         return flags
 
+    def size_from_string(self, data):
+        if isinstance(data, binary_types):
+            data = data.decode("utf-8")
+        size_match = re.search(r'RFC822\.SIZE\s+(?P<size>\d+)', data)
+        if size_match:
+            self.size = int(size_match.group('size'))
+        return self.size
+
+    def internal_date_from_string(self, data):
+        if isinstance(data, binary_types):
+            data = data.decode("utf-8")
+        date_match = re.search(r'INTERNALDATE\s+"(?P<date>[^"]+)"', data)
+        if date_match:
+            self.internal_date = _parse_internal_date(date_match.group('date'))
+        return self.internal_date
+
     def from_raw_message_data(self, data):
+        try:
+            items = _parse_fetch_response(data)
+        except ValueError:
+            return self._from_unparsed_raw_message_data(data)
+
+        # 消息体部分为 BODY[...]、RFC822、RFC822.HEADER 等数据项的字面量
+        raw_message_data = b''
+        for name, value in items.items():
+            if name == 'RFC822.SIZE' or not name.startswith(('BODY[', 'RFC822')):
+                continue
+            if isinstance(value, (binary_types, string_types)):
+                raw_message_data = value
+                break
+        if isinstance(raw_message_data, str):
+            self.from_string(raw_message_data)
+        else:
+            self.from_bytes(raw_message_data)
+
+        if items.get('UID') is not None:
+            self.uid = items['UID']
+        self.flags = _normalize_flags(items.get('FLAGS'))
+        if items.get('RFC822.SIZE') is not None:
+            self.size = int(items['RFC822.SIZE'])
+        if items.get('INTERNALDATE'):
+            self.internal_date = _parse_internal_date(items['INTERNALDATE'])
+        if items.get('BODYSTRUCTURE'):
+            self._bodystructure = items['BODYSTRUCTURE']
+        return self
+
+    def _from_unparsed_raw_message_data(self, data):
         # 提取邮件的标识标记、消息体部分
         raw_message_data = b''
         raw_uid_or_flag_data = []
@@ -658,13 +2194,94 @@ class Message(object):
         try:
             self.uid_from_string(raw_uid_or_flag_data)
             self.flag_from_string([raw_uid_or_flag_data])
-        except Exception:
-            print("-" * 120)
-            print(data)
-            print("-" * 120)
+            self.size_from_string(raw_uid_or_flag_data)
+            self.internal_date_from_string(raw_uid_or_flag_data)
+        except Exception as ex:
+            logging.getLogger("kmailbox").debug(
+                "Parse message data error: %s, data: %r", ex, data
+            )
         return self
 
 
+class MessageTemplate(object):
+    """邮件模板，用于群发个性化的邮件
+
+    邮件的结构及附件等固定部分只生成一次，为每个收件人生成邮件时仅替换邮件头及正文
+    中的变量，然后与预先生成的邮件骨架拼接。变量使用 string.Template 的语法，如
+    $name、${name}，$$ 表示 $ 字符本身
+    """
+
+    # 正文在邮件骨架中的占位符
+    _body_placeholder = "@@KMAILBOX-TEMPLATE-BODY@@"
+
+    def __init__(self, subject, content, sender=None, is_html=False,
+                 attachments=None, headers=None, charset="utf-8",
+                 attachment_cache=None):
+        self.subject = string.Template(subject)
+        self.content = string.Template(content)
+        self.sender = sender
+        self.is_html = is_html
+        self.attachments = attachments
+        self.headers = headers
+        self.charset = charset
+        # 附件 MIME 对象缓存，为 None 时使用 Message.attachment_cache
+        self.attachment_cache = attachment_cache
+        self._skeleton = None
+
+    @property
+    def skeleton(self):
+        """邮件骨架，为正文之前与之后的两部分文本"""
+        if self._skeleton is None:
+            skeleton = MIMEMultipart()
+            body = MIMEBase("text", "html" if self.is_html else "plain",
+                            charset=self.charset)
+            body["Content-Transfer-Encoding"] = "base64"
+            body.set_payload(self._body_placeholder)
+            skeleton.attach(body)
+            cache = self.attachment_cache
+            if cache is None:
+                cache = Message.attachment_cache
+            for attachment in (self.attachments or []):
+                if cache is not None:
+                    skeleton.attach(cache.get(attachment, self.charset))
+                else:
+                    skeleton.attach(_build_attachment_part(attachment,
+                                                           self.charset))
+            head, tail = skeleton.as_string().split(self._body_placeholder)
+            self._skeleton = (head, tail)
+        return self._skeleton
+
+    def render(self, recipient, cc_recipient=None, **fields):
+        """为收件人生成邮件，fields 为模板中的变量值，返回 Message 对象"""
+        message = Message(is_html=self.is_html, charset=self.charset)
+        message.sender = self.sender
+        message.recipient = recipient
+        message.cc_recipient = cc_recipient
+        message.subject = self.subject.substitute(fields)
+        message.content = self.content.substitute(fields)
+        message.attachments = self.attachments
+        if self.headers:
+            message.headers = dict(
+                (key, string.Template(value).substitute(fields))
+                for key, value in self.headers.items()
+            )
+        return self.render_message(message)
+
+    def render_message(self, message):
+        """将已设置好邮件头及正文的 Message 对象与邮件骨架拼接"""
+        head, tail = self.skeleton
+        header_text = "".join(
+            "{}: {}\n".format(name, value)
+            for name, value in message._iter_headers()
+        )
+        body = email.base64mime.body_encode(
+            message.content.encode(self.charset)
+        ).rstrip("\n")
+        message._rendered = header_text + head + body + tail
+        message._template = self
+        return message
+
+
 class MailBox(object):
     """邮件收发器"""
 
@@ -672,7 +2289,9 @@ class MailBox(object):
                  username=None, password=None,
                  imap_host=None, smtp_host=None,
                  use_tls=False, use_ssl=False,
-                 timeout=60, logger=None, debug=False):
+                 timeout=60, logger=None, debug=False,
+                 fetch_batch_size=100, use_uid=True, cache=None,
+                 max_line_length=8000, attachment_cache=None):
         self.username = username or os.getenv("KMAILBOX_USERNAME")
         self.password = password or os.getenv("KMAILBOX_PASSWORD")
 
@@ -687,6 +2306,18 @@ class MailBox(object):
         self._smtp_server = None
         self._imap_server = None
 
+        # 当前选择的邮箱目录的状态
+        self.folder_status = None
+
+        # 通过 ENABLE 命令启用的扩展
+        self._enabled_capabilities = set()
+
+        # 用于并行下载邮件的 IMAP 连接池，以及工作线程当前使用的连接
+        self._lock = threading.RLock()
+        self._local = threading.local()
+        self._imap_pool = []
+        self._selected_readonly = False
+
         if not logger:
             logger = logging.getLogger("kmailbox")
             logger.addHandler(logging.NullHandler())
@@ -695,6 +2326,27 @@ class MailBox(object):
 
         self.debug = debug
 
+        # 批量下载邮件时每条 FETCH 命令所包含的邮件数量
+        self.fetch_batch_size = fetch_batch_size
+
+        # 是否使用 UID 搜索与下载邮件，否则使用邮件序号
+        # 序号会随着邮件的删除而变化，UID 在邮箱目录的 UIDVALIDITY 不变时保持稳定
+        self.use_uid = use_uid
+
+        # 邮件本地缓存，可以为 MessageCache 对象或者缓存目录
+        if cache and not isinstance(cache, MessageCache):
+            cache = MessageCache(cache)
+        self.cache = cache
+
+        # IMAP 命令行的最大长度，超出时 UID 集合会被拆分为多条命令执行
+        # RFC 7162 建议客户端发送的命令行不超过 8192 字节
+        self.max_line_length = max_line_length
+
+        # 发送邮件时使用的附件 MIME 对象缓存，为 True 时使用默认大小的缓存
+        if attachment_cache is True:
+            attachment_cache = AttachmentCache()
+        self.attachment_cache = attachment_cache
+
     @property
     def imap_host(self):
         host = self._imap_host or _get_default_imap_host(self.username)
@@ -721,40 +2373,88 @@ class MailBox(object):
             port = smtplib.SMTP_SSL_PORT if self.use_ssl else smtplib.SMTP_PORT
         return host, port
 
+    def _create_imap_server(self):
+        """创建 IMAP 连接并登录"""
+        if self.use_ssl:
+            server = imaplib.IMAP4_SSL(*self.imap_host)
+        else:
+            server = imaplib.IMAP4(*self.imap_host)
+        if self.debug:
+            server.debug = 1
+        self._log.debug("Using '%s' login to %s",
+                        self.username, self.imap_host)
+        res = server.login(self.username, self.password)
+        self._check_command_response(res, command="login")
+        # 登录后服务器支持的扩展可能会发生变化
+        data = self._check_command_response(server.capability())
+        server.capabilities = tuple(
+            _decode_string(data[-1], "utf-8").upper().split()
+        )
+        return server
+
     @property
     def imap_server(self):
+        # 并行下载邮件时，工作线程使用各自从连接池中获取的连接
+        local_server = getattr(self._local, "imap_server", None)
+        if local_server:
+            return local_server
         if not self._imap_server and self.imap_host:
-            if self.use_ssl:
-                server = imaplib.IMAP4_SSL(*self.imap_host)
-            else:
-                server = imaplib.IMAP4(*self.imap_host)
-            if self.debug:
-                server.debug = 1
-            self._log.debug("Using '%s' login to %s",
-                            self.username, self.imap_host)
-            res = server.login(self.username, self.password)
-            self._check_command_response(res, command="login")
-            self._imap_server = server
+            self._imap_server = self._create_imap_server()
+            self._enabled_capabilities = set()
             self.declare_identity()
         return self._imap_server
 
+    def _acquire_imap_session(self):
+        """从连接池中获取一个 IMAP 连接供当前线程使用，并选择与主连接相同的目录"""
+        with self._lock:
+            server = self._imap_pool.pop() if self._imap_pool else None
+        is_new = server is None
+        if is_new:
+            server = self._create_imap_server()
+            server.kmailbox_folder = None
+        self._local.imap_server = server
+        try:
+            if is_new:
+                self.declare_identity()
+            status = self.folder_status
+            folder = (status.name, self._selected_readonly) if status else None
+            if folder and server.kmailbox_folder != folder:
+                self._log.debug("Selecting mail folder '%s' for pooled session",
+                                folder[0])
+                self._imap_command("select", self._encode_folder(folder[0]),
+                                   folder[1])
+                server.kmailbox_folder = folder
+        except Exception:
+            self._local.imap_server = None
+            raise
+        return server
+
+    def _release_imap_session(self, server):
+        self._local.imap_server = None
+        with self._lock:
+            self._imap_pool.append(server)
+
+    def _create_smtp_server(self):
+        """创建 SMTP 连接并登录"""
+        if self.use_ssl:
+            server = smtplib.SMTP_SSL(*self.smtp_host, timeout=self.timeout)
+        else:
+            server = smtplib.SMTP(*self.smtp_host, timeout=self.timeout)
+        if self.debug:
+            server.set_debuglevel(1)
+        self._log.debug("Using '%s' login to %s",
+                        self.username, self.smtp_host)
+        server.connect(*self.smtp_host)
+        server.ehlo()
+        if not self.use_ssl and self.use_tls:
+            server.starttls()
+        server.login(self.username, self.password)
+        return server
+
     @property
     def smtp_server(self):
         if not self._smtp_server and self.smtp_host:
-            if self.use_ssl:
-                server = smtplib.SMTP_SSL(*self.smtp_host, timeout=self.timeout)
-            else:
-                server = smtplib.SMTP(*self.smtp_host, timeout=self.timeout)
-            if self.debug:
-                server.set_debuglevel(1)
-            self._log.debug("Using '%s' login to %s",
-                            self.username, self.smtp_host)
-            server.connect(*self.smtp_host)
-            server.ehlo()
-            if not self.use_ssl and self.use_tls:
-                server.starttls()
-            server.login(self.username, self.password)
-            self._smtp_server = server
+            self._smtp_server = self._create_smtp_server()
         return self._smtp_server
 
     def _check_command_response(self, response, expected='OK', command=None):
@@ -776,7 +2476,20 @@ class MailBox(object):
         self._smtp_server.quit()
         self._smtp_server = None
 
+    def _logout_imap_session(self, server):
+        try:
+            server.logout()
+        except Exception as ex:
+            self._log.warning("Logout pooled IMAP session error: %s", ex)
+
+    def _close_imap_pool(self):
+        with self._lock:
+            pool, self._imap_pool = self._imap_pool, []
+        for server in pool:
+            self._logout_imap_session(server)
+
     def _close_imap_server(self):
+        self._close_imap_pool()
         if not self._imap_server:
             return
         self._imap_server.close()
@@ -788,17 +2501,215 @@ class MailBox(object):
         self._close_smtp_server()
         self._close_imap_server()
 
-    def send(self, message, after_reset_connect=False):
+    def _sendmail(self, server, message):
+        """通过指定的 SMTP 连接发送邮件，返回被拒绝的收件人
+
+        带附件的待发送邮件以流式方式生成并发送，避免将整封邮件保存在内存中
+        """
+        if self.attachment_cache is not None and \
+                message.attachment_cache is None:
+            message.attachment_cache = self.attachment_cache
         if not message.sender:
             message.sender = self.username
+            if message._template is not None:
+                # 模板生成邮件时还没有发件人，使用默认发件人重新生成邮件头
+                message._template.render_message(message)
+        if message.is_received or message._rendered is not None or \
+                not message.attachments:
+            return server.sendmail(message.sender, message.to_addrs,
+                                   message.as_string())
+        return self._send_streaming(server, message)
+
+    @staticmethod
+    def _send_streaming(server, message, chunk_size=1024 * 1024):
+        """流式发送邮件
+
+        服务器支持 CHUNKING 扩展（RFC 3030）时通过 BDAT 命令分块发送，否则在 DATA
+        命令中边生成边发送，返回被拒绝的收件人
+        """
+        server.ehlo_or_helo_if_needed()
+        code, resp = server.mail(message.sender)
+        if code != 250:
+            server.rset()
+            raise smtplib.SMTPSenderRefused(code, resp, message.sender)
+        refused = {}
+        for addr in message.to_addrs:
+            code, resp = server.rcpt(addr)
+            if code not in (250, 251):
+                refused[addr] = (code, resp)
+        if len(refused) == len(message.to_addrs):
+            server.rset()
+            raise smtplib.SMTPRecipientsRefused(refused)
+
+        try:
+            MailBox._send_chunks(server, message.iter_bytes(chunk_size))
+        except smtplib.SMTPResponseException:
+            raise
+        except Exception:
+            # 读取附件或者发送数据中途失败时，会话停留在 DATA/BDAT 阶段无法继续
+            # 使用，直接关闭连接
+            server.close()
+            raise
+        code, resp = server.getreply()
+        if code != 250:
+            server.rset()
+            raise smtplib.SMTPDataError(code, resp)
+        return refused
+
+    @staticmethod
+    def _send_chunks(server, chunks):
+        """通过 BDAT 或者 DATA 命令发送邮件数据，不读取最终的响应"""
+        if server.has_extn("chunking"):
+            for chunk in chunks:
+                if not chunk:
+                    continue
+                server.send("BDAT {}\r\n".format(len(chunk)).encode("ascii"))
+                server.send(chunk)
+                code, resp = server.getreply()
+                if code != 250:
+                    server.rset()
+                    raise smtplib.SMTPDataError(code, resp)
+            server.send(b"BDAT 0 LAST\r\n")
+        else:
+            code, resp = server.docmd("DATA")
+            if code != 354:
+                server.rset()
+                raise smtplib.SMTPDataError(code, resp)
+            line_start = True
+            for chunk in chunks:
+                if not chunk:
+                    continue
+                # 以 . 开头的行需要转义
+                quoted = re.sub(br'(?m)^\.', b'..', chunk)
+                if chunk.startswith(b'.') and not line_start:
+                    quoted = quoted[1:]
+                server.send(quoted)
+                line_start = chunk.endswith(b'\n')
+            server.send(b".\r\n" if line_start else b"\r\n.\r\n")
+
+    def send(self, message, after_reset_connect=False):
         self._log.info("Sending email to %s", message.to_addrs)
-        self.smtp_server.sendmail(message.sender,
-                                  message.to_addrs,
-                                  message.as_string())
+        try:
+            self._sendmail(self.smtp_server, message)
+        except Exception:
+            # 流式发送中途失败时连接已被关闭，下次发送时重新连接
+            if self._smtp_server is not None and \
+                    self._smtp_server.sock is None:
+                self._smtp_server = None
+            raise
         self._log.info("Send mail is successful")
         if after_reset_connect:
             self._close_smtp_server()
 
+    @staticmethod
+    def _is_transient_smtp_error(ex):
+        """判断 SMTP 错误是否为临时性错误（4xx 响应或者连接断开），可以重试"""
+        if isinstance(ex, smtplib.SMTPRecipientsRefused):
+            return all(400 <= code < 500
+                       for code, _ in ex.recipients.values())
+        if isinstance(ex, smtplib.SMTPResponseException):
+            return 400 <= ex.smtp_code < 500
+        if isinstance(ex, smtplib.SMTPServerDisconnected):
+            return True
+        # 仅网络错误可以重试，读取附件失败等其他 OSError 不重试
+        return isinstance(ex, _network_errors)
+
+    @staticmethod
+    def _quit_smtp_session(session):
+        server, session["server"], session["sent"] = session["server"], None, 0
+        if server is None:
+            return
+        try:
+            server.quit()
+        except Exception:
+            server.close()
+
+    def _send_in_session(self, session, message, retries, retry_delay,
+                         max_per_session, throttle):
+        """在工作线程的 SMTP 会话中发送邮件，遇到临时性错误时重连并重试"""
+        attempts, error = 0, None
+        while attempts <= retries:
+            attempts += 1
+            try:
+                if max_per_session and session["sent"] >= max_per_session:
+                    self._quit_smtp_session(session)
+                if session["server"] is not None and \
+                        session["server"].sock is None:
+                    session["server"] = None  # 连接已在发送失败时关闭
+                if session["server"] is None:
+                    session["server"] = self._create_smtp_server()
+                if throttle:
+                    throttle()
+                refused = self._sendmail(session["server"], message)
+                session["sent"] += 1
+                return MailSendResult(message, True, None, refused, attempts)
+            except Exception as ex:
+                error = ex
+                if not self._is_transient_smtp_error(ex):
+                    break
+                self._quit_smtp_session(session)
+                if attempts > retries:
+                    break
+                self._log.warning("Send mail to %s error: %s, retrying",
+                                  message.to_addrs, ex)
+                time.sleep(retry_delay * attempts)
+        self._log.error("Send mail to %s error: %s", message.to_addrs, error)
+        return MailSendResult(message, False, error, {}, attempts)
+
+    def send_many(self, messages, connections=1, max_per_session=None,
+                  rate_limit=None, retries=3, retry_delay=1):
+        """批量发送邮件
+
+        使用 connections 个 SMTP 连接并行发送，每个连接发送 max_per_session 封邮件
+        后重新建立连接；遇到 4xx 响应或者连接断开时自动重连并重试，最多重试 retries
+        次。rate_limit 为每秒最多发送的邮件数量。返回与 messages 顺序一致的
+        MailSendResult 列表
+        """
+        messages = list(messages)
+        results = [None] * len(messages)
+        tasks = queue.Queue()
+        for index, message in enumerate(messages):
+            tasks.put((index, message))
+
+        throttle = None
+        if rate_limit:
+            throttle_lock = threading.Lock()
+            next_time = [time.time()]
+
+            def throttle():
+                with throttle_lock:
+                    now = time.time()
+                    send_time = max(next_time[0], now)
+                    next_time[0] = send_time + 1.0 / rate_limit
+                if send_time > now:
+                    time.sleep(send_time - now)
+
+        def worker():
+            session = {"server": None, "sent": 0}
+            try:
+                while True:
+                    try:
+                        index, message = tasks.get_nowait()
+                    except queue.Empty:
+                        return
+                    results[index] = self._send_in_session(
+                        session, message, retries, retry_delay,
+                        max_per_session, throttle
+                    )
+            finally:
+                self._quit_smtp_session(session)
+
+        self._log.info("Sending %d emails with %d connections",
+                       len(messages), connections)
+        threads = [threading.Thread(target=worker)
+                   for _ in range(max(min(connections, len(messages)), 1))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
     def _imap_command(self, command, *args, **kwargs):
         """封装 IMAP4 对象的命令方法"""
         cmd_func = getattr(self.imap_server, command, None)
@@ -806,10 +2717,52 @@ class MailBox(object):
             cmd_func = functools.partial(
                 self.imap_server._simple_command, command.upper()
             )
+        args = self._prepare_literals(args)
         res = cmd_func(*args, **kwargs)
         data = self._check_command_response(res, command=command)
         return data
 
+    def _prepare_literals(self, args):
+        """处理命令参数中的字面量（如 MailQuery 编译得到的非 ASCII 检索条件）
+
+        imaplib 只支持在命令的末尾附加一个字面量，因此将第一个字面量之后的参数合并，
+        通过 imaplib 的 literal 回调在每次收到继续响应时发送下一个片段
+        """
+        for index, arg in enumerate(args):
+            if isinstance(arg, binary_types) and \
+                    _literal_marker_pattern.search(arg):
+                break
+        else:
+            return args
+        rest = b' '.join(
+            arg if isinstance(arg, binary_types) else str(arg).encode("utf-8")
+            for arg in args[index:] if arg is not None
+        )
+        segments = _split_literals(rest)
+        pieces = iter(segments[1:])
+        server = self.imap_server
+        # imaplib 要求回调为绑定方法
+        server.literal = types.MethodType(
+            lambda _, continuation: next(pieces, None), server
+        )
+        return args[:index] + (segments[0],)
+
+    def has_capability(self, name):
+        """判断 IMAP 服务器是否支持指定的扩展"""
+        return name.upper() in self.imap_server.capabilities
+
+    def enable(self, capability):
+        """启用 IMAP 扩展（RFC 5161），如 QRESYNC"""
+        capability = capability.upper()
+        if capability in self._enabled_capabilities:
+            return
+        if not self.has_capability(capability):
+            raise CapabilityNotSupportedError(
+                "Server does not support {}".format(capability)
+            )
+        self._imap_command("enable", capability)
+        self._enabled_capabilities.add(capability)
+
     def declare_identity(self, name="kmailbox", version=__version__,
                          vendor="kmailbox"):
         client_id = '("name" "{}" "version" "{}" "vendor" "{}")'.format(
@@ -842,9 +2795,113 @@ class MailBox(object):
         name = name.replace(b'\\', b'\\\\').replace(b'"', b'\\"')
         return b'"' + name + b'"'
 
-    def select(self, box="INBOX", readonly=False):
+    def _pop_untagged_number(self, name):
+        """获取并移除服务器返回的数字类型的未标记响应，如 UIDVALIDITY、UIDNEXT"""
+        data = self.imap_server.untagged_responses.pop(name, None)
+        if not data or data[-1] is None:
+            return None
+        value = _decode_string(data[-1], "utf-8").split()
+        return int(value[0]) if value and value[0].isdigit() else None
+
+    def _pop_vanished(self):
+        """获取并移除 VANISHED 响应（RFC 7162），返回被删除邮件的 UID 列表"""
+        vanished = []
+        for item in self.imap_server.untagged_responses.pop('VANISHED', []):
+            item = _decode_string(item, "utf-8") or ''
+            item = re.sub(r'^\(EARLIER\)\s*', '', item, flags=re.I)
+            vanished.extend(str(uid) for uid in _expand_sequence_set(item))
+        return vanished
+
+    def select(self, box="INBOX", readonly=False, condstore=False,
+               qresync=None):
+        """选择邮箱目录，返回 MailFolderStatus 对象
+
+        参数 condstore 为 True 时启用 CONDSTORE 扩展（RFC 7162），服务器会为每封邮件
+        维护 MODSEQ，并在目录状态中返回 HIGHESTMODSEQ
+
+        参数 qresync 为 True 时启用 QRESYNC 扩展，也可以为上次同步的
+        (uidvalidity, modseq) 或者 (uidvalidity, modseq, known_uids)，
+        此时服务器在选择目录时即返回自该 modseq 之后被删除的邮件，其 UID 列表保存在
+        返回结果的 vanished 属性中
+        """
         self._log.info("Selecting mail folder '%s'", box)
-        self._imap_command("select", self._encode_folder(box), readonly)
+        select_params = None
+        if qresync:
+            self.enable("QRESYNC")
+            if isinstance(qresync, (tuple, list)):
+                select_params = "(QRESYNC ({}))".format(
+                    " ".join(str(item) for item in qresync)
+                )
+        elif condstore:
+            if not self.has_capability("CONDSTORE"):
+                raise CapabilityNotSupportedError(
+                    "Server does not support CONDSTORE"
+                )
+            select_params = "(CONDSTORE)"
+
+        encoded_box = self._encode_folder(box)
+        if select_params:
+            # imaplib 的 select 方法没有附加参数，由于目录名参数会被原样发送，
+            # 将参数拼接在目录名之后，连接状态仍由 imaplib 的 select 维护
+            encoded_box += b" " + select_params.encode("ascii")
+            if binary_types is str:
+                # Python 2 的 imaplib 会给含空格的 str 参数加引号，unicode 则不会
+                encoded_box = encoded_box.decode("ascii")
+        self._imap_command("select", encoded_box, readonly)
+        self._selected_readonly = readonly
+        self.folder_status = MailFolderStatus(
+            name=box,
+            exists=self._pop_untagged_number('EXISTS'),
+            uidvalidity=self._pop_untagged_number('UIDVALIDITY'),
+            uidnext=self._pop_untagged_number('UIDNEXT'),
+            highestmodseq=self._pop_untagged_number('HIGHESTMODSEQ'),
+            vanished=self._pop_vanished() if qresync and
+            isinstance(qresync, (tuple, list)) else None,
+        )
+        cache_key = self._cache_key()
+        if cache_key:
+            self.cache.invalidate(*cache_key)
+        return self.folder_status
+
+    def changed_since(self, modseq, uid_set="1:*"):
+        """获取 MODSEQ 大于 modseq 的邮件的标志（RFC 7162），返回 MailChanges 对象
+
+        需要在选择目录时启用 CONDSTORE 或者 QRESYNC，启用 QRESYNC 时还会返回自该
+        modseq 之后被删除的邮件的 UID。返回结果中的 highestmodseq 可用于下一次调用
+        """
+        qresync = "QRESYNC" in self._enabled_capabilities
+        if not qresync and not self.has_capability("CONDSTORE"):
+            raise CapabilityNotSupportedError(
+                "Server does not support CONDSTORE"
+            )
+        modifier = "(CHANGEDSINCE {}{})".format(
+            modseq, " VANISHED" if qresync else ""
+        )
+        data = self._imap_command(
+            'uid', 'FETCH', uid_set, '(UID FLAGS MODSEQ)', modifier
+        )
+
+        highestmodseq = int(modseq)
+        changed = []
+        for item in data:
+            if not item:
+                continue
+            items = _parse_fetch_response([item])
+            item_modseq = int((items.get('MODSEQ') or [modseq])[0])
+            highestmodseq = max(highestmodseq, item_modseq)
+            changed.append(MailChange(
+                uid=items.get('UID'),
+                flags=_normalize_flags(items.get('FLAGS')),
+                modseq=item_modseq,
+            ))
+
+        vanished = self._pop_vanished()
+        if self.folder_status:
+            self.folder_status = self.folder_status._replace(
+                highestmodseq=max(highestmodseq,
+                                  self.folder_status.highestmodseq or 0)
+            )
+        return MailChanges(changed, vanished, highestmodseq)
 
     def _search(self, *criterions, **kwargs):
         """搜索邮件
@@ -880,113 +2937,823 @@ class MailBox(object):
 
         Criterion 示例，获取未读且标题中带 hello 的邮件："(UNSEEN SUBJECT 'hello')"
 
-        另外可传递关键参数 charset 来指定编码格式
+        criterion 也可以为 MailQuery 对象，包含非 ASCII 字符时会自动指定 UTF-8 字符集
+
+        另外可传递关键参数 charset 来指定编码格式，关键参数 uid 指定是否返回邮件的
+        UID，默认为 use_uid 属性的值，否则返回邮件序号
         """
 
         if not criterions:
             criterions = ["ALL"]
         charset = kwargs.get("charset", None)
+        uid = kwargs.get("uid", self.use_uid)
+        criterions, charset = _compile_criterions(criterions, charset)
         self._log.info("Using criterion %s search mails", criterions)
-        data = self._imap_command('search', charset, *criterions)
+        if uid:
+            charset_args = ('CHARSET', charset) if charset else ()
+            data = self._imap_command(
+                'uid', 'SEARCH', *(charset_args + tuple(criterions))
+            )
+        else:
+            data = self._imap_command('search', charset, *criterions)
         if isinstance(data[0], binary_types):
             mail_list = data[0].decode("utf-8").split()
         else:
             mail_list = data[0].split()
         return mail_list
 
-    def _fetch_single_message(self, msg_num, msg_parts):
+    @staticmethod
+    def _parse_esearch_response(data, returns):
+        """解析 ESEARCH 响应，如 b'(TAG "A1") UID COUNT 3 MIN 2 MAX 9 ALL 2,5,9'"""
+        result = dict.fromkeys(MailSearchResult._fields)
+        if "COUNT" in returns:
+            result["count"] = 0
+        items = _parse_imap_response([data]) if data else []
+        items = [item for item in items if not isinstance(item, list)]
+        if items and items[0].upper() == 'UID':
+            items = items[1:]
+        for name, value in zip(items[::2], items[1::2]):
+            name = name.lower()
+            if name in ("count", "min", "max"):
+                result[name] = int(value)
+            elif name == "all":
+                result[name] = value
+        return MailSearchResult(**result)
+
+    def esearch(self, *criterions, **kwargs):
+        """在服务器端统计搜索结果，返回 MailSearchResult 对象
+
+        服务器支持 ESEARCH 扩展（RFC 4731）时通过 SEARCH RETURN 仅返回统计结果，
+        而不传输完整的邮件列表，否则由普通的搜索结果计算。关键参数 returns 指定需要
+        返回的结果项，默认为 ("COUNT", "MIN", "MAX", "ALL")，其余参数与 _search 相同
+        """
+        returns = tuple(item.upper() for item in kwargs.pop(
+            "returns", ("COUNT", "MIN", "MAX", "ALL")
+        ))
+        if not self.has_capability("ESEARCH"):
+            numbers = sorted(int(num) for num in self._search(*criterions,
+                                                              **kwargs))
+            return MailSearchResult(
+                count=len(numbers) if "COUNT" in returns else None,
+                min=numbers[0] if numbers and "MIN" in returns else None,
+                max=numbers[-1] if numbers and "MAX" in returns else None,
+                all=(_compact_sequence_set(numbers) or None)
+                if "ALL" in returns else None,
+            )
+
+        criterions, charset = _compile_criterions(
+            criterions or ["ALL"], kwargs.get("charset", None)
+        )
+        uid = kwargs.get("uid", self.use_uid)
+        args = ('RETURN', '({})'.format(' '.join(returns)))
+        if charset:
+            args += ('CHARSET', charset)
+        self._log.info("Using criterion %s esearch mails", criterions)
+        self.imap_server.untagged_responses.pop('ESEARCH', None)
+        if uid:
+            self._imap_command('uid', 'SEARCH', *(args + criterions))
+        else:
+            self._imap_command('search', None, *(args + criterions))
+        data = self.imap_server.untagged_responses.pop('ESEARCH', [None])
+        return self._parse_esearch_response(data[-1], returns)
+
+    def count(self, *criterions, **kwargs):
+        """统计符合搜索条件的邮件数量，参数与 _search 相同"""
+        return self.esearch(*criterions, returns=("COUNT",), **kwargs).count
+
+    def sort(self, sort_criteria, *criterions, **kwargs):
+        """通过 SORT 扩展（RFC 5256）在服务器端排序，返回排序后的邮件列表
+
+        sort_criteria 为排序条件，如 "REVERSE DATE"、["FROM", "SUBJECT"]，可选的
+        排序字段有 ARRIVAL、CC、DATE、FROM、SIZE、SUBJECT、TO，其余参数与 _search
+        相同，如获取某个发件人最新的 20 封邮件：
+
+            box.sort("REVERSE DATE", MailQuery(sender="a@mail.com"))[:20]
+        """
+        if not self.has_capability("SORT"):
+            raise CapabilityNotSupportedError("Server does not support SORT")
+        if not isinstance(sort_criteria, string_types):
+            sort_criteria = ' '.join(sort_criteria)
+        sort_criteria = '({})'.format(sort_criteria.strip('()'))
+        criterions, charset = _compile_criterions(
+            criterions or ["ALL"], kwargs.get("charset", None)
+        )
+        uid = kwargs.get("uid", self.use_uid)
+        self._log.info("Sorting mails by %s with criterion %s",
+                       sort_criteria, criterions)
+        if uid:
+            data = self._imap_command('uid', 'SORT', sort_criteria,
+                                      charset or 'UTF-8', *criterions)
+        else:
+            data = self._imap_command('sort', sort_criteria,
+                                      charset or 'UTF-8', *criterions)
+        return (_decode_string(data[0], "utf-8") or '').split()
+
+    def thread(self, *criterions, **kwargs):
+        """通过 THREAD 扩展（RFC 5256）在服务器端将邮件组织为会话
+
+        关键字参数 algorithm 为 REFERENCES（默认）或者 ORDEREDSUBJECT，其余参数与
+        _search 相同，如 box.thread("UNSEEN", algorithm="ORDEREDSUBJECT")。返回
+        会话列表，每个会话为嵌套的列表，如 [["2"], ["3", "6", ["4", "23"]]]，其中
+        嵌套的子列表表示同一父邮件下的多个分支
+        """
+        algorithm = kwargs.get("algorithm", "REFERENCES").upper()
+        if not self.has_capability("THREAD=" + algorithm):
+            raise CapabilityNotSupportedError(
+                "Server does not support THREAD={}".format(algorithm)
+            )
+        criterions, charset = _compile_criterions(
+            criterions or ["ALL"], kwargs.get("charset", None)
+        )
+        uid = kwargs.get("uid", self.use_uid)
+        if uid:
+            data = self._imap_command('uid', 'THREAD', algorithm,
+                                      charset or 'UTF-8', *criterions)
+        else:
+            data = self._imap_command('thread', algorithm,
+                                      charset or 'UTF-8', *criterions)
+        return _parse_imap_response([item for item in data if item])
+
+    def _fetch(self, msg_set, msg_parts, uid=False):
+        """下载邮件数据，uid 为 True 时 msg_set 为 UID 集合，否则为序号集合"""
+        if uid:
+            return self._imap_command('uid', 'FETCH', msg_set, msg_parts)
+        return self._imap_command('fetch', msg_set, msg_parts)
+
+    def _fetch_single_message(self, msg_num, msg_parts, uid=False):
+        raw_msg = None
         try:
-            raw_msg = self._imap_command('fetch', msg_num, msg_parts)
+            raw_msg = self._fetch(msg_num, msg_parts, uid)
             return Message(is_received=True).from_raw_message_data(raw_msg)
         except Exception as ex:
             self._log.error("Fetch %r message error: %s, raw_msg: %s",
                             msg_num, ex, raw_msg)
 
-    def fetch_messages(self, msg_set, mark_seen=True, gen=False):
+    # 匹配 FETCH 响应中每封邮件数据的起始部分，如 b'12 (UID 345 ...'
+    _fetch_response_start_pattern = re.compile(br'^\d+ \(')
+
+    @classmethod
+    def _split_fetch_response(cls, data, literal_only=True):
+        """将包含多封邮件的 FETCH 响应数据拆分为每封邮件各自的数据
+
+        literal_only 为 False 时保留不包含字面量的数据，如仅下载 ENVELOPE 等数据时
+        """
+        groups = []
+        for item in data:
+            head = item[0] if isinstance(item, (tuple, list)) else item
+            if not head:
+                continue
+            if not isinstance(head, binary_types):
+                head = head.encode("utf-8")
+            if cls._fetch_response_start_pattern.match(head) or not groups:
+                groups.append([item])
+            else:
+                groups[-1].append(item)
+        if not literal_only:
+            return groups
+        # 忽略不包含消息体的数据，如服务器主动推送的 FLAGS 变更通知
+        return [
+            group for group in groups
+            if any(isinstance(item, (tuple, list)) for item in group)
+        ]
+
+    def _fetch_batch_messages(self, msg_nums, msg_parts, uid=False):
+        """通过一条 FETCH 命令下载多封邮件，按 msg_nums 的顺序返回
+
+        服务器按编号顺序返回压缩后的序列集合中的邮件，因此需要重新排序。整批下载
+        失败时改为逐封下载，避免一封邮件的错误导致整批邮件丢失
+        """
+        msg_set = _compact_sequence_set(msg_nums)
+        try:
+            data = self._fetch(msg_set, msg_parts, uid)
+        except Exception as ex:
+            self._log.error("Fetch messages %r error: %s, fetching one by one",
+                            _shorten_text(msg_set), ex)
+            messages = (self._fetch_single_message(num, msg_parts, uid)
+                        for num in msg_nums)
+            return [message for message in messages if message]
+        messages = []
+        for raw_msg in self._split_fetch_response(data):
+            try:
+                message = Message(is_received=True)
+                message.from_raw_message_data(raw_msg)
+                if uid:
+                    num = message.uid
+                else:
+                    head = raw_msg[0]
+                    if isinstance(head, (tuple, list)):
+                        head = head[0]
+                    num = _decode_string(head, "utf-8").split()[0]
+                messages.append((num, message))
+            except Exception as ex:
+                self._log.error("Parse message error: %s, raw_msg: %s",
+                                ex, raw_msg[0])
+        order = {}
+        for index, num in enumerate(msg_nums):
+            order.setdefault(str(int(num)), index)
+        messages.sort(key=lambda item: order.get(str(item[0]), len(order)))
+        return [message for _, message in messages]
+
+    def _cache_key(self):
+        """当前目录在邮件缓存中的键 (folder_key, uidvalidity)，不可用时为 None"""
+        status = self.folder_status
+        if not self.cache or not status or not status.uidvalidity:
+            return None
+        return self._sync_key(status.name), status.uidvalidity
+
+    def _fetch_cached_messages(self, uids, msg_parts, mark_seen=False):
+        """按 UID 下载完整邮件，优先使用本地缓存的邮件数据，仅下载未缓存的邮件"""
+        folder_key, uidvalidity = self._cache_key()
+        uids = [str(uid) for uid in uids]
+        cached = {}
+        for uid in uids:
+            data = self.cache.get(folder_key, uidvalidity, uid)
+            if data is not None:
+                cached[uid] = data
+
+        messages = {}
+        if cached:
+            # 邮件的标志是可变的，因此仍需从服务器获取
+            if mark_seen:
+                self.mark_as_seen(list(cached))
+            cached_set = _compact_sequence_set(cached)
+            for item in self._fetch(cached_set, "(UID FLAGS INTERNALDATE)",
+                                    uid=True):
+                if not item:
+                    continue
+                items = _parse_fetch_response([item])
+                uid = items.get('UID')
+                if uid not in cached:
+                    continue
+                message = Message(
+                    is_received=True, uid=uid,
+                    flags=_normalize_flags(items.get('FLAGS')),
+                    size=len(cached[uid]),
+                    internal_date=_parse_internal_date(
+                        items.get('INTERNALDATE')
+                    ),
+                )
+                messages[uid] = message.from_bytes(cached[uid])
+
+        missing = [uid for uid in uids if uid not in cached]
+        if missing:
+            if len(missing) > 1:
+                fetched = self._fetch_batch_messages(missing, msg_parts, True)
+            else:
+                fetched = [self._fetch_single_message(
+                    missing[0], msg_parts, True
+                )]
+            for message in fetched:
+                if not message or not message.uid:
+                    continue
+                messages[message.uid] = message
+                if message._raw is not None:
+                    self.cache.set(folder_key, uidvalidity, message.uid,
+                                   message._raw)
+        return [messages[uid] for uid in uids if uid in messages]
+
+    def _fetch_message_body(self, uid, mark_seen=False):
+        """按 UID 下载单封邮件的完整数据"""
+        cache_key = self._cache_key()
+        if cache_key:
+            data = self.cache.get(cache_key[0], cache_key[1], uid)
+            if data is not None:
+                if mark_seen:
+                    self.mark_as_seen([str(uid)])
+                return data
+        msg_part = "(BODY[])" if mark_seen else "(BODY.PEEK[])"
+        for item in self._fetch(uid, msg_part, uid=True):
+            if isinstance(item, (tuple, list)):
+                if cache_key and isinstance(item[1], binary_types):
+                    self.cache.set(cache_key[0], cache_key[1], uid, item[1])
+                return item[1]
+        raise UnexpectedCommandStatusError(
+            "No message data found for uid {}".format(uid)
+        )
+
+    def _fetch_message_section(self, uid, section, offset=None, length=None):
+        """按 UID 下载邮件的指定 MIME 部分，可以通过 offset、length 仅下载其中一段"""
+        msg_part = "BODY.PEEK[{}]".format(section)
+        if offset is not None:
+            msg_part += "<{}.{}>".format(offset, length)
+        data = self._fetch(uid, "({})".format(msg_part), uid=True)
+        for item in data:
+            if isinstance(item, (tuple, list)):
+                return item[1]
+        return b''  # 超出数据范围时服务器会返回 NIL
+
+    def _iter_message_section(self, uid, section, chunk_size=None):
+        """分块下载邮件的指定 MIME 部分"""
+        chunk_size = chunk_size or 1024 * 1024
+        offset = 0
+        while True:
+            chunk = self._fetch_message_section(uid, section, offset, chunk_size)
+            if chunk:
+                yield chunk
+            if len(chunk) < chunk_size:
+                break
+            offset += len(chunk)
+
+    def _map_in_sessions(self, func, tasks, workers, ordered=True):
+        """使用连接池中的多个 IMAP 连接并行执行任务，返回任务结果的迭代器
+
+        每个工作线程使用各自的连接，ordered 为 True 时按任务顺序返回结果
+        """
+        task_queue = queue.Queue()
+        for index, task in enumerate(tasks):
+            task_queue.put((index, task))
+        task_count = task_queue.qsize()
+        workers = min(workers, task_count)
+        result_queue = queue.Queue()
+        stopped = threading.Event()
+
+        def _worker():
+            try:
+                session = self._acquire_imap_session()
+            except Exception as ex:
+                self._log.error("Create IMAP session error: %s", ex)
+                result_queue.put(None)
+                return
+            try:
+                while not stopped.is_set():
+                    try:
+                        index, task = task_queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    try:
+                        result_queue.put((index, func(task)))
+                    except Exception as ex:
+                        self._log.error("Run task %r error: %s", task, ex)
+                        result_queue.put((index, None))
+            finally:
+                self._release_imap_session(session)
+                result_queue.put(None)
+
+        threads = [threading.Thread(target=_worker) for _ in range(workers)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        pending = {}
+        next_index = 0
+        finished_workers = 0
+        try:
+            while next_index < task_count and finished_workers < workers:
+                item = result_queue.get()
+                if item is None:
+                    finished_workers += 1
+                    continue
+                if not ordered:
+                    next_index += 1
+                    yield item[1]
+                    continue
+                pending[item[0]] = item[1]
+                while next_index in pending:
+                    yield pending.pop(next_index)
+                    next_index += 1
+            # 所有工作线程均已退出时，处理剩余的结果
+            while not result_queue.empty():
+                item = result_queue.get()
+                if item is not None:
+                    pending[item[0]] = item[1]
+            for index in sorted(pending):
+                yield pending[index]
+        finally:
+            stopped.set()
+
+    def fetch_messages(self, msg_set, mark_seen=True, gen=False,
+                       batch_size=None, uid=None, headers_only=False,
+                       workers=None, ordered=True):
         """使用 RFC822 电子邮件的标准格式下载邮件
 
         当 message_part 使用 RFC822 时功能上等同于 BODY[]
         注意 BODY[] 的形式会隐含 /Seen 标记，如不希望如此，可以使用 BODY.PEEK[] 代替
         其不会暗自设置 /Seen 标记
+
+        参数 batch_size 表示每条 FETCH 命令下载的邮件数量，默认为 fetch_batch_size，
+        其值为 1 时逐封下载邮件，整批下载失败时也会改为逐封下载。返回的邮件与
+        msg_set 的顺序一致
+
+        参数 uid 表示 msg_set 是否为 UID 集合，默认为 use_uid 属性的值，应与搜索
+        邮件时使用的模式保持一致
+
+        参数 headers_only 为 True 时仅下载邮件头、大小、标志及 BODYSTRUCTURE，在访问
+        邮件的 content 属性时再通过当前连接下载完整邮件，attachments 属性则由
+        BODYSTRUCTURE 构建，仅在获取附件数据时下载对应的 MIME 部分
+
+        参数 workers 大于 1 时使用连接池中的多个 IMAP 连接并行下载邮件，每个连接会
+        选择与当前连接相同的目录，ordered 为 True 时按 msg_set 的顺序返回邮件，
+        否则按下载完成的顺序返回
         """
-        msg_parts = ("(BODY[] UID FLAGS)" if mark_seen
-                     else "(BODY.PEEK[] UID FLAGS)")
-        msg_gen = (self._fetch_single_message(num, msg_parts)
-                   for num in msg_set)
+        if headers_only:
+            msg_parts = ("(UID FLAGS INTERNALDATE RFC822.SIZE BODYSTRUCTURE "
+                         "BODY.PEEK[HEADER])")
+        else:
+            msg_parts = ("(BODY[] UID FLAGS INTERNALDATE RFC822.SIZE)"
+                         if mark_seen else
+                         "(BODY.PEEK[] UID FLAGS INTERNALDATE RFC822.SIZE)")
+        batch_size = batch_size or self.fetch_batch_size
+        uid = self.use_uid if uid is None else uid
+        if uid and not headers_only and self._cache_key():
+            def fetch_batch(batch):
+                return self._fetch_cached_messages(batch, msg_parts, mark_seen)
+        elif batch_size > 1:
+            def fetch_batch(batch):
+                return self._fetch_batch_messages(batch, msg_parts, uid)
+        else:
+            def fetch_batch(batch):
+                return [self._fetch_single_message(batch[0], msg_parts, uid)]
+        batches = _iter_chunks(msg_set, batch_size)
+        if workers and workers > 1:
+            batch_results = self._map_in_sessions(
+                fetch_batch, list(batches), workers, ordered
+            )
+        else:
+            batch_results = (fetch_batch(batch) for batch in batches)
+        msg_gen = (msg for msgs in batch_results for msg in (msgs or []))
+        if headers_only:
+            msg_gen = (msg.bind_mailbox(self, mark_seen) if msg else msg
+                       for msg in msg_gen)
         return msg_gen if gen else list(msg_gen)
 
+    def fetch_records(self, msg_set, gen=False, batch_size=None, uid=None):
+        """下载邮件列表记录
+
+        仅下载邮件的 UID、标志、大小、到达时间及信封（ENVELOPE）信息，返回
+        MessageRecord 列表，适合列出大量邮件，需要邮件内容时再调用记录的 to_message
+        方法下载完整邮件
+
+        参数 batch_size 及 uid 的含义与 fetch_messages 方法相同
+        """
+        msg_parts = "(UID FLAGS INTERNALDATE RFC822.SIZE ENVELOPE)"
+        batch_size = batch_size or self.fetch_batch_size
+        uid = self.use_uid if uid is None else uid
+
+        def fetch_groups(batch):
+            msg_set = _compact_sequence_set(batch)
+            try:
+                data = self._fetch(msg_set, msg_parts, uid)
+                return self._split_fetch_response(data, literal_only=False)
+            except Exception as ex:
+                self._log.error(
+                    "Fetch records %r error: %s, fetching one by one",
+                    _shorten_text(msg_set), ex
+                )
+            # 整批下载失败时逐封下载，仅丢失出错的邮件
+            groups = []
+            for num in batch:
+                try:
+                    data = self._fetch(num, msg_parts, uid)
+                    groups.extend(
+                        self._split_fetch_response(data, literal_only=False)
+                    )
+                except Exception as ex:
+                    self._log.error("Fetch %r record error: %s", num, ex)
+            return groups
+
+        def fetch_batch(batch):
+            for group in fetch_groups(batch):
+                try:
+                    items = _parse_fetch_response(group)
+                    if 'ENVELOPE' in items:
+                        yield MessageRecord.from_fetch_items(items)
+                except Exception as ex:
+                    self._log.error("Parse record error: %s, raw_msg: %s",
+                                    ex, group[0])
+
+        record_gen = (
+            record for batch in _iter_chunks(msg_set, batch_size)
+            for record in fetch_batch(batch)
+        )
+        return record_gen if gen else list(record_gen)
+
+    def records(self, criterions=None, gen=False):
+        """列出符合搜索条件（默认为所有邮件）的邮件记录，参见 fetch_records
+
+        criterions 可以为检索条件字符串、MailQuery 对象或者由它们组成的列表
+        """
+        if not criterions:
+            criterions = ["ALL"]
+        elif isinstance(criterions, (string_types, MailQuery)):
+            criterions = [criterions]
+        return self.fetch_records(self._search(*criterions), gen)
+
     def fetch_uids(self, msg_set, gen=False):
-        """获取邮件的唯一标识"""
-        uid_gen = (Message(is_received=True).uid_from_string(
-            self._imap_command('fetch', num, "UID")[0]
-        ) for num in msg_set)
+        """获取邮件的唯一标识
+
+        参数 msg_set 为邮件序号集合，使用 UID 模式搜索邮件时无需再调用该方法
+        """
+        uid_gen = (
+            Message(is_received=True).uid_from_string(item)
+            for batch in _iter_chunks(msg_set, self.fetch_batch_size)
+            for item in self._imap_command(
+                'fetch', _compact_sequence_set(batch), "(UID)"
+            ) if item
+        )
         return uid_gen if gen else list(uid_gen)
 
-    def all(self, mark_seen=True, gen=False):
-        return self.fetch_messages(self._search("ALL"), mark_seen, gen)
+    def all(self, mark_seen=True, gen=False, headers_only=False):
+        return self.fetch_messages(self._search("ALL"), mark_seen, gen,
+                                   headers_only=headers_only)
 
-    def unread(self, mark_seen=True, gen=False):
-        return self.fetch_messages(self._search("UNSEEN"), mark_seen, gen)
+    def unread(self, mark_seen=True, gen=False, headers_only=False):
+        return self.fetch_messages(self._search("UNSEEN"), mark_seen, gen,
+                                   headers_only=headers_only)
 
-    def recent(self, mark_seen=True, gen=False):
-        return self.fetch_messages(self._search("RECENT"), mark_seen, gen)
+    def recent(self, mark_seen=True, gen=False, headers_only=False):
+        return self.fetch_messages(self._search("RECENT"), mark_seen, gen,
+                                   headers_only=headers_only)
 
-    def new(self, mark_seen=True, gen=False):
-        return self.fetch_messages(self._search("NEW"), mark_seen, gen)
+    def new(self, mark_seen=True, gen=False, headers_only=False):
+        return self.fetch_messages(self._search("NEW"), mark_seen, gen,
+                                   headers_only=headers_only)
 
-    def old(self, mark_seen=True, gen=False):
-        return self.fetch_messages(self._search("OLD"), mark_seen, gen)
+    def old(self, mark_seen=True, gen=False, headers_only=False):
+        return self.fetch_messages(self._search("OLD"), mark_seen, gen,
+                                   headers_only=headers_only)
 
-    def from_criteria(self, criteria, mark_seen=True, gen=False):
-        """按发件人搜索邮件"""
+    def from_criteria(self, criteria, mark_seen=True, gen=False,
+                      headers_only=False):
+        """按发件人搜索邮件
+
+        criteria 可以为发件人、发件人列表（匹配其中任意一个）或者 MailQuery 对象
+        """
+        if not isinstance(criteria, MailQuery):
+            criteria = MailQuery(sender=criteria)
         return self.fetch_messages(
-            self._search('FROM "{}"'.format(criteria)), mark_seen, gen
+            self._search(criteria), mark_seen, gen,
+            headers_only=headers_only
         )
 
+    # 匹配 IDLE 期间服务器推送的邮件数量变化通知，如 b'* 12 EXISTS'
+    _idle_event_pattern = re.compile(br'^\* (\d+) (EXISTS|EXPUNGE|RECENT)\b')
+
     @staticmethod
-    def _clean_uid_set(uid_set):
-        """转换 uid 集合
+    def _has_buffered_data(server):
+        """检查 imaplib 读取响应使用的 file 对象的缓冲区中是否已有未处理的数据
 
-        Uid 集合可以是: 字符串(可以逗号分隔)，可迭代的对象
+        如继续响应与 EXISTS 通知在同一个数据包中到达时，后者已被读入缓冲区，套接字
+        上不再有可读取的数据
         """
-        if isinstance(uid_set, string_types):
-            uid_set = uid_set.split(',')
+        peek = getattr(server.file, 'peek', None)
+        if peek is None:
+            # Python 2 的 socket._fileobject 将已读取的数据保存在 _rbuf 中
+            rbuf = getattr(server.file, '_rbuf', None)
+            return bool(rbuf is not None and rbuf.tell())
+        # 缓冲区为空时 peek 会读取套接字，临时切换为非阻塞模式以免等待
+        sock = server.sock
+        timeout = sock.gettimeout()
+        sock.settimeout(0)
         try:
-            uid_set_iter = iter(uid_set)
-        except TypeError:
-            raise ValueError('Wrong uid type: "{}"'.format(type(uid_set)))
+            return bool(peek(1))
+        except (socket.error, ssl.SSLError):
+            return False
+        finally:
+            sock.settimeout(timeout)
 
-        uid_list = []
-        for uid in uid_set_iter:
-            if not isinstance(uid, string_types):
-                try:
-                    uid = uid.uid
-                except AttributeError:
-                    raise ValueError('Wrong uid: "{}"'.format(uid))
-            uid = uid.strip()
-            if not uid.isdigit():
-                raise ValueError('Wrong uid: "{}"'.format(uid))
-            uid_list.append(uid)
-        return ','.join((item for item in uid_list))
+    @classmethod
+    def _wait_readable(cls, server, timeout):
+        """等待 IMAP 连接上有可读取的数据"""
+        if cls._has_buffered_data(server):
+            return True
+        sock = server.sock
+        if hasattr(sock, 'pending') and sock.pending():
+            return True
+        readable, _, _ = select_io([sock], [], [], timeout)
+        return bool(readable)
+
+    # imaplib 没有提供 IDLE 命令，需要使用的内部接口
+    _idle_internals = ('_new_tag', '_get_response', '_get_tagged_response',
+                       'tagged_commands', 'send', 'sock', 'file')
+
+    def _start_idle(self, server):
+        """发送 IDLE 命令并等待服务器的继续响应（+），返回命令的标签"""
+        missing = [name for name in self._idle_internals
+                   if not hasattr(server, name)]
+        if missing:
+            raise CapabilityNotSupportedError(
+                "IDLE requires imaplib internals: " + ", ".join(missing)
+            )
+        tag = server._new_tag()
+        server.send(tag + b' IDLE\r\n')
+        while True:
+            # _get_response 收到继续响应时返回 None，否则返回读取到的响应行
+            if server._get_response() is None:
+                return tag
+            result = server.tagged_commands.get(tag)
+            if result:
+                # 服务器没有接受 IDLE 命令就结束了该命令
+                server.tagged_commands.pop(tag, None)
+                raise UnexpectedCommandStatusError(
+                    "Unexpected response status '{}', data: {}, "
+                    "command: idle".format(result[0], result[1])
+                )
+
+    def idle(self, timeout=None):
+        """进入 IDLE 状态（RFC 2177）等待服务器推送当前目录的变化
+
+        在收到 EXISTS、EXPUNGE、RECENT 通知或者超过 timeout 秒后结束 IDLE，
+        返回收到的通知列表，如 [('EXISTS', 12)]。timeout 为 0 时立即结束，为 None
+        时一直等待
+        """
+        if not self.has_capability("IDLE"):
+            raise CapabilityNotSupportedError("Server does not support IDLE")
+        server = self.imap_server
+        tag = self._start_idle(server)
+        self._log.debug("Entered IDLE, timeout=%s", timeout)
+
+        events = []
+        deadline = time.time() + timeout if timeout is not None else None
+        try:
+            while not events:
+                wait = deadline - time.time() if deadline is not None \
+                    else None
+                if wait is not None and wait <= 0:
+                    break
+                if not self._wait_readable(server, wait):
+                    break
+                match = self._idle_event_pattern.match(server._get_response())
+                if match:
+                    events.append((match.group(2).decode(),
+                                   int(match.group(1))))
+        finally:
+            server.send(b'DONE\r\n')
+            self._check_command_response(
+                server._get_tagged_response(tag), command="idle"
+            )
+        for name in ('EXISTS', 'EXPUNGE', 'RECENT'):
+            server.untagged_responses.pop(name, None)
+        return events
+
+    def watch(self, folder=None, timeout=None, idle_timeout=29 * 60,
+              poll_interval=30, fetch=True, mark_seen=False,
+              headers_only=False):
+        """监听新到达的邮件，返回一个迭代器
+
+        服务器支持 IDLE 时通过 IDLE 等待服务器推送，并且每隔 idle_timeout 秒重新发起
+        IDLE 以避免被服务器断开连接，否则每隔 poll_interval 秒发送 NOOP 轮询。
+        有新邮件到达时下载并返回 Message 对象，参数 fetch 为 False 时仅返回其 UID
+
+        参数 folder 为要监听的目录，默认为当前选择的目录，timeout 为总的监听时间，
+        默认一直监听
+        """
+        if folder:
+            self.select(folder, readonly=not mark_seen)
+        status = self.folder_status
+        if status and status.uidnext:
+            last_uid = status.uidnext - 1
+        else:
+            last_uid = max(
+                [int(uid) for uid in self._search("ALL", uid=True)] or [0]
+            )
+        use_idle = self.has_capability("IDLE")
+        if not use_idle:
+            self._log.info("Server does not support IDLE, polling by NOOP")
+        deadline = time.time() + timeout if timeout is not None else None
+        self.imap_server.untagged_responses.pop('EXISTS', None)
+
+        while deadline is None or time.time() < deadline:
+            wait = idle_timeout if use_idle else poll_interval
+            if deadline is not None:
+                wait = max(min(wait, deadline - time.time()), 0)
+            if use_idle:
+                has_new = any(
+                    name in ('EXISTS', 'RECENT')
+                    for name, _ in self.idle(wait)
+                )
+            else:
+                time.sleep(wait)
+                self._imap_command("noop")
+                untagged = self.imap_server.untagged_responses
+                has_new = bool(untagged.pop('EXISTS', None) or
+                               untagged.pop('RECENT', None))
+            if not has_new:
+                continue
+
+            uids = [
+                uid for uid in self._search(
+                    "UID {}:*".format(last_uid + 1), uid=True
+                ) if int(uid) > last_uid
+            ]
+            if not uids:
+                continue
+            last_uid = max(int(uid) for uid in uids)
+            self._log.info("Received %d new messages", len(uids))
+            if not fetch:
+                for uid in uids:
+                    yield uid
+                continue
+            for msg in self.fetch_messages(uids, mark_seen, gen=True,
+                                           uid=True,
+                                           headers_only=headers_only):
+                yield msg
+
+    def _sync_key(self, folder):
+        host = self.imap_host
+        return "{}@{}/{}".format(self.username, host[0] if host else "", folder)
+
+    def sync(self, state, folder="INBOX", mark_seen=False, gen=False,
+             headers_only=False):
+        """增量同步邮件，仅下载上次同步之后到达的邮件
+
+        参数 state 为 MailSyncState 对象或者同步状态文件路径。同步状态记录了目录的
+        UIDVALIDITY 以及已同步的最大 UID，每次仅下载 UID 大于该值的邮件，当目录的
+        UIDVALIDITY 发生变化时（UID 已失效）会重新同步目录中的所有邮件
+
+        注意该方法会选择 folder 目录，mark_seen 为 False 时以只读方式选择
+        """
+        if not isinstance(state, MailSyncState):
+            state = MailSyncState(state)
+        status = self.select(folder, readonly=not mark_seen)
+        key = self._sync_key(folder)
+        uidvalidity, last_uid = state.get(key)
+        if uidvalidity != status.uidvalidity:
+            if uidvalidity is not None:
+                self._log.warning(
+                    "UIDVALIDITY of folder '%s' changed from %s to %s, "
+                    "resync all messages", folder, uidvalidity,
+                    status.uidvalidity
+                )
+            last_uid = 0
+
+        if status.uidnext and status.uidnext <= last_uid + 1:
+            uids = []  # 没有新到达的邮件
+        else:
+            # 当没有新邮件时 'last+1:*' 仍会匹配到最大 UID 的邮件，因此需要过滤
+            uids = [
+                uid for uid in self._search(
+                    "UID {}:*".format(last_uid + 1), uid=True
+                ) if int(uid) > last_uid
+            ]
+        self._log.info("Sync %d new messages from folder '%s'",
+                       len(uids), folder)
+
+        uids.sort(key=int)
+
+        def _sync_gen():
+            fetched = set()
+            try:
+                for msg in self.fetch_messages(uids, mark_seen, gen=True,
+                                               uid=True,
+                                               headers_only=headers_only):
+                    if msg and msg.uid:
+                        fetched.add(int(msg.uid))
+                    yield msg
+            finally:
+                # 下载失败的邮件会被忽略，已同步的 UID 只能推进到第一封未下载的
+                # 邮件之前，以便下次同步时重新下载
+                synced_uid = last_uid
+                for uid in uids:
+                    if int(uid) not in fetched:
+                        self._log.warning(
+                            "Message %s of folder '%s' was not fetched, "
+                            "sync will resume from it", uid, folder
+                        )
+                        break
+                    synced_uid = int(uid)
+                state.update(key, status.uidvalidity, synced_uid)
+                state.save()
+
+        return _sync_gen() if gen else list(_sync_gen())
+
+    @staticmethod
+    def _clean_uid_set(uid_set):
+        """转换 uid 集合
+
+        Uid 集合可以是: 字符串(可以逗号分隔，可以包含 a:b 形式的区间)，整数，
+        可迭代的对象(元素可以为字符串、整数或者 Message 对象)，连续的 uid 会被
+        合并为区间
+        """
+        return ','.join(_iter_sequence_sets(_parse_uid_ranges(uid_set)))
+
+    def _split_uid_set(self, uid_set):
+        """转换 uid 集合，并按命令行长度限制拆分为多个集合"""
+        max_length = max(self.max_line_length - 100, 20)
+        return _iter_sequence_sets(_parse_uid_ranges(uid_set), max_length)
+
+    def _uid_command(self, command, uid_set, *args):
+        """对 uid 集合执行 UID 命令，集合过长时拆分为多条命令执行"""
+        data = []
+        for uid_str in self._split_uid_set(uid_set):
+            data.extend(self._imap_command("uid", command, uid_str, *args))
+        return data
 
     def flag(self, uid_set, flag_set, value):
         """设置或者取消设置邮件标志
 
         参数 value 值为 True 时表示设置标志，否则为取消
         """
-        uid_str = self._clean_uid_set(uid_set)
-        if not uid_str:
-            return None
         if isinstance(flag_set, string_types):
             flag_set = [flag_set]
-        store_result = self.imap_server.uid(
-            'STORE', uid_str, ('+' if value else '-') + 'FLAGS',
+        # uid_set 可能为迭代器，只能遍历一次
+        uid_set = self._clean_uid_set(uid_set)
+        self._log.info("Falg %s (value=%r) for %s", flag_set, value,
+                       _shorten_text(uid_set))
+        data = self._uid_command(
+            'STORE', uid_set, ('+' if value else '-') + 'FLAGS',
             '({})'.format(' '.join(('\\' + item for item in flag_set)))
         )
-        self._log.info("Falg %s (value=%r) for %s",
-                       flag_set, value, _shorten_text(uid_str))
-        data = self._check_command_response(store_result)
-        return data
+        return data or None
 
     def expunge(self):
         """将邮箱中所有打了删除标记的邮件彻底删除"""
@@ -1004,44 +3771,139 @@ class MailBox(object):
         """标记邮件为未读"""
         return self.flag(uid_set, MailFlag.SEEN, False)
 
-    def move(self, to_folder, criterions=None, on_condition_what=None):
-        """移动邮件到指定目录"""
+    def delete(self, criteria_or_uids, chunk_size=1000, progress=None):
+        """批量彻底删除邮件
+
+        参数 criteria_or_uids 可以为搜索条件字符串、MailQuery 对象，或者 UID 列表、
+        形如 '1,5,100:200' 的字符串等 UID 集合。邮件按 chunk_size 分块标记删除，
+        服务器支持 UIDPLUS 时每块通过 UID EXPUNGE 立即清除，因此中断后重新执行即可
+        从断点继续。progress 为可调用对象，每处理完一块以 (已删除数量, 总数量) 作为
+        参数调用，返回删除数量
+        """
+        if progress and not callable(progress):
+            raise Exception("progress must be a callable object")
+        is_uid_string = isinstance(criteria_or_uids, string_types) and \
+            re.match(r'^[\d,:*\s]+$', criteria_or_uids)
+        if isinstance(criteria_or_uids, MailQuery) or (
+                isinstance(criteria_or_uids, string_types) and
+                not is_uid_string):
+            uids = self._search(criteria_or_uids, uid=True)
+        else:
+            # UID 集合同样由服务器通过 UID 检索条件搜索，仅得到实际存在的邮件，
+            # 也避免在本地展开很大的区间
+            if is_uid_string and '*' in criteria_or_uids:
+                uid_sets = [re.sub(r'\s+', '', criteria_or_uids)]
+            else:
+                uid_sets = self._split_uid_set(criteria_or_uids)
+            uids = [uid for uid_set in uid_sets
+                    for uid in self._search("UID " + uid_set, uid=True)]
+        if not uids:
+            return 0
+
+        use_uid_expunge = self.has_capability("UIDPLUS")
+        deleted_count = 0
+        for chunk in _iter_chunks(uids, chunk_size):
+            self.mark_as_delete(chunk)
+            if use_uid_expunge:
+                self._uid_command("EXPUNGE", chunk)
+            deleted_count += len(chunk)
+            self._log.debug("Deleted %d/%d messages",
+                            deleted_count, len(uids))
+            if progress:
+                progress(deleted_count, len(uids))
+        if not use_uid_expunge:
+            self.expunge()
+        self._log.info("Delete %d messages done", deleted_count)
+        return deleted_count
+
+    def move(self, to_folder, criterions=None, on_condition_what=None,
+             batch_size=1000):
+        """移动邮件到指定目录
+
+        服务器支持 MOVE 扩展（RFC 6851）时按 UID 集合批量执行 UID MOVE，否则批量
+        复制并标记删除，最后清除被移动的邮件。仅在指定了 on_condition_what 时下载
+        邮件头用于判断，返回成功移动的邮件 UID 列表
+        """
         if on_condition_what and not callable(on_condition_what):
             raise Exception("on_condition_what must be a callable object")
-        if criterions:
-            msgs = self.fetch_messages(
-                self._search(criterions), mark_seen=False, gen=False
-            )
-        else:
-            msgs = self.new(mark_seen=False, gen=False)
+        uids = self._search(criterions or "NEW", uid=True)
+        if on_condition_what:
+            msgs = self.fetch_messages(uids, mark_seen=False, gen=True,
+                                       uid=True, headers_only=True)
+            uids = [msg.uid for msg in msgs if msg and on_condition_what(msg)]
+        if not uids:
+            return []
+
         encoded_to_folder = self._encode_folder(to_folder)
-        for msg in msgs:
-            if not msg or (on_condition_what and not on_condition_what(msg)):
+        use_move = self.has_capability("MOVE")
+        moved_uids = []
+        for batch in _iter_chunks(uids, batch_size):
+            try:
+                if use_move:
+                    self._uid_command("MOVE", batch, encoded_to_folder)
+                else:
+                    self._uid_command("COPY", batch, encoded_to_folder)
+                    self.mark_as_delete(batch)
+            except Exception as ex:
+                self._log.error("Move %s to %r error: %s",
+                                _shorten_sequence_string(batch), to_folder, ex)
                 continue
-            ret = self.imap_server.uid('COPY', msg.uid, encoded_to_folder)
-            if ret[0] == 'OK':
-                self.mark_as_delete(msg.uid)
-                self.expunge()
-                self._log.info("Move %s to %r done", msg, to_folder)
+            moved_uids.extend(batch)
+
+        if moved_uids and not use_move:
+            if self.has_capability("UIDPLUS"):
+                self._uid_command("EXPUNGE", moved_uids)
             else:
-                self._log.error("Move %s to %r error: %s",
-                                msg, to_folder, ret[1])
+                self.expunge()
+        self._log.info("Move %d messages to %r done",
+                       len(moved_uids), to_folder)
+        return moved_uids
 
     def relay(self, to_addrs, criterions=None, on_condition_what=None):
-        """邮件转发"""
+        """邮件转发
+
+        直接转发下载到的原始邮件数据，不会重新生成邮件内容。所有邮件通过同一个 SMTP
+        会话发送，邮件多于一批（fetch_batch_size）时，发送当前邮件的同时在后台线程
+        中使用另一个 IMAP 连接下载后续的邮件（imaplib 的连接不是线程安全的），该连接
+        在转发结束后退出登录，返回转发的邮件数量
+        """
         if on_condition_what and not callable(on_condition_what):
             raise Exception("on_condition_what must be a callable object")
-        if criterions:
-            msgs = self.fetch_messages(
-                self._search(criterions), mark_seen=False, gen=True
-            )
+        # 邮件序号在不同的连接之间可能不一致，因此搜索与下载均使用 UID
+        uids = self._search(criterions or "NEW", uid=True)
+
+        def fetch_in_session():
+            # 在后台线程中执行，该线程使用独立的 IMAP 连接
+            session = self._acquire_imap_session()
+            try:
+                for msg in self.fetch_messages(uids, mark_seen=False,
+                                               gen=True, uid=True):
+                    yield msg
+            finally:
+                self._local.imap_server = None
+                self._logout_imap_session(session)
+
+        if len(uids) > self.fetch_batch_size:
+            messages = _iter_prefetched(fetch_in_session(),
+                                        self.fetch_batch_size)
         else:
-            msgs = self.new(mark_seen=False, gen=True)
-        for msg in msgs:
-            if on_condition_what and not on_condition_what(msg):
+            messages = self.fetch_messages(uids, mark_seen=False, gen=True,
+                                           uid=True)
+
+        smtp_server = self.smtp_server
+        smtp_server.ehlo_or_helo_if_needed()
+        mail_options = []
+        if smtp_server.has_extn("8bitmime"):
+            mail_options.append("BODY=8BITMIME")
+        relay_count = 0
+        for msg in messages:
+            if not msg or (on_condition_what and not on_condition_what(msg)):
                 continue
-            self.smtp_server.sendmail(self.username, to_addrs, msg.as_string())
+            smtp_server.sendmail(self.username, to_addrs, msg.as_bytes(),
+                                 mail_options)
+            relay_count += 1
             self._log.info("Relay %s to %s", msg, to_addrs)
+        return relay_count
 
     def __enter__(self):
         return self
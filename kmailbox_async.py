@@ -0,0 +1,644 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) Huoty, All rights reserved
+# Author: Huoty <sudohuoty@163.com>
+
+"""基于 asyncio 的邮件收发器
+
+基于 asyncio 的 Stream 接口实现非阻塞的 IMAP、SMTP 客户端，邮件的解析复用 kmailbox
+模块中的 Message 等对象，可在一个事件循环中同时处理大量邮箱
+"""
+
+import os
+import re
+import ssl
+import base64
+import socket
+import asyncio
+import logging
+from email.utils import parseaddr
+
+from kmailbox import (
+    __version__,
+    Message,
+    MailBox,
+    MailFolderStatus,
+    MailQuery,
+    UnexpectedCommandStatusError,
+    CapabilityNotSupportedError,
+    _decode_string,
+    _iter_chunks,
+    _compact_sequence_set,
+    _shorten_text,
+    _split_literals,
+    _compile_criterions,
+)
+
+
+CRLF = b'\r\n'
+
+
+class _AsyncIMAPConnection(object):
+    """非阻塞的 IMAP 连接
+
+    命令的返回结果与 imaplib 保持一致，未标记响应按类型分组，其中带字面量的数据为
+    (头部, 字面量) 元组，以便复用 kmailbox 中的响应解析逻辑
+    """
+
+    _untagged_status_pattern = re.compile(
+        br'\* (?P<data>\d+) (?P<type>[A-Z-]+)( (?P<data2>.*))?'
+    )
+    _untagged_pattern = re.compile(br'\* (?P<type>[A-Z-]+)( (?P<data>.*))?')
+    _literal_pattern = re.compile(br'.*\{(?P<size>\d+)\}$')
+    _response_code_pattern = re.compile(
+        br'\[(?P<type>[A-Z-]+)( (?P<data>[^\]]*))?\]'
+    )
+
+    def __init__(self, reader, writer, logger=None):
+        self._reader = reader
+        self._writer = writer
+        self._log = logger or logging.getLogger("kmailbox")
+        self._tagnum = 0
+        self._lock = asyncio.Lock()
+        self.capabilities = ()
+
+    @classmethod
+    async def connect(cls, host, port, use_ssl=False, timeout=None,
+                      logger=None):
+        ssl_context = ssl.create_default_context() if use_ssl else None
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(host, port, ssl=ssl_context),
+            timeout
+        )
+        conn = cls(reader, writer, logger)
+        greeting = await conn._read_line()
+        if not greeting.startswith(b'* OK') and \
+                not greeting.startswith(b'* PREAUTH'):
+            raise UnexpectedCommandStatusError(
+                "Unexpected IMAP greeting: {!r}".format(greeting)
+            )
+        return conn
+
+    async def _read_line(self):
+        line = await self._reader.readline()
+        if not line:
+            raise ConnectionError("IMAP connection closed by server")
+        return line[:-2] if line.endswith(CRLF) else line.rstrip(b'\n')
+
+    async def _read_untagged(self, line, untagged):
+        """读取一条未标记响应，包括其后的字面量"""
+        match = self._untagged_status_pattern.match(line)
+        if match:
+            typ = match.group('type').decode()
+            data = match.group('data')
+            if match.group('data2'):
+                data = data + b' ' + match.group('data2')
+        else:
+            match = self._untagged_pattern.match(line)
+            typ = match.group('type').decode() if match else None
+            data = (match.group('data') if match else line) or b''
+        items = []
+        while True:
+            literal_match = self._literal_pattern.match(data)
+            if not literal_match:
+                break
+            literal = await self._reader.readexactly(
+                int(literal_match.group('size'))
+            )
+            items.append((data, literal))
+            data = await self._read_line()
+        items.append(data)
+        if typ is None:
+            # 无法识别的响应仍需读取完其后的字面量，以免影响后续响应的解析
+            self._log.warning("Ignore unknown untagged response: %r",
+                              line[:100])
+            return
+        untagged.setdefault(typ, []).extend(items)
+        if typ in ('OK', 'NO', 'BAD'):
+            code_match = self._response_code_pattern.match(data)
+            if code_match:
+                untagged.setdefault(code_match.group('type').decode(), []) \
+                    .append(code_match.group('data'))
+
+    async def command(self, name, *args):
+        """执行命令，返回 (状态, 数据, 未标记响应字典)"""
+        async with self._lock:
+            self._tagnum += 1
+            tag = 'KMB{}'.format(self._tagnum).encode()
+            parts = [tag, name.encode()]
+            for arg in args:
+                if arg is None:
+                    continue
+                if not isinstance(arg, bytes):
+                    arg = str(arg).encode()
+                parts.append(arg)
+            self._log.debug("> %r", b' '.join(parts[:2]))
+            # 包含字面量时，每个字面量需要在收到服务器的继续响应之后发送
+            segments = _split_literals(b' '.join(parts))
+            self._writer.write(segments[0] + CRLF)
+            await self._writer.drain()
+
+            untagged = {}
+            for segment in segments[1:]:
+                result = await self._read_response(tag, untagged,
+                                                   continuation=True)
+                if result is not None:  # 服务器拒绝了命令
+                    return result
+                self._writer.write(segment + CRLF)
+                await self._writer.drain()
+            return await self._read_response(tag, untagged)
+
+    async def _read_response(self, tag, untagged, continuation=False):
+        """读取响应直到命令结束，continuation 为 True 时收到继续响应即返回 None"""
+        while True:
+            line = await self._read_line()
+            if line.startswith(tag + b' '):
+                typ, _, data = line[len(tag) + 1:].partition(b' ')
+                return typ.decode(), [data], untagged
+            if line.startswith(b'*'):
+                await self._read_untagged(line, untagged)
+            elif continuation and line.startswith(b'+'):
+                return None
+            else:
+                raise UnexpectedCommandStatusError(
+                    "Unexpected IMAP response: {!r}".format(line)
+                )
+
+    async def close(self):
+        self._writer.close()
+        try:
+            await self._writer.wait_closed()
+        except Exception:
+            pass
+
+
+class _AsyncSMTPConnection(object):
+    """非阻塞的 SMTP 连接"""
+
+    # 本机的完整域名，用于 EHLO 命令，只在首次使用时查询
+    _local_hostname = None
+
+    def __init__(self, reader, writer, host, logger=None):
+        self._reader = reader
+        self._writer = writer
+        self._host = host
+        self._log = logger or logging.getLogger("kmailbox")
+        self.extensions = {}
+
+    @classmethod
+    async def connect(cls, host, port, use_ssl=False, timeout=None,
+                      logger=None):
+        ssl_context = ssl.create_default_context() if use_ssl else None
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(host, port, ssl=ssl_context),
+            timeout
+        )
+        conn = cls(reader, writer, host, logger)
+        await conn._expect(220)
+        return conn
+
+    async def _read_reply(self):
+        code, lines = None, []
+        while True:
+            line = await self._reader.readline()
+            if not line:
+                raise ConnectionError("SMTP connection closed by server")
+            line = line.rstrip(b'\r\n')
+            code = int(line[:3])
+            lines.append(line[4:])
+            if line[3:4] != b'-':
+                return code, lines
+
+    async def _expect(self, *codes):
+        code, lines = await self._read_reply()
+        if code not in codes:
+            raise UnexpectedCommandStatusError(
+                "Unexpected SMTP reply {}: {}".format(
+                    code, b' '.join(lines).decode('utf-8', 'replace')
+                )
+            )
+        return lines
+
+    async def command(self, line, *codes):
+        self._log.debug("> %s", line.split(' ', 1)[0])
+        self._writer.write(line.encode('utf-8') + CRLF)
+        await self._writer.drain()
+        return await self._expect(*codes)
+
+    @classmethod
+    async def _get_local_hostname(cls):
+        # socket.getfqdn 会阻塞（查询 DNS），在线程池中执行
+        if cls._local_hostname is None:
+            loop = asyncio.get_running_loop()
+            cls._local_hostname = await loop.run_in_executor(
+                None, socket.getfqdn
+            )
+        return cls._local_hostname
+
+    async def ehlo(self):
+        hostname = await self._get_local_hostname()
+        lines = await self.command("EHLO {}".format(hostname), 250)
+        self.extensions = {}
+        for line in lines[1:]:
+            name, _, params = _decode_string(line, 'utf-8').partition(' ')
+            self.extensions[name.lower()] = params
+
+    async def starttls(self):
+        if 'starttls' not in self.extensions:
+            raise CapabilityNotSupportedError(
+                "Server does not support STARTTLS"
+            )
+        if not hasattr(self._writer, 'start_tls'):
+            raise CapabilityNotSupportedError(
+                "STARTTLS requires Python 3.11 or later"
+            )
+        await self.command("STARTTLS", 220)
+        await self._writer.start_tls(ssl.create_default_context(),
+                                     server_hostname=self._host)
+        await self.ehlo()
+
+    async def login(self, username, password):
+        mechanisms = self.extensions.get('auth', '').upper().split()
+        if 'PLAIN' in mechanisms or 'LOGIN' not in mechanisms:
+            token = base64.b64encode(
+                '\0{}\0{}'.format(username, password).encode('utf-8')
+            ).decode()
+            await self.command("AUTH PLAIN {}".format(token), 235)
+        else:
+            await self.command("AUTH LOGIN", 334)
+            for value in (username, password):
+                await self.command(
+                    base64.b64encode(value.encode('utf-8')).decode(),
+                    334, 235
+                )
+
+    async def sendmail(self, from_addr, to_addrs, msg):
+        if isinstance(msg, str):
+            msg = msg.encode('utf-8')
+        msg = re.sub(br'(?:\r\n|\n|\r(?!\n))', CRLF, msg)
+        msg = re.sub(br'(?m)^\.', b'..', msg)  # 以 . 开头的行需要转义
+        if not msg.endswith(CRLF):
+            msg += CRLF
+        await self.command(
+            "MAIL FROM:<{}>".format(parseaddr(str(from_addr))[1]), 250
+        )
+        for addr in to_addrs:
+            await self.command(
+                "RCPT TO:<{}>".format(parseaddr(str(addr))[1]),
+                250, 251
+            )
+        await self.command("DATA", 354)
+        self._writer.write(msg + b'.' + CRLF)
+        await self._writer.drain()
+        await self._expect(250)
+
+    async def quit(self):
+        try:
+            await self.command("QUIT", 221)
+        finally:
+            self._writer.close()
+
+
+class AsyncMailBox(object):
+    """基于 asyncio 的邮件收发器
+
+    接口与 MailBox 基本一致，但方法均为协程，读取邮件的方法为异步迭代器
+    """
+
+    imap_host = MailBox.imap_host
+    smtp_host = MailBox.smtp_host
+    _check_command_response = MailBox._check_command_response
+    _encode_folder = staticmethod(MailBox._encode_folder)
+    _clean_uid_set = staticmethod(MailBox._clean_uid_set)
+    _split_uid_set = MailBox._split_uid_set
+    _split_fetch_response = MailBox._split_fetch_response
+    _fetch_response_start_pattern = MailBox._fetch_response_start_pattern
+
+    def __init__(self,
+                 username=None, password=None,
+                 imap_host=None, smtp_host=None,
+                 use_tls=False, use_ssl=False,
+                 timeout=60, logger=None, fetch_batch_size=100,
+                 use_uid=True, max_line_length=8000):
+        self.username = username or os.getenv("KMAILBOX_USERNAME")
+        self.password = password or os.getenv("KMAILBOX_PASSWORD")
+
+        self._imap_host = imap_host or os.getenv("KMAILBOX_IMAP_HOST")
+        self._smtp_host = smtp_host or os.getenv("KMAILBOX_SMTP_HOST")
+
+        self.use_tls = use_tls
+        self.use_ssl = use_ssl
+        self.timeout = timeout
+        self.fetch_batch_size = fetch_batch_size
+        self.use_uid = use_uid
+        self.max_line_length = max_line_length
+
+        self._imap = None
+        self._smtp = None
+        self._imap_lock = asyncio.Lock()
+        self._smtp_lock = asyncio.Lock()
+        self.folder_status = None
+
+        if not logger:
+            logger = logging.getLogger("kmailbox")
+            logger.addHandler(logging.NullHandler())
+            logger.propagate = False
+        self._log = self.logger = logger
+
+    async def _get_imap(self):
+        async with self._imap_lock:
+            if self._imap is None:
+                self._log.debug("Using '%s' login to %s",
+                                self.username, self.imap_host)
+                conn = await _AsyncIMAPConnection.connect(
+                    *self.imap_host, use_ssl=self.use_ssl,
+                    timeout=self.timeout, logger=self._log
+                )
+                res = await conn.command(
+                    "LOGIN", self._quote(self.username),
+                    self._quote(self.password)
+                )
+                self._check_command_response(res, command="login")
+                res = await conn.command("CAPABILITY")
+                conn.capabilities = tuple(
+                    _decode_string(res[2]['CAPABILITY'][-1], 'utf-8')
+                    .upper().split()
+                )
+                if "ID" in conn.capabilities:
+                    await conn.command(
+                        "ID", '("name" "kmailbox" "version" "{}" "vendor" '
+                        '"kmailbox")'.format(__version__)
+                    )
+                self._imap = conn
+        return self._imap
+
+    async def _get_smtp(self):
+        async with self._smtp_lock:
+            if self._smtp is None:
+                self._log.debug("Using '%s' login to %s",
+                                self.username, self.smtp_host)
+                conn = await _AsyncSMTPConnection.connect(
+                    *self.smtp_host, use_ssl=self.use_ssl,
+                    timeout=self.timeout, logger=self._log
+                )
+                await conn.ehlo()
+                if not self.use_ssl and self.use_tls:
+                    await conn.starttls()
+                await conn.login(self.username, self.password)
+                self._smtp = conn
+        return self._smtp
+
+    @staticmethod
+    def _quote(value):
+        value = value.replace('\\', '\\\\').replace('"', '\\"')
+        return '"{}"'.format(value)
+
+    async def _imap_command(self, command, *args):
+        conn = await self._get_imap()
+        typ, data, untagged = await conn.command(command.upper(), *args)
+        self._check_command_response((typ, data), command=command)
+        return untagged
+
+    async def has_capability(self, name):
+        conn = await self._get_imap()
+        return name.upper() in conn.capabilities
+
+    async def close(self):
+        if self._smtp:
+            await self._smtp.quit()
+            self._smtp = None
+        if self._imap:
+            try:
+                await self._imap.command("LOGOUT")
+            finally:
+                await self._imap.close()
+                self._imap = None
+
+    async def send(self, message):
+        if not message.sender:
+            message.sender = self.username
+        self._log.info("Sending email to %s", message.to_addrs)
+        smtp = await self._get_smtp()
+        await smtp.sendmail(message.sender, message.to_addrs,
+                            message.as_string())
+        self._log.info("Send mail is successful")
+
+    @staticmethod
+    def _untagged_number(untagged, name):
+        data = untagged.get(name)
+        if not data or data[-1] is None:
+            return None
+        value = _decode_string(data[-1], 'utf-8').split()
+        return int(value[0]) if value and value[0].isdigit() else None
+
+    async def select(self, box="INBOX", readonly=False):
+        """选择邮箱目录，返回 MailFolderStatus 对象"""
+        self._log.info("Selecting mail folder '%s'", box)
+        untagged = await self._imap_command(
+            "EXAMINE" if readonly else "SELECT", self._encode_folder(box)
+        )
+        self.folder_status = MailFolderStatus(
+            name=box,
+            exists=self._untagged_number(untagged, 'EXISTS'),
+            uidvalidity=self._untagged_number(untagged, 'UIDVALIDITY'),
+            uidnext=self._untagged_number(untagged, 'UIDNEXT'),
+            highestmodseq=self._untagged_number(untagged, 'HIGHESTMODSEQ'),
+        )
+        return self.folder_status
+
+    async def _search(self, *criterions, charset=None, uid=None):
+        """搜索邮件，参数与 MailBox._search 相同"""
+        if not criterions:
+            criterions = ["ALL"]
+        uid = self.use_uid if uid is None else uid
+        criterions, charset = _compile_criterions(criterions, charset)
+        self._log.info("Using criterion %s search mails", criterions)
+        args = (('CHARSET', charset) if charset else ()) + tuple(criterions)
+        if uid:
+            untagged = await self._imap_command("UID", "SEARCH", *args)
+        else:
+            untagged = await self._imap_command("SEARCH", *args)
+        return [
+            num for item in untagged.get('SEARCH', [])
+            for num in _decode_string(item, 'utf-8').split()
+        ]
+
+    async def _fetch(self, msg_set, msg_parts, uid=False):
+        if uid:
+            untagged = await self._imap_command("UID", "FETCH", msg_set,
+                                                msg_parts)
+        else:
+            untagged = await self._imap_command("FETCH", msg_set, msg_parts)
+        return untagged.get('FETCH', [])
+
+    async def fetch_messages(self, msg_set, mark_seen=True, batch_size=None,
+                             uid=None, headers_only=False):
+        """下载邮件，返回异步迭代器，参数与 MailBox.fetch_messages 相同
+
+        headers_only 为 True 时下载的邮件不会自动下载完整内容，需要先通过
+        load_body 方法下载，否则访问其 content 属性或者附件数据时会抛出 RuntimeError
+        """
+        if headers_only:
+            msg_parts = ("(UID FLAGS INTERNALDATE RFC822.SIZE BODYSTRUCTURE "
+                         "BODY.PEEK[HEADER])")
+        else:
+            msg_parts = ("(BODY[] UID FLAGS INTERNALDATE RFC822.SIZE)"
+                         if mark_seen else
+                         "(BODY.PEEK[] UID FLAGS INTERNALDATE RFC822.SIZE)")
+        uid = self.use_uid if uid is None else uid
+        for batch in _iter_chunks(msg_set, batch_size or self.fetch_batch_size):
+            msg_set_str = _compact_sequence_set(batch)
+            try:
+                data = await self._fetch(msg_set_str, msg_parts, uid)
+            except Exception as ex:
+                self._log.error("Fetch messages %r error: %s",
+                                msg_set_str, ex)
+                continue
+            for raw_msg in self._split_fetch_response(data):
+                try:
+                    message = Message(is_received=True)
+                    message.from_raw_message_data(raw_msg)
+                    if headers_only:
+                        message.bind_mailbox(self, mark_seen)
+                    yield message
+                except Exception as ex:
+                    self._log.error("Parse message error: %s, raw_msg: %s",
+                                    ex, raw_msg[0])
+
+    def _fetch_message_body(self, uid, mark_seen=False):
+        # 同步的 Message 属性无法等待异步的下载，需要先调用 load_body
+        raise RuntimeError(
+            "Message {} only has headers, use 'await mailbox.load_body(msg)' "
+            "to fetch its body first".format(uid)
+        )
+
+    def _iter_message_section(self, uid, section, chunk_size=None):
+        self._fetch_message_body(uid)
+
+    async def load_body(self, message, mark_seen=False):
+        """为仅下载了邮件头的消息下载完整的邮件数据"""
+        msg_part = "(BODY[])" if mark_seen else "(BODY.PEEK[])"
+        for item in await self._fetch(message.uid, msg_part, uid=True):
+            if isinstance(item, tuple):
+                message.from_bytes(item[1])
+                message._headers_only = False
+                return message
+        raise UnexpectedCommandStatusError(
+            "No message data found for uid {}".format(message.uid)
+        )
+
+    async def _search_and_fetch(self, criterion, mark_seen, headers_only):
+        msg_set = await self._search(criterion)
+        async for msg in self.fetch_messages(msg_set, mark_seen,
+                                             headers_only=headers_only):
+            yield msg
+
+    def all(self, mark_seen=True, headers_only=False):
+        return self._search_and_fetch("ALL", mark_seen, headers_only)
+
+    def unread(self, mark_seen=True, headers_only=False):
+        return self._search_and_fetch("UNSEEN", mark_seen, headers_only)
+
+    def recent(self, mark_seen=True, headers_only=False):
+        return self._search_and_fetch("RECENT", mark_seen, headers_only)
+
+    def new(self, mark_seen=True, headers_only=False):
+        return self._search_and_fetch("NEW", mark_seen, headers_only)
+
+    def old(self, mark_seen=True, headers_only=False):
+        return self._search_and_fetch("OLD", mark_seen, headers_only)
+
+    def from_criteria(self, criteria, mark_seen=True, headers_only=False):
+        """按发件人搜索邮件，criteria 可以为发件人列表或者 MailQuery 对象"""
+        if not isinstance(criteria, MailQuery):
+            criteria = MailQuery(sender=criteria)
+        return self._search_and_fetch(criteria, mark_seen, headers_only)
+
+    async def _uid_command(self, command, uid_set, *args):
+        """对 uid 集合执行 UID 命令，集合过长时拆分为多条命令执行"""
+        data = []
+        for uid_str in self._split_uid_set(uid_set):
+            untagged = await self._imap_command("UID", command, uid_str, *args)
+            data.extend(untagged.get('FETCH', []))
+        return data
+
+    async def flag(self, uid_set, flag_set, value):
+        """设置或者取消设置邮件标志"""
+        if isinstance(flag_set, str):
+            flag_set = [flag_set]
+        # uid_set 可能为迭代器，只能遍历一次
+        uid_set = self._clean_uid_set(uid_set)
+        self._log.info("Falg %s (value=%r) for %s", flag_set, value,
+                       _shorten_text(uid_set))
+        data = await self._uid_command(
+            "STORE", uid_set, ('+' if value else '-') + 'FLAGS',
+            '({})'.format(' '.join(('\\' + item for item in flag_set)))
+        )
+        return data or None
+
+    async def expunge(self):
+        """将邮箱中所有打了删除标记的邮件彻底删除"""
+        untagged = await self._imap_command("EXPUNGE")
+        return untagged.get('EXPUNGE', [None])
+
+    async def mark_as_delete(self, uid_set):
+        return await self.flag(uid_set, "DELETED", True)
+
+    async def mark_as_seen(self, uid_set):
+        return await self.flag(uid_set, "SEEN", True)
+
+    async def mark_as_unseen(self, uid_set):
+        return await self.flag(uid_set, "SEEN", False)
+
+    async def _matched_messages(self, criterions, on_condition_what,
+                                headers_only):
+        if on_condition_what and not callable(on_condition_what):
+            raise Exception("on_condition_what must be a callable object")
+        msg_set = await self._search(criterions or "NEW")
+        async for msg in self.fetch_messages(msg_set, mark_seen=False,
+                                             headers_only=headers_only):
+            if on_condition_what and not on_condition_what(msg):
+                continue
+            yield msg
+
+    async def move(self, to_folder, criterions=None, on_condition_what=None):
+        """移动邮件到指定目录
+
+        服务器支持 MOVE 扩展时使用 UID MOVE，否则复制邮件并删除原邮件
+        """
+        if on_condition_what:
+            uids = [
+                msg.uid async for msg in self._matched_messages(
+                    criterions, on_condition_what, headers_only=True
+                )
+            ]
+        else:
+            uids = await self._search(criterions or "NEW", uid=True)
+        if not uids:
+            return []
+        encoded_to_folder = self._encode_folder(to_folder)
+        if await self.has_capability("MOVE"):
+            await self._uid_command("MOVE", uids, encoded_to_folder)
+        else:
+            await self._uid_command("COPY", uids, encoded_to_folder)
+            await self.mark_as_delete(uids)
+            if await self.has_capability("UIDPLUS"):
+                await self._uid_command("EXPUNGE", uids)
+            else:
+                await self.expunge()
+        self._log.info("Move %d messages to %r done", len(uids), to_folder)
+        return uids
+
+    async def relay(self, to_addrs, criterions=None, on_condition_what=None):
+        """邮件转发"""
+        smtp = await self._get_smtp()
+        async for msg in self._matched_messages(criterions, on_condition_what,
+                                                headers_only=False):
+            await smtp.sendmail(self.username, to_addrs, msg.as_bytes())
+            self._log.info("Relay %s to %s", msg, to_addrs)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, exc_traceback):
+        await self.close()
@@ -7,6 +7,7 @@
 from __future__ import print_function
 
 import os
+import sys
 from setuptools import setup
 from os.path import join as path_join, dirname as path_dirname
 
@@ -59,6 +60,9 @@ def get_long_description():
 
 def main():
     setup_args["version"] = get_version()
+    # kmailbox_async 使用了 async/await 语法及 asyncio.get_running_loop
+    if sys.version_info >= (3, 7):
+        setup_args["py_modules"].append("kmailbox_async")
     setup_args["long_description"] = get_long_description()
     setup_args["entry_points"] = {
         'console_scripts': [
@@ -7,10 +7,21 @@
 
 import os
 import sys
+import datetime
+import email
+import functools
+import imaplib
 import logging
+import pytest
 from inspect import isgenerator
 from pprint import pprint
-from kmailbox import Message, MailBox, string_types
+from email.header import decode_header, make_header
+from kmailbox import (
+    Message, MailBox, MailFolderStatus, MailSyncState, MailChange, MailQuery,
+    MessageCache, MessageTemplate, AttachmentCache, string_types,
+    UnexpectedCommandStatusError, CapabilityNotSupportedError,
+    _compact_sequence_set, _expand_sequence_set,
+)
 
 try:
     from unittest import mock
@@ -55,6 +66,1156 @@ class TestMessage(object):
         assert msg_str
 
 
+class TestAttachmentCache(object):
+
+    def test_shared_attachment_part(self, tmpdir):
+        attachment = tmpdir.join("report.pdf")
+        attachment.write_binary(b"%PDF-1.4 data")
+        cache = AttachmentCache(max_size=1024)
+        part = cache.get(str(attachment), "utf-8")
+        assert cache.get(str(attachment), "utf-8") is part
+
+        messages = []
+        for index in range(2):
+            msg = Message()
+            msg.recipient = "to{}@email.com".format(index)
+            msg.attachments = [str(attachment)]
+            messages.append(msg)
+        with mock.patch.object(Message, "attachment_cache", cache):
+            for msg in messages:
+                msg.as_string()
+        assert messages[0]._msg.get_payload()[1] is \
+            messages[1]._msg.get_payload()[1]
+
+        # 文件修改后重新编码
+        attachment.write_binary(b"%PDF-1.4 new data")
+        os.utime(str(attachment), (0, 0))
+        assert cache.get(str(attachment), "utf-8") is not part
+
+    def test_opt_in(self, tmpdir):
+        attachment = tmpdir.join("report.pdf")
+        attachment.write_binary(b"%PDF-1.4 data")
+        # 默认不缓存附件
+        assert Message.attachment_cache is None
+        msg = Message(sender="me@email.com", recipient="to@email.com",
+                      content="hello", attachments=[str(attachment)])
+        assert b"".join(msg.iter_bytes()).count(b"JVBERi0xLjQgZGF0YQ") == 1
+
+        box = MailBox(attachment_cache=True)
+        server = mock.Mock()
+        server.mail.return_value = server.rcpt.return_value = (250, b"OK")
+        server.getreply.return_value = (250, b"OK")
+        server.has_extn.side_effect = lambda name: name == "chunking"
+        box._sendmail(server, msg)
+        assert msg.attachment_cache is box.attachment_cache
+        assert len(box.attachment_cache._parts) == 1
+
+
+class TestStreamingSend(object):
+
+    def test_iter_bytes(self, tmpdir):
+        attachment = tmpdir.join("data.bin")
+        attachment.write_binary(os.urandom(5000))
+        msg = Message(sender="me@email.com")
+        msg.recipient = "to@email.com"
+        msg.content = "hello"
+        msg.attachments = [str(attachment)]
+        # 超过缓存大小的附件流式编码
+        msg.attachment_cache = AttachmentCache(max_size=1000)
+        chunks = list(msg.iter_bytes(chunk_size=1000))
+        assert len(chunks) > 3
+        data = b"".join(chunks)
+        assert b"\n" not in data.replace(b"\r\n", b"")
+        parsed = Message(is_received=True).from_bytes(data)
+        assert parsed.content == "hello"
+        assert parsed.attachments[0].payload == attachment.read_binary()
+
+        # 可以缓存的附件只编码一次
+        msg.attachment_cache = AttachmentCache()
+        with mock.patch("kmailbox._iter_base64_file") as iter_file:
+            first = b"".join(msg.iter_bytes())
+            second = b"".join(msg.iter_bytes())
+        assert not iter_file.called
+        assert len(msg.attachment_cache._parts) == 1
+        for data in (first, second):
+            parsed = Message(is_received=True).from_bytes(data)
+            assert parsed.attachments[0].payload == attachment.read_binary()
+
+    def test_send_failure_closes_session(self, tmpdir):
+        attachment = tmpdir.join("data.bin")
+        attachment.write_binary(b"x" * 100)
+        msg = Message(sender="me@email.com", recipient="to@email.com",
+                      content="hello", attachments=[str(attachment)])
+        msg.attachment_cache = None
+        server = mock.Mock()
+        server.mail.return_value = server.rcpt.return_value = (250, b"OK")
+        server.docmd.return_value = (354, b"Go ahead")
+        server.has_extn.return_value = False
+        attachment.remove()
+        server.close.side_effect = lambda: setattr(server, "sock", None)
+        box = MailBox()
+        box._smtp_server = server
+        with pytest.raises(OSError):
+            box.send(msg)
+        server.close.assert_called_once_with()
+        # 下次发送时重新连接
+        assert box._smtp_server is None
+
+    def test_send_with_chunking(self, tmpdir):
+        attachment = tmpdir.join("data.txt")
+        attachment.write("attachment")
+        msg = Message(sender="me@email.com")
+        msg.recipient = "to@email.com"
+        msg.content = "hello"
+        msg.attachments = [str(attachment)]
+        server = mock.Mock()
+        server.mail.return_value = server.rcpt.return_value = (250, b"OK")
+        server.getreply.return_value = (250, b"OK")
+        server.has_extn.side_effect = lambda name: name == "chunking"
+        assert MailBox()._sendmail(server, msg) == {}
+        assert not server.sendmail.called
+        sent = [call[0][0] for call in server.send.call_args_list]
+        assert sent[0].startswith(b"BDAT ")
+        assert sent[-1] == b"BDAT 0 LAST\r\n"
+        body = b"".join(sent[1:-1:2])
+        assert sum(int(item.split()[1]) for item in sent[:-1:2]) == len(body)
+        assert b"attachment" in Message(is_received=True).from_bytes(
+            body).attachments[0].payload
+
+
+class TestMessageTemplate(object):
+
+    def test_render(self, tmpdir):
+        attachment = tmpdir.join("notice.txt")
+        attachment.write("attachment")
+        template = MessageTemplate(
+            "订单 $order", "Hi $name,\n订单 $order 已发货",
+            sender="shop@email.com", attachments=[str(attachment)],
+            headers={"X-Order": "$order"}
+        )
+        skeleton = template.skeleton
+        for name, order in (("Tom", "1"), ("张三", "2")):
+            msg = template.render("{}@email.com".format(order), name=name,
+                                  order=order)
+            assert template.skeleton is skeleton
+            parsed = Message(is_received=True).from_string(msg.as_string())
+            assert parsed.subject == "订单 " + order
+            assert parsed.content == "Hi {},\n订单 {} 已发货".format(name, order)
+            assert parsed.recipient == ("{}@email.com".format(order),)
+            assert str(make_header(decode_header(
+                parsed._msg["X-Order"]))) == order
+            assert [att.filename for att in parsed.attachments] == \
+                ["notice.txt"]
+
+    def test_default_sender(self):
+        template = MessageTemplate("Hi $name", "Hello $name")
+        msg = template.render("to@email.com", name="Tom")
+        server = mock.Mock()
+        server.sendmail.return_value = {}
+        MailBox(username="me@email.com")._sendmail(server, msg)
+        sender, to_addrs, text = server.sendmail.call_args[0]
+        assert sender == "me@email.com"
+        parsed = Message(is_received=True).from_string(text)
+        assert parsed.sender.address == "me@email.com"
+        assert parsed.content == "Hello Tom"
+
+
+class TestLazyParse(object):
+
+    def test_headers_parsed_first(self):
+        raw = (b"From: Tom <tom@email.com>\r\nTo: a@email.com\r\n"
+               b"Subject: hello\r\nDate: Mon, 2 Mar 2020 10:00:00 +0800\r\n"
+               b"\r\nbody text")
+        msg = Message(is_received=True).from_bytes(raw)
+        with mock.patch("email.message_from_bytes",
+                        wraps=email.message_from_bytes) as parse:
+            assert msg.subject == "hello"
+            assert msg.sender.address == "tom@email.com"
+            assert msg.recipient[0].address == "a@email.com"
+            assert msg.date.day == 2
+            assert not parse.called
+            assert msg.content == "body text"
+            assert not parse.called
+        assert msg.as_bytes() is raw
+
+    def test_raw_part_index(self, tmpdir):
+        raw = (b'Subject: parts\r\nContent-Type: multipart/mixed; '
+               b'boundary="b1"\r\n\r\npreamble\r\n--b1\r\n'
+               b'Content-Type: text/plain; charset=utf-8\r\n'
+               b'Content-Transfer-Encoding: quoted-printable\r\n\r\n'
+               b'caf=C3=A9\r\n--b1\r\nContent-Type: message/rfc822\r\n\r\n'
+               b'Subject: inner\r\n\r\ninner body\r\n--b1\r\n'
+               b'Content-Type: application/pdf\r\n'
+               b'Content-Disposition: attachment; filename="a.pdf"\r\n'
+               b'Content-Transfer-Encoding: base64\r\n\r\n'
+               b'aGVsbG8g\r\nd29ybGQ=\r\n--b1--\r\n')
+        msg = Message(is_received=True).from_bytes(raw)
+        assert [part.section for part in msg._raw_parts] == ["1", "2.1", "3"]
+        assert msg.content == "café"
+        att = msg.attachments[0]
+        assert isinstance(att._raw_payload, memoryview)
+        assert att.filename == "a.pdf"
+        att.download(str(tmpdir), chunk_size=5)
+        assert tmpdir.join("a.pdf").read_binary() == b"hello world"
+        assert att.payload == b"hello world"
+        assert msg._parsed_msg is None
+        # 与完整解析后提取的结果一致
+        parsed = Message(is_received=True).from_bytes(raw)
+        assert parsed._msg is not None
+        assert [a.payload for a in parsed.attachments] == [att.payload]
+        assert parsed.content == msg.content
+
+
+class TestMessageParts(object):
+
+    raw = (
+        'Subject: parts\nContent-Type: multipart/mixed; boundary="b1"\n\n'
+        '--b1\nContent-Type: multipart/alternative; boundary="b2"\n\n'
+        '--b2\nContent-Type: text/plain; charset=utf-8\n\nplain text\n'
+        '--b2\nContent-Type: text/html; charset=utf-8\n\n<p>html</p>\n'
+        '--b2--\n--b1\nContent-Type: image/png\nContent-ID: <img0>\n'
+        'Content-Disposition: inline; filename="a.png"\n'
+        'Content-Transfer-Encoding: base64\n\naGVsbG8=\n'
+        '--b1\nContent-Type: application/pdf\n'
+        'Content-Disposition: attachment; filename="b.pdf"\n'
+        'Content-Transfer-Encoding: base64\n\n' + 'aGVsbG8g' * 100 + '\n'
+        '--b1--\n'
+    )
+
+    def test_part_index(self):
+        for msg in (Message(is_received=True).from_string(self.raw),
+                    Message(is_received=True).from_bytes(self.raw.encode())):
+            assert [part.section for part in msg.parts] == \
+                ["1.1", "1.2", "2", "3"]
+            image = msg.parts[2]
+            assert image.content_id == "img0"
+            assert image.disposition == "inline"
+            assert image.filename == "a.png"
+            assert msg.content == "plain text"
+            assert [att.filename for att in msg.attachments] == \
+                ["a.png", "b.pdf"]
+            # 之后的查询复用同一份索引，不再遍历邮件
+            with mock.patch("kmailbox._walk_email_parts") as walk, \
+                    mock.patch("kmailbox._index_mime_parts") as index:
+                assert msg.get_content(prefer="html") == "<p>html</p>"
+                assert msg.get_content(prefer="plain") == "plain text"
+                assert [att.filename for att in msg.get_attachments(
+                    "image/*")] == ["a.png"]
+                assert [att.filename for att in msg.get_attachments(
+                    min_size=100)] == ["b.pdf"]
+                assert msg.get_attachments(["text/*"], max_size=10) == []
+                assert not walk.called and not index.called
+
+
+class TestFetchResponse(object):
+
+    def test_compact_sequence_set(self):
+        assert _compact_sequence_set(["3", 1, 2, 5, 7, 8]) == "1:3,5,7:8"
+        assert _compact_sequence_set([]) == ""
+
+    def test_split_fetch_response(self):
+        data = [
+            (b'1 (UID 11 FLAGS (\\Seen) BODY[] {22}',
+             b'Subject: first\r\n\r\nA'),
+            b')',
+            (b'2 (UID 12 BODY[] {23}', b'Subject: second\r\n\r\nB'),
+            b' FLAGS ())',
+            b'3 (FLAGS (\\Seen))',
+        ]
+        groups = MailBox._split_fetch_response(data)
+        assert len(groups) == 2
+        msgs = [Message(is_received=True).from_raw_message_data(group)
+                for group in groups]
+        assert [msg.uid for msg in msgs] == ["11", "12"]
+        assert msgs[0].flags == ("SEEN",)
+        assert msgs[1].subject == "second"
+
+    def test_internal_date(self):
+        data = [
+            (b'1 (UID 11 FLAGS () INTERNALDATE "17-Jul-1996 02:44:25 -0700" '
+             b'RFC822.SIZE 32 BODY[] {32}',
+             b'Date: someday\r\nSubject: hi\r\n\r\nA'),
+            b')',
+        ]
+        msg = Message(is_received=True).from_raw_message_data(data)
+        assert msg.size == 32
+        assert msg.internal_date == datetime.datetime(
+            1996, 7, 17, 2, 44, 25,
+            tzinfo=datetime.timezone(-datetime.timedelta(hours=7))
+        )
+        # Date 邮件头格式错误时使用 INTERNALDATE
+        assert msg.date == msg.internal_date
+        assert MailQuery(sent_since=datetime.date(2020, 3, 1)).criteria == \
+            "SENTSINCE 1-Mar-2020"
+
+    def test_headers_only_message(self):
+        data = [
+            (b'1 (UID 11 FLAGS () RFC822.SIZE 40 BODY[HEADER] {20}',
+             b'Subject: hello\r\n\r\n'),
+            b')',
+        ]
+        mailbox = mock.Mock()
+        mailbox._fetch_message_body.return_value = (
+            b'Subject: hello\r\n\r\nbody text'
+        )
+        msg = Message(is_received=True).from_raw_message_data(data)
+        msg.bind_mailbox(mailbox)
+        assert msg.size == 40
+        assert msg.subject == "hello"
+        assert not mailbox._fetch_message_body.called
+        assert msg.content == "body text"
+        mailbox._fetch_message_body.assert_called_once_with("11", False)
+
+    def test_envelope_records(self):
+        data = [
+            b'1 (UID 11 FLAGS (\\Seen) INTERNALDATE "17-Jul-1996 02:44:25 '
+            b'-0700" RFC822.SIZE 32 ENVELOPE ("Mon, 2 Mar 2020 10:00:00 '
+            b'+0800" "=?utf-8?b?5rWL6K+V?=" (("Huoty" NIL "Huoty" '
+            b'"Example.com")) NIL NIL ((NIL NIL "a" "example.com")) NIL NIL '
+            b'NIL "<1@example.com>"))',
+            (b'2 (UID 12 FLAGS (\\Seen) ENVELOPE (NIL {2}', b'hi'),
+            b' NIL NIL NIL ((NIL NIL "a" "example.com")) NIL NIL NIL NIL))',
+        ]
+        mailbox = MailBox(imap_host="imap.example.com")
+        mailbox._imap_command = mock.Mock(return_value=data)
+        records = mailbox.fetch_records(["11", "12"])
+        assert len(records) == 2
+        record = records[0]
+        assert not hasattr(record, "__dict__")
+        assert record.uid == "11"
+        assert record.flags == ("SEEN",)
+        assert record.size == 32
+        assert record.subject == "测试"
+        assert record.sender == "huoty@example.com"
+        assert record.sender_name == "Huoty"
+        assert record.recipients == ("a@example.com",)
+        assert record.message_id == "<1@example.com>"
+        assert record.date.hour == 10
+        assert records[1].subject == "hi"
+        assert records[1].flags is record.flags
+        assert records[1].recipients[0] is record.recipients[0]
+        mailbox._imap_command.assert_called_once_with(
+            'uid', 'FETCH', '11:12',
+            "(UID FLAGS INTERNALDATE RFC822.SIZE ENVELOPE)"
+        )
+
+    def test_records_fallback(self):
+        record = (b'1 (UID 12 FLAGS () ENVELOPE (NIL "hi" NIL NIL NIL NIL '
+                  b'NIL NIL NIL NIL))')
+
+        def fetch(msg_set, msg_parts, uid=False):
+            if msg_set == "12":
+                return [record]
+            raise imaplib.IMAP4.error("FETCH failed")
+
+        mailbox = MailBox()
+        with mock.patch.object(mailbox, "_fetch", side_effect=fetch):
+            records = mailbox.fetch_records(["11", "12"])
+        # 整批下载失败后逐封下载，仅丢失出错的邮件
+        assert [item.subject for item in records] == ["hi"]
+
+        with mock.patch.object(mailbox, "_search",
+                               return_value=[]) as search:
+            query = MailQuery(sender="a@b.c")
+            mailbox.records(["UNSEEN", query])
+            search.assert_called_with("UNSEEN", query)
+            mailbox.records("UNSEEN")
+            search.assert_called_with("UNSEEN")
+            mailbox.records()
+            search.assert_called_with("ALL")
+
+    def test_bodystructure_attachments(self, tmpdir):
+        data = [
+            (b'1 (UID 11 FLAGS () BODYSTRUCTURE (("text" "plain" '
+             b'("charset" "utf-8") NIL NIL "7bit" 4 1 NIL NIL NIL NIL)'
+             b'("application" "pdf" ("name" "a.pdf") NIL NIL "base64" 16 '
+             b'NIL ("attachment" ("filename*" {18}', b"utf-8''%E6%B5%8B.pdf"),
+            (b')) NIL NIL) "mixed" ("boundary" "xx") NIL NIL NIL) '
+             b'BODY[HEADER] {16}', b'Subject: test\r\n\r\n'),
+            b')',
+        ]
+        mailbox = mock.Mock()
+        mailbox._iter_message_section.return_value = iter([
+            b'aGVsbG8g\r\n', b'd29y', b'bGQ=\r\n'
+        ])
+        msg = Message(is_received=True).from_raw_message_data(data)
+        msg.bind_mailbox(mailbox)
+        assert len(msg.attachments) == 1
+        att = msg.attachments[0]
+        assert att.filename == "测.pdf"
+        assert att.content_type == "application/pdf"
+        att.download(str(tmpdir))
+        mailbox._iter_message_section.assert_called_once_with("11", "2", None)
+        assert tmpdir.join("测.pdf").read_binary() == b"hello world"
+        assert not mailbox._fetch_message_body.called
+
+    def test_fetch_batch_order(self):
+        box = MailBox()
+        data = [
+            (b"2 (UID 12 BODY[] {15}", b"Subject: two\r\n"), b")",
+            (b"5 (UID 15 BODY[] {16}", b"Subject: five\r\n"), b")",
+        ]
+        with mock.patch.object(box, "_fetch", return_value=data) as fetch:
+            msgs = box._fetch_batch_messages(["15", "12"], "(BODY[])", True)
+            fetch.assert_called_once_with("12,15", "(BODY[])", True)
+            assert [msg.uid for msg in msgs] == ["15", "12"]
+            msgs = box._fetch_batch_messages([5, 2], "(BODY[])")
+            assert [msg.subject for msg in msgs] == ["five", "two"]
+
+    def test_fetch_batch_fallback(self):
+        box = MailBox()
+
+        def fetch(msg_set, msg_parts, uid=False):
+            if msg_set == "12":
+                return [(b"2 (UID 12 BODY[] {15}", b"Subject: two\r\n"), b")"]
+            raise imaplib.IMAP4.error("FETCH failed")
+
+        with mock.patch.object(box, "_fetch", side_effect=fetch):
+            msgs = box._fetch_batch_messages(["15", "12"], "(BODY[])", True)
+        # 整批下载失败后逐封下载，仅丢失出错的邮件
+        assert [msg.uid for msg in msgs] == ["12"]
+
+
+class TestMailQuery(object):
+
+    def test_compile(self):
+        query = MailQuery(sender=["a@mail.com", 'b"@mail.com'],
+                          since=datetime.date(2020, 1, 5), larger=1024,
+                          seen=False)
+        assert query.compile() == (None, (
+            'OR FROM "a@mail.com" FROM "b\\"@mail.com" SINCE 5-Jan-2020 '
+            'LARGER 1024 UNSEEN'
+        ))
+        query = ~MailQuery(flags="$Work", to="c@mail.com") | \
+            MailQuery(subject="报告")
+        # 非 ASCII 字符串以字面量发送
+        assert query.compile() == (
+            "UTF-8",
+            'OR NOT (TO "c@mail.com" KEYWORD $Work) SUBJECT {6}\r\n报告'
+            .encode("utf-8")
+        )
+        with pytest.raises(ValueError):
+            MailQuery(sender=[])
+
+    def test_search(self):
+        box = MailBox()
+        box._imap_server = mock.Mock()
+        box._imap_server.uid.return_value = ("OK", [b"3 5"])
+        query = MailQuery(subject="报告") & MailQuery(flagged=True)
+        assert box._search(query, uid=True) == ["3", "5"]
+        box._imap_server.uid.assert_called_once_with(
+            "SEARCH", "CHARSET", "UTF-8", b"SUBJECT {6}"
+        )
+        # 字面量在收到继续响应后由 imaplib 的 literal 回调发送
+        literal = box._imap_server.literal
+        assert literal(b"go") == "报告 FLAGGED".encode("utf-8")
+        assert literal(b"go") is None
+
+    def test_async_literal(self):
+        import asyncio
+        from kmailbox_async import _AsyncIMAPConnection
+
+        async def search():
+            reader = asyncio.StreamReader()
+            reader.feed_data(b"+ go\r\n+ go\r\n* SEARCH 3\r\n"
+                             b"KMB1 OK done\r\n")
+            writer = mock.MagicMock()
+            writer.drain = mock.AsyncMock()
+            conn = _AsyncIMAPConnection(reader, writer)
+            charset, criteria = (MailQuery(subject="报告") &
+                                 MailQuery(sender="é")).compile()
+            result = await conn.command("SEARCH", "CHARSET", charset,
+                                        criteria)
+            return result, [call[0][0] for call in writer.write.call_args_list]
+
+        (typ, _, untagged), written = asyncio.run(search())
+        assert typ == "OK" and untagged["SEARCH"] == [b"3"]
+        assert written == [
+            b"KMB1 SEARCH CHARSET UTF-8 SUBJECT {6}\r\n",
+            "报告 FROM {2}\r\n".encode("utf-8"),
+            "é\r\n".encode("utf-8"),
+        ]
+
+
+class TestServerSearch(object):
+
+    def test_uid_mode(self):
+        box = MailBox()
+        box._imap_server = mock.Mock(capabilities=("IMAP4REV1",))
+        box._imap_server.uid.return_value = ("OK", [b"11 12"])
+        assert box._search("UNSEEN") == ["11", "12"]
+        box._imap_server.uid.assert_called_once_with("SEARCH", "UNSEEN")
+        assert not box._imap_server.search.called
+
+        box._imap_server.uid.return_value = (
+            "OK", [(b"1 (UID 11 BODY[] {12}", b"Subject: a\r\n"), b")"]
+        )
+        msgs = box.fetch_messages(["11"], mark_seen=False, batch_size=1)
+        assert msgs[0].uid == "11"
+        box._imap_server.uid.assert_called_with(
+            "FETCH", "11", "(BODY.PEEK[] UID FLAGS INTERNALDATE RFC822.SIZE)"
+        )
+
+        box._imap_server.uid.return_value = ("OK", [None])
+        box.mark_as_seen(["11", "12"])
+        box._imap_server.uid.assert_called_with(
+            "STORE", "11:12", "+FLAGS", "(\\SEEN)"
+        )
+
+    def test_sequence_mode(self):
+        box = MailBox(use_uid=False)
+        box._imap_server = mock.Mock(capabilities=("IMAP4REV1",))
+        box._imap_server.search.return_value = ("OK", [b"1 2"])
+        assert box._search("UNSEEN") == ["1", "2"]
+        box._imap_server.search.assert_called_once_with(None, "UNSEEN")
+
+        box._imap_server.fetch.return_value = (
+            "OK", [(b"1 (UID 11 BODY[] {12}", b"Subject: a\r\n"), b")",
+                   (b"2 (UID 12 BODY[] {12}", b"Subject: b\r\n"), b")"]
+        )
+        msgs = box.fetch_messages(["1", "2"], mark_seen=False)
+        assert [msg.uid for msg in msgs] == ["11", "12"]
+        box._imap_server.fetch.assert_called_once_with(
+            "1:2", "(BODY.PEEK[] UID FLAGS INTERNALDATE RFC822.SIZE)"
+        )
+        assert not box._imap_server.uid.called
+
+    def test_esearch(self):
+        box = MailBox()
+        box._imap_server = mock.Mock(capabilities=("IMAP4REV1", "ESEARCH"),
+                                     untagged_responses={})
+
+        def uid(*args):
+            box._imap_server.untagged_responses["ESEARCH"] = [
+                b'(TAG "A5") UID COUNT 4 MIN 2 MAX 9 ALL 2:4,9'
+            ]
+            return "OK", [None]
+
+        box._imap_server.uid.side_effect = uid
+        result = box.esearch("UNSEEN", uid=True)
+        box._imap_server.uid.assert_called_once_with(
+            "SEARCH", "RETURN", "(COUNT MIN MAX ALL)", "UNSEEN"
+        )
+        assert result == (4, 2, 9, "2:4,9")
+        assert "ESEARCH" not in box._imap_server.untagged_responses
+
+        box._imap_server.capabilities = ("IMAP4REV1",)
+        with mock.patch.object(box, "_search", return_value=["7", "3", "4"]):
+            assert box.esearch("ALL") == (3, 3, 7, "3:4,7")
+            assert box.count("ALL") == 3
+
+    def test_sort_and_thread(self):
+        box = MailBox()
+        box._imap_server = mock.Mock(
+            capabilities=("IMAP4REV1", "SORT", "THREAD=REFERENCES")
+        )
+        box._imap_server.uid.return_value = ("OK", [b"9 4 2"])
+        query = MailQuery(sender="a@mail.com")
+        assert box.sort(["REVERSE", "DATE"], query, uid=True)[:2] == \
+            ["9", "4"]
+        box._imap_server.uid.assert_called_with(
+            "SORT", "(REVERSE DATE)", "UTF-8", 'FROM "a@mail.com"'
+        )
+
+        box._imap_server.uid.return_value = ("OK", [b"(2)(3 6 (4 23)(44))"])
+        assert box.thread(uid=True) == [["2"], ["3", "6", ["4", "23"], ["44"]]]
+        box._imap_server.uid.assert_called_with(
+            "THREAD", "REFERENCES", "UTF-8", "ALL"
+        )
+        # 位置参数均为检索条件
+        box.thread("UNSEEN", uid=True)
+        box._imap_server.uid.assert_called_with(
+            "THREAD", "REFERENCES", "UTF-8", "UNSEEN"
+        )
+        with pytest.raises(CapabilityNotSupportedError):
+            box.thread("UNSEEN", algorithm="ORDEREDSUBJECT")
+
+
+class TestSync(object):
+
+    def test_sync(self, tmpdir):
+        state_file = str(tmpdir.join("state.json"))
+        box = MailBox(username="test@mail.com", imap_host="imap.mail.com")
+        status = MailFolderStatus("INBOX", 2, 100, 13, None)
+        msgs = [Message(is_received=True, uid="11"),
+                Message(is_received=True, uid="12")]
+        with mock.patch.object(box, "select", return_value=status), \
+                mock.patch.object(box, "_search", return_value=["11", "12"]), \
+                mock.patch.object(box, "fetch_messages",
+                                  return_value=iter(msgs)) as fetch:
+            assert box.sync(state_file) == msgs
+            assert MailSyncState(state_file).get(
+                box._sync_key("INBOX")) == (100, 12)
+
+            box._search.reset_mock()
+            fetch.return_value = iter([])
+            assert box.sync(state_file) == []
+            assert not box._search.called
+
+            # UIDVALIDITY 变化后需要重新同步
+            fetch.return_value = iter(msgs)
+            status = status._replace(uidvalidity=101)
+            box.select.return_value = status
+            assert box.sync(state_file) == msgs
+            box._search.assert_called_with("UID 1:*", uid=True)
+
+    def test_sync_with_failed_batch(self, tmpdir):
+        state_file = str(tmpdir.join("state.json"))
+        box = MailBox(username="test@mail.com", imap_host="imap.mail.com")
+        status = MailFolderStatus("INBOX", 3, 100, 14, None)
+        # UID 12 所在的批次下载失败
+        msgs = [Message(is_received=True, uid="11"),
+                Message(is_received=True, uid="13")]
+        with mock.patch.object(box, "select", return_value=status), \
+                mock.patch.object(box, "_search",
+                                  return_value=["13", "11", "12"]), \
+                mock.patch.object(box, "fetch_messages",
+                                  return_value=iter(msgs)):
+            assert box.sync(state_file) == msgs
+        assert MailSyncState(state_file).get(
+            box._sync_key("INBOX")) == (100, 11)
+
+    def test_select_condstore(self):
+        box = MailBox()
+        server = mock.Mock(spec=imaplib.IMAP4, capabilities=("CONDSTORE",),
+                           state="AUTH", untagged_responses={})
+        box._imap_server = server
+
+        def command(name, *args):
+            server.untagged_responses.update({
+                "EXISTS": [b"3"], "UIDVALIDITY": [b"100"],
+                "HIGHESTMODSEQ": [b"20"],
+            })
+            return "OK", [b"SELECT completed"]
+
+        server._simple_command.side_effect = command
+        server.select.side_effect = functools.partial(
+            imaplib.IMAP4.select, server
+        )
+        status = box.select(condstore=True)
+        server._simple_command.assert_called_once_with(
+            "SELECT", b'"INBOX" (CONDSTORE)'
+        )
+        assert server.state == "SELECTED"
+        assert status == MailFolderStatus("INBOX", 3, 100, None, 20)
+        assert status.vanished is None
+
+    def test_select_qresync(self):
+        box = MailBox()
+        server = mock.Mock(spec=imaplib.IMAP4, capabilities=("QRESYNC",),
+                           state="AUTH", untagged_responses={})
+        box._imap_server = server
+        box._enabled_capabilities.add("QRESYNC")
+
+        def command(name, *args):
+            server.untagged_responses.update({
+                "EXISTS": [b"3"], "UIDVALIDITY": [b"100"],
+                "HIGHESTMODSEQ": [b"20"],
+                "VANISHED": [b"(EARLIER) 3,7:8", b"(EARLIER) 12"],
+            })
+            return "OK", [b"SELECT completed"]
+
+        server._simple_command.side_effect = command
+        server.select.side_effect = functools.partial(
+            imaplib.IMAP4.select, server
+        )
+        status = box.select(qresync=(100, 15))
+        server._simple_command.assert_called_once_with(
+            "SELECT", b'"INBOX" (QRESYNC (100 15))'
+        )
+        assert status.vanished == ["3", "7", "8", "12"]
+        assert "VANISHED" not in server.untagged_responses
+
+    def test_changed_since(self):
+        box = MailBox()
+        box._imap_server = mock.Mock(capabilities=("IMAP4REV1", "QRESYNC"))
+        box._enabled_capabilities.add("QRESYNC")
+
+        def uid(*args):
+            box._imap_server.untagged_responses = {
+                "VANISHED": [b"(EARLIER) 3,7:9"]
+            }
+            return "OK", [b"1 (UID 5 FLAGS (\\Seen) MODSEQ (20))",
+                          b"2 (UID 6 FLAGS () MODSEQ (18))"]
+
+        box._imap_server.uid.side_effect = uid
+        changes = box.changed_since(15)
+        box._imap_server.uid.assert_called_once_with(
+            "FETCH", "1:*", "(UID FLAGS MODSEQ)", "(CHANGEDSINCE 15 VANISHED)"
+        )
+        assert changes.changed == [MailChange("5", ("SEEN",), 20),
+                                   MailChange("6", (), 18)]
+        assert changes.vanished == ["3", "7", "8", "9"]
+        assert changes.highestmodseq == 20
+
+
+class TestIdle(object):
+
+    def _mailbox(self, responses):
+        box = MailBox()
+        server = box._imap_server = mock.Mock(capabilities=("IMAP4REV1",
+                                                            "IDLE"))
+        server.tagged_commands = {}
+        server.untagged_responses = {}
+
+        def new_tag():
+            server.tagged_commands[b"A1"] = None
+            return b"A1"
+
+        def get_response():
+            response = responses.pop(0)
+            if isinstance(response, tuple):  # 带标签的命令结束响应
+                server.tagged_commands[b"A1"] = response
+                return b"A1 " + response[0].encode()
+            return response
+
+        server._new_tag.side_effect = new_tag
+        server._get_response.side_effect = get_response
+        server._get_tagged_response.return_value = ("OK", [b"IDLE done"])
+        return box, server
+
+    def test_idle(self):
+        box, server = self._mailbox([b"* OK still here", None,
+                                     b"* 4 EXISTS"])
+        with mock.patch.object(box, "_wait_readable",
+                               return_value=True) as wait:
+            assert box.idle(60) == [("EXISTS", 4)]
+        assert 0 < wait.call_args[0][1] <= 60
+        assert server.send.call_args_list == [mock.call(b"A1 IDLE\r\n"),
+                                              mock.call(b"DONE\r\n")]
+        server._get_tagged_response.assert_called_once_with(b"A1")
+
+    def test_idle_timeout(self):
+        box, server = self._mailbox([None])
+        with mock.patch.object(box, "_wait_readable") as wait:
+            assert box.idle(0) == []
+        assert not wait.called
+        server.send.assert_called_with(b"DONE\r\n")
+
+        box, server = self._mailbox([None])
+        with mock.patch.object(box, "_wait_readable", return_value=False):
+            assert box.idle(0.01) == []
+        server.send.assert_called_with(b"DONE\r\n")
+
+        box.folder_status = MailFolderStatus("INBOX", 2, 100, 13, None)
+        with mock.patch.object(box, "idle") as idle:
+            assert list(box.watch(timeout=0)) == []
+        assert not idle.called
+
+    def test_idle_buffered_event(self):
+        import socket
+        import threading
+
+        client_sock, server_sock = socket.socketpair()
+
+        class IMAP4(imaplib.IMAP4):
+            def open(self, host="", port=0, timeout=None):
+                self.sock = client_sock
+                self.file = client_sock.makefile("rb")
+
+        def serve():
+            server_file = server_sock.makefile("rb")
+            server_sock.sendall(b"* OK ready\r\n")
+            idle_tag = None
+            for line in iter(server_file.readline, b""):
+                tag, _, command = line.strip().partition(b" ")
+                if command == b"CAPABILITY":
+                    server_sock.sendall(b"* CAPABILITY IMAP4rev1 IDLE\r\n" +
+                                        tag + b" OK done\r\n")
+                elif command == b"IDLE":
+                    # 继续响应与 EXISTS 通知在同一个数据包中发送
+                    idle_tag = tag
+                    server_sock.sendall(b"+ idling\r\n* 3 EXISTS\r\n")
+                elif tag == b"DONE":
+                    server_sock.sendall(idle_tag + b" OK done\r\n")
+                    break
+
+        thread = threading.Thread(target=serve)
+        thread.start()
+        box = MailBox()
+        box._imap_server = IMAP4()
+        started = datetime.datetime.now()
+        try:
+            assert box.idle(5) == [("EXISTS", 3)]
+        finally:
+            thread.join(5)
+            client_sock.close()
+            server_sock.close()
+        assert (datetime.datetime.now() - started).total_seconds() < 4
+
+    def test_idle_rejected(self):
+        box, server = self._mailbox([("BAD", [b"unknown command"])])
+        with pytest.raises(UnexpectedCommandStatusError):
+            box.idle(60)
+        server.send.assert_called_once_with(b"A1 IDLE\r\n")
+
+
+class TestBulkOperations(object):
+
+    def test_uid_set(self):
+        uid_set = ["9", 3, "1:2", Message(is_received=True, uid="4"), 7]
+        assert MailBox._clean_uid_set(uid_set) == "1:4,7,9"
+        assert MailBox._clean_uid_set("5, 3:1") == "1:3,5"
+        box = MailBox(max_line_length=120)
+        uid_sets = list(box._split_uid_set(range(1, 200, 2)))
+        assert len(uid_sets) > 1
+        assert all(len(item) <= 20 for item in uid_sets)
+        assert _expand_sequence_set(",".join(uid_sets)) == \
+            list(range(1, 200, 2))
+
+    def test_move(self):
+        box = MailBox()
+        box._imap_server = mock.Mock(capabilities=("IMAP4REV1", "MOVE"))
+        box._imap_server.uid.return_value = ("OK", [None])
+        with mock.patch.object(box, "_search",
+                               return_value=["1", "2", "3", "5"]):
+            assert box.move("Archive", "ALL", batch_size=3) == \
+                ["1", "2", "3", "5"]
+        assert box._imap_server.uid.call_args_list == [
+            mock.call("MOVE", "1:3", b'"Archive"'),
+            mock.call("MOVE", "5", b'"Archive"'),
+        ]
+
+        # 不支持 MOVE 时复制后标记删除，并只清除被移动的邮件
+        box._imap_server.capabilities = ("IMAP4REV1", "UIDPLUS")
+        box._imap_server.uid.reset_mock()
+        with mock.patch.object(box, "_search", return_value=["1", "2"]):
+            box.move("Archive", "ALL")
+        commands = [item[0][0] for item in box._imap_server.uid.call_args_list]
+        assert commands == ["COPY", "STORE", "EXPUNGE"]
+        box._imap_server.uid.assert_called_with("EXPUNGE", "1:2")
+
+    def test_delete(self):
+        box = MailBox()
+        box._imap_server = mock.Mock(capabilities=("IMAP4REV1", "UIDPLUS"))
+        box._imap_server.uid.return_value = ("OK", [None])
+        progress = mock.Mock()
+        with mock.patch.object(box, "_search",
+                               return_value=["1", "2", "3"]) as search:
+            assert box.delete('FROM "a@b.c"', chunk_size=2,
+                              progress=progress) == 3
+        search.assert_called_once_with('FROM "a@b.c"', uid=True)
+        assert progress.call_args_list == [mock.call(2, 3), mock.call(3, 3)]
+        expunges = [item[0] for item in box._imap_server.uid.call_args_list
+                    if item[0][0] == "EXPUNGE"]
+        assert expunges == [("EXPUNGE", "1:2"), ("EXPUNGE", "3")]
+
+        box._imap_server.capabilities = ("IMAP4REV1",)
+        with mock.patch.object(box, "_search",
+                               return_value=["7", "9"]) as search, \
+                mock.patch.object(box, "expunge") as expunge:
+            assert box.delete(["9", 7]) == 2
+        search.assert_called_once_with("UID 7,9", uid=True)
+        expunge.assert_called_once_with()
+
+        # UID 区间由服务器按 UID 搜索，仅删除实际存在的邮件
+        def uid(command, *args):
+            if command == "SEARCH":
+                return "OK", [b"100 102"]
+            return "OK", [None]
+
+        box._imap_server.uid.reset_mock()
+        box._imap_server.uid.side_effect = uid
+        with mock.patch.object(box, "expunge"):
+            assert box.delete("100:102, 4000000000") == 2
+        assert box._imap_server.uid.call_args_list == [
+            mock.call("SEARCH", "UID 100:102,4000000000"),
+            mock.call("STORE", "100,102", "+FLAGS", "(\\DELETED)"),
+        ]
+        with mock.patch.object(box, "_search",
+                               return_value=["5", "6"]) as search, \
+                mock.patch.object(box, "expunge"):
+            assert box.delete("5:*") == 2
+        search.assert_called_once_with("UID 5:*", uid=True)
+
+    def test_flag_with_generator(self):
+        box = MailBox()
+        box._imap_server = mock.Mock(capabilities=("IMAP4REV1",))
+        box._imap_server.uid.return_value = ("OK", [None])
+        box.flag((uid for uid in ["3", "1", "2"]), "Seen", True)
+        box._imap_server.uid.assert_called_once_with(
+            "STORE", "1:3", "+FLAGS", "(\\Seen)"
+        )
+
+
+class TestRelay(object):
+
+    def test_relay_raw_bytes(self):
+        box = MailBox(username="me@mail.com")
+        box.fetch_batch_size = 2
+        raw = "Subject: 你好\r\n\r\n中文正文\r\n".encode("utf-8")
+        msgs = [Message(is_received=True, uid=str(uid)).from_bytes(raw)
+                for uid in range(3)]
+        box._smtp_server = mock.Mock()
+        box._smtp_server.has_extn.return_value = True
+        main_server = box._imap_server = mock.Mock()
+        session = mock.Mock()
+        servers = []
+
+        def fetch_messages(*args, **kwargs):
+            # 后台线程使用单独的连接下载邮件
+            servers.append(box.imap_server)
+            return iter(msgs)
+
+        with mock.patch.object(box, "_search",
+                               return_value=["0", "1", "2"]) as search, \
+                mock.patch.object(box, "fetch_messages",
+                                  side_effect=fetch_messages) as fetch, \
+                mock.patch.object(box, "_create_imap_server",
+                                  return_value=session), \
+                mock.patch.object(box, "declare_identity"):
+            count = box.relay(["to@mail.com"],
+                              on_condition_what=lambda msg: msg.uid != "1")
+        assert count == 2
+        search.assert_called_once_with("NEW", uid=True)
+        assert fetch.call_args[1]["uid"] is True
+        assert servers == [session]
+        assert box.imap_server is main_server
+        # 转发结束后退出后台线程使用的连接，不保留在连接池中
+        session.logout.assert_called_once_with()
+        assert box._imap_pool == []
+        box._smtp_server.sendmail.assert_called_with(
+            "me@mail.com", ["to@mail.com"], raw, ["BODY=8BITMIME"]
+        )
+
+        # 仅有一批邮件时直接使用当前连接下载
+        servers[:] = []
+        with mock.patch.object(box, "_search", return_value=["0"]), \
+                mock.patch.object(box, "fetch_messages",
+                                  side_effect=fetch_messages), \
+                mock.patch.object(box, "_create_imap_server") as create:
+            box.relay(["to@mail.com"])
+        assert servers == [main_server]
+        assert not create.called
+
+
+class TestSendMany(object):
+
+    def test_send_many(self):
+        import smtplib
+        box = MailBox(username="me@mail.com")
+        messages = []
+        for index in range(6):
+            msg = Message()
+            msg.recipient = "to{}@mail.com".format(index)
+            msg.content = "hello"
+            messages.append(msg)
+
+        servers = []
+
+        def sendmail(sender, to_addrs, msg):
+            if to_addrs[0] == "to5@mail.com":
+                raise smtplib.SMTPRecipientsRefused({
+                    to_addrs[0]: (550, b"No such user")
+                })
+            return {}
+
+        def create_server():
+            server = mock.Mock()
+            server.sendmail.side_effect = sendmail
+            if not servers:
+                # 第一个连接在发送第二封邮件时断开
+                server.sendmail.side_effect = [
+                    {}, smtplib.SMTPServerDisconnected("closed")
+                ]
+            servers.append(server)
+            return server
+
+        with mock.patch.object(box, "_create_smtp_server",
+                               side_effect=create_server):
+            results = box.send_many(messages, connections=1,
+                                    max_per_session=2, retry_delay=0)
+        assert [result.message for result in results] == messages
+        assert [result.success for result in results] == [True] * 5 + [False]
+        assert results[1].attempts == 2
+        assert results[5].attempts == 1
+        assert messages[0].sender == "me@mail.com"
+        assert len(servers) == 4
+
+    def test_retry_errors(self):
+        box = MailBox(username="me@mail.com")
+        msg = Message(recipient="to@mail.com", content="hello")
+        is_transient = MailBox._is_transient_smtp_error
+        assert is_transient(ConnectionResetError())
+        assert not is_transient(FileNotFoundError("a.pdf"))
+        assert not is_transient(PermissionError("a.pdf"))
+
+        server = mock.Mock()
+        server.sendmail.side_effect = ConnectionResetError()
+        with mock.patch.object(box, "_create_smtp_server",
+                               return_value=server), \
+                mock.patch("time.sleep") as sleep:
+            result = box.send_many([msg], retries=2, retry_delay=1)[0]
+        assert not result.success and result.attempts == 3
+        # 最后一次失败之后不再等待
+        assert sleep.call_args_list == [mock.call(1), mock.call(2)]
+
+
+class TestMessageCache(object):
+
+    def test_lru_eviction(self, tmpdir):
+        cache = MessageCache(str(tmpdir), max_size=10)
+        cache.set("INBOX", 1, "1", b"aaaa")
+        cache.set("INBOX", 1, "2", b"bbbb")
+        assert cache.get("INBOX", 1, "1") == b"aaaa"
+        cache.set("INBOX", 1, "3", b"cccc")
+        assert cache.get("INBOX", 1, "2") is None
+        assert cache.get("INBOX", 1, "1") == b"aaaa"
+
+        # 重新加载时从磁盘恢复索引
+        cache = MessageCache(str(tmpdir), max_size=10)
+        assert cache.get("INBOX", 1, "3") == b"cccc"
+
+    def test_invalidate(self, tmpdir):
+        cache = MessageCache(str(tmpdir))
+        cache.set("INBOX", 1, "1", b"aaaa")
+        assert cache.get("INBOX", 2, "1") is None
+        assert cache.get("INBOX", 1, "1") is None
+
+    def test_fetch_cached_messages(self, tmpdir):
+        box = MailBox(username="test@mail.com", imap_host="imap.mail.com",
+                      cache=str(tmpdir))
+        box.folder_status = MailFolderStatus("INBOX", 2, 100, 13, None)
+        folder_key, uidvalidity = box._cache_key()
+        box.cache.set(folder_key, uidvalidity, "11",
+                      b"Subject: cached\r\n\r\n")
+        with mock.patch.object(box, "_fetch") as fetch:
+            fetch.side_effect = [
+                [b"1 (UID 11 FLAGS (\\Seen))"],
+                [(b"2 (UID 12 FLAGS () BODY[] {21}",
+                  b"Subject: fetched\r\n\r\n"), b")"],
+            ]
+            msgs = box.fetch_messages(["11", "12"], mark_seen=False)
+        assert [msg.subject for msg in msgs] == ["cached", "fetched"]
+        assert msgs[0].flags == ("SEEN",)
+        assert box.cache.get(folder_key, uidvalidity, "12") is not None
+
+
+class TestParallelFetch(object):
+
+    def test_map_in_sessions(self):
+        box = MailBox()
+        sessions = []
+
+        def acquire():
+            session = object()
+            sessions.append(session)
+            box._local.imap_server = session
+            return session
+
+        def fetch_batch(batch):
+            assert box.imap_server in sessions
+            return [num * 10 for num in batch]
+
+        with mock.patch.object(box, "_acquire_imap_session",
+                               side_effect=acquire):
+            results = list(box._map_in_sessions(
+                fetch_batch, [[1, 2], [3], [4, 5]], workers=2
+            ))
+        assert results == [[10, 20], [30], [40, 50]]
+        assert len(box._imap_pool) == len(sessions) == 2
+        assert getattr(box._local, "imap_server", None) is None
+
+
+class TestAsyncMailBox(object):
+
+    def test_fetch_messages(self):
+        import asyncio
+        from kmailbox_async import AsyncMailBox, _AsyncIMAPConnection
+
+        raw = b"From: a@b.c\r\nSubject: hi\r\n\r\nbody\r\n"
+        response = (
+            b"* 1 FETCH (UID 10 FLAGS (\\Seen) BODY[] {%d}\r\n%s)\r\n"
+            b"KMB1 OK FETCH completed\r\n" % (len(raw), raw)
+        )
+
+        async def fetch():
+            reader = asyncio.StreamReader()
+            reader.feed_data(response)
+            box = AsyncMailBox(imap_host="localhost")
+            box._imap = _AsyncIMAPConnection(reader, mock.MagicMock())
+            box._imap._writer.drain = mock.AsyncMock()
+            return [msg async for msg in box.fetch_messages(["10"])]
+
+        messages = asyncio.run(fetch())
+        assert len(messages) == 1
+        assert messages[0].uid == "10"
+        assert messages[0].subject == "hi"
+        assert "SEEN" in messages[0].flags
+
+    def test_unknown_untagged(self):
+        import asyncio
+        from kmailbox_async import AsyncMailBox, _AsyncIMAPConnection
+
+        raw = b"Subject: hi\r\n\r\n"
+        response = (
+            b"* x-unknown {3}\r\nabc\r\n"
+            b"* 1 FETCH (UID 10 BODY[] {%d}\r\n%s)\r\n"
+            b"KMB1 OK FETCH completed\r\n" % (len(raw), raw)
+        )
+
+        async def fetch():
+            reader = asyncio.StreamReader()
+            reader.feed_data(response)
+            box = AsyncMailBox(imap_host="localhost")
+            box._imap = _AsyncIMAPConnection(reader, mock.MagicMock())
+            box._imap._writer.drain = mock.AsyncMock()
+            return [msg async for msg in box.fetch_messages(["10"])]
+
+        messages = asyncio.run(fetch())
+        assert [msg.subject for msg in messages] == ["hi"]
+
+    def test_headers_only(self):
+        import asyncio
+        from kmailbox_async import AsyncMailBox, _AsyncIMAPConnection
+
+        header = b"From: a@b.c\r\nSubject: hi\r\n\r\n"
+        raw = header + b"body\r\n"
+        response = (
+            b"* 1 FETCH (UID 10 FLAGS () BODY[HEADER] {%d}\r\n%s)\r\n"
+            b"KMB1 OK FETCH completed\r\n"
+            b"* 1 FETCH (UID 10 BODY[] {%d}\r\n%s)\r\n"
+            b"KMB2 OK FETCH completed\r\n"
+            % (len(header), header, len(raw), raw)
+        )
+
+        async def fetch():
+            reader = asyncio.StreamReader()
+            reader.feed_data(response)
+            box = AsyncMailBox(imap_host="localhost")
+            box._imap = _AsyncIMAPConnection(reader, mock.MagicMock())
+            box._imap._writer.drain = mock.AsyncMock()
+            msgs = [msg async for msg in box.fetch_messages(
+                ["10"], headers_only=True)]
+            # 未下载邮件内容时访问 content 抛出异常，而不是返回空内容
+            with pytest.raises(RuntimeError):
+                msgs[0].content
+            await box.load_body(msgs[0])
+            return msgs[0]
+
+        assert asyncio.run(fetch()).content == "body\r\n"
+
+    def test_ehlo_hostname(self):
+        import asyncio
+        from kmailbox_async import _AsyncSMTPConnection
+
+        async def ehlo():
+            reader = asyncio.StreamReader()
+            reader.feed_data(b"250-mail.example.com\r\n250 8BITMIME\r\n")
+            writer = mock.MagicMock()
+            writer.drain = mock.AsyncMock()
+            conn = _AsyncSMTPConnection(reader, writer, "mail.example.com")
+            await conn.ehlo()
+            return conn, writer
+
+        with mock.patch("socket.getfqdn", return_value="client.local"), \
+                mock.patch.object(_AsyncSMTPConnection, "_local_hostname",
+                                  None):
+            conn, writer = asyncio.run(ehlo())
+        writer.write.assert_called_once_with(b"EHLO client.local\r\n")
+        assert "8bitmime" in conn.extensions
+
+
 class TestMailBox(object):
 
     def setup_class(cls):
@@ -24,25 +24,12 @@ def main():
     )
     box.login(os.environ["KMAILBOX_USER"], os.environ["KMAILBOX_PASSWD"])
     box.select()
-    # id_list = box._search('FROM "{}"'.format("test@mail.com"))
-    from pprint import pprint
-    # for mail in box.all(mark_seen=False, gen=True):
-    for mail in box.from_criteria("test@mail.com", mark_seen=False, gen=True):
-        pprint({
-            "uid": mail.uid,
-            "sender": mail.sender,
-            "to_addrs": mail.to_addrs,
-            "subject": mail.subject,
-            "date": str(mail.date),
-            "flags": mail.flags,
-            "attachments": [att.filename for att in mail.attachments],
-        })
-    # uid_list = box.fetch_uids(id_list)
-    # box.mark_as_delete(uid_list)
-    # box.expunge()
-    for uid in box.fetch_uids(id_list, gen=True):
-        box.mark_as_delete(str(uid))
-        box.expunge()
+
+    def progress(deleted_count, total):
+        log.info("Deleted %d/%d messages", deleted_count, total)
+
+    box.delete('FROM "{}"'.format("test@mail.com"), chunk_size=500,
+               progress=progress)
     box.logout()
 
 